@@ -0,0 +1,37 @@
+"""
+Compare two benchmark result files, e.g. from two commits.
+
+    python benchmarks/compare.py before.json after.json [--threshold 1.1]
+"""
+import sys
+import json
+import argparse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=1.1, help='Flag benchmarks that got this many times slower (default: 1.1)')
+    args = parser.parse_args(argv)
+
+    with open(args.before, 'r', encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, 'r', encoding='utf-8') as f:
+        after = json.load(f)
+
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+    print(f"{'benchmark':<40} {'before ms':>12} {'after ms':>12} {'ratio':>8} {'peak KiB':>12}")
+    regressions = 0
+    for name, timing in after['totals'].items():
+        previous = before['totals'].get(name)
+        if previous is None or previous['median_s'] == 0:
+            print(f"{name:<40} {'-':>12} {timing['median_s'] * 1000:12.1f} {'-':>8} {timing['peak_bytes'] / 1024:12.1f}")
+            continue
+        ratio = timing['median_s'] / previous['median_s']
+        flag = '  slower' if ratio > args.threshold else ''
+        regressions += ratio > args.threshold
+        print(f"{name:<40} {previous['median_s'] * 1000:12.1f} {timing['median_s'] * 1000:12.1f} {ratio:8.2f} {timing['peak_bytes'] / 1024:12.1f}{flag}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Benchmarks over the bundled IDF corpus (uploads/*.IDF) and synthetic panels.
+
+    python benchmarks/run.py --output benchmarks/results.json
+    python benchmarks/compare.py old.json new.json
+
+Every benchmark records the min/median/mean wall time over --repeat runs and the peak memory of one extra
+run under tracemalloc.
+"""
+import os
+import io
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import contextlib
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO)
+
+import numpy as np
+import plotly
+
+import idf_tool.parse_idf as idf
+from idf_tool.document import IdfDocument
+
+def measure(fn, setup=None, repeat=3):
+    """ Time `fn(setup())`; setup time is not measured. """
+    times = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        fn(argument)
+        times.append(time.perf_counter() - start)
+
+    argument = setup() if setup else None
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    fn(argument)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return {'min_s': min(times), 'median_s': statistics.median(times), 'mean_s': statistics.mean(times), 'repeat': repeat, 'peak_bytes': peak}
+
+def fresh(document):
+    """ Copy of a document without its rendered text caches. """
+    return IdfDocument.from_state(*document.state())
+
+def string_metadata_of(document):
+    string_metadata = {}
+    for string in document.outline_names('string'):
+        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(document.outline(string), idf.CELL_TYPES)
+        string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+    return string_metadata
+
+def flip_all(document):
+    """ Rotation arguments that turn every string and busbar by 180 degrees. """
+    sbars, _ = idf.get_component_names_by_type(document)
+    w_sbar_prev = {sbar: [document.placement(document.rows_named(sbar)[0])[3]] for sbar in sbars if len(document.rows_named(sbar))}
+    string_rows = document.placements[document.rows_of_type('string')]
+    w_string_prev = {id: [rotation] for id, rotation in zip(string_rows['id'].tolist(), string_rows['rotation'].tolist())}
+    w_sbar = {sbar: (prev[0] + 180) % 360 for sbar, prev in w_sbar_prev.items()}
+    w_string = {id: (prev[0] + 180) % 360 for id, prev in w_string_prev.items()}
+    return w_sbar_prev, w_sbar, w_string_prev, w_string
+
+def benchmark_functions(path, repeat):
+    with open(path, 'r') as f:
+        text = f.read()
+    document = idf.parse_document(path)
+    string_metadata = string_metadata_of(document)
+    w_sbar_prev, w_sbar, w_string_prev, w_string = flip_all(document)
+    regenerated = idf.regenerate_idf_file_content(fresh(document))
+
+    def generate_outlines(target):
+        for string, metadata in string_metadata.items():
+            idf.generate_string_outline(metadata['cell_type'], metadata['nr_cells'], metadata['dist'], metadata['plus'], metadata['minus'],
+                                        target, string, idf.CELL_TYPES, None)
+
+    def warm_document():
+        target = fresh(document)
+        idf.regenerate_idf_file_content(target)
+        return target
+
+    return {
+        'parse': measure(lambda _: idf.parse_document(path), repeat=repeat),
+        'reverse_engineer_string_outline': measure(lambda _: string_metadata_of(document), repeat=repeat),
+        'generate_string_outline': measure(generate_outlines, setup=lambda: fresh(document), repeat=repeat),
+        'rotate': measure(lambda target: idf.rotate(target, w_sbar_prev, w_sbar, w_string_prev, w_string, string_metadata, idf.CELL_TYPES),
+                          setup=lambda: fresh(document), repeat=repeat),
+        'draw_board_json': measure(lambda _: json.dumps(idf.draw_board(document), cls=plotly.utils.PlotlyJSONEncoder), repeat=repeat),
+        'regenerate_idf_file_content': measure(idf.regenerate_idf_file_content, setup=lambda: fresh(document), repeat=repeat),
+        'regenerate_idf_file_content_cached': measure(idf.regenerate_idf_file_content, setup=warm_document, repeat=repeat),
+        'generate_diff': measure(lambda _: idf.generate_diff(text, regenerated, 'original', 'output'), repeat=repeat),
+    }
+
+def roundtrip_form(document):
+    """ /submit_parameters form that flips every component and puts a soldering pad under every busbar. """
+    form = {}
+    for id, name, component_type, rotation in zip(document.placements['id'].tolist(), document.placements['name'].tolist(),
+                                                  document.placements['type'].tolist(), document.placements['rotation'].tolist()):
+        if document.types[component_type] == 'string':
+            form[f'string180deg_{id}'] = str((rotation + 180) % 360)
+        else:
+            form[f'sbar180deg_{document.names[name]}'] = str((rotation + 180) % 360)
+            form[f'sbarheight_{document.names[name]}'] = 'on'
+    return form
+
+class RoundTrip:
+    """ Drives /submit -> /submit_parameters -> /export through the Flask test client, with its folders in a temporary directory. """
+
+    def __init__(self, folder):
+        # The app resolves templates relative to the working directory
+        os.chdir(REPO)
+        import idf_tool.app as app_module
+        self.app_module = app_module
+        self.folder = folder
+        app_module.app.config.update(TESTING=True, UPLOAD_FOLDER=os.path.join(folder, 'uploads'), EXPORT_FOLDER=os.path.join(folder, 'submits'))
+        app_module.store.folder = os.path.join(folder, 'workspaces')
+        app_module.parse_cache.folder = os.path.join(folder, 'parse_cache')
+        for path in (app_module.app.config['UPLOAD_FOLDER'], app_module.app.config['EXPORT_FOLDER'], app_module.store.folder):
+            os.makedirs(path, exist_ok=True)
+
+    def clear_parse_cache(self):
+        shutil.rmtree(self.app_module.parse_cache.folder, ignore_errors=True)
+        os.makedirs(self.app_module.parse_cache.folder)
+
+    def run(self, filename, data, form):
+        client = self.app_module.app.test_client()
+        with contextlib.redirect_stdout(io.StringIO()):
+            responses = [
+                client.post('/submit', data={'file': (io.BytesIO(data), filename)}, content_type='multipart/form-data'),
+                client.post('/submit_parameters', data=form),
+                client.post('/export'),
+            ]
+        for response in responses:
+            if response.status_code != 200:
+                raise RuntimeError(f'{response.request.path} returned {response.status_code}')
+            response.get_data()
+
+    def benchmark(self, path, repeat):
+        with open(path, 'rb') as f:
+            data = f.read()
+        form = roundtrip_form(idf.parse_document(path))
+        filename = os.path.basename(path)
+
+        def cold():
+            self.clear_parse_cache()
+
+        def warm():
+            self.run(filename, data, form)
+
+        return {
+            'roundtrip': measure(lambda _: self.run(filename, data, form), setup=cold, repeat=repeat),
+            'roundtrip_cached_parse': measure(lambda _: self.run(filename, data, form), setup=warm, repeat=repeat),
+        }
+
+def synthetic_panel(nr_strings, seed=0):
+    """ IDF text of a generated panel with `nr_strings` strings and one busbar per five strings. """
+    random.seed(seed)
+    string_types = [('M10 HC', 10, 2.0, 15.0, 15.0), ('M10', 6, 3.0, 12.0, 11.0), ('G1', 11, 2.0, 15.0, 15.0), ('M10 HC', 5, 2.0, 10.0, 10.0)]
+    columns = max(1, int(np.ceil(np.sqrt(nr_strings))))
+    width = columns * 200.0 + 100
+    length = int(np.ceil(nr_strings / columns)) * 1900.0 + 100
+
+    document = IdfDocument()
+    names = []
+    for cell_type, nr_cells, dist, plus, minus in string_types:
+        name = f"String {cell_type} {nr_cells} Cells {int(dist)}mm +{int(plus)}mm -{int(minus)}mm"
+        idf.generate_string_outline(cell_type, nr_cells, dist, plus, minus, document, name, idf.CELL_TYPES, None)
+        names.append(name)
+    for i in range(nr_strings // 5):
+        name = f'Busbar {i:05}'
+        document.set_outline(name, 'busbar', '0.3', [[0, 0, 0], [120, 0, 0], [120, 5, 0], [0, 5, 0], [0, 0, 0]])
+        document.add_placement(f'BB{i:03}', name, 'busbar', [-random.uniform(0, width), -random.uniform(0, length), 0.92, 0.0])
+    for i in range(nr_strings):
+        x = -100.0 - (i % columns) * 200.0
+        y = -100.0 - (i // columns) * 1900.0
+        document.add_placement(f'STR{i:03}', random.choice(names), 'string', [x, y, 0.92, random.choice([0.0, 180.0])])
+
+    document.header = f""".HEADER
+BOARD_FILE 3.0 "IPTE TS1 1.0" 2025/01/01.00:00:00 1
+"Synthetic panel // {nr_strings} strings" MM
+.END_HEADER
+.BOARD_OUTLINE UNOWNED
+4.0
+0 0.0 0.0 0.0
+0 -{width} 0.0 0.0
+0 -{width} -{length} 0.0
+0 0.0 -{length} 0.0
+0 0.0 0.0 0.0
+.END_BOARD_OUTLINE
+"""
+    return idf.regenerate_idf_file_content(document)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=os.path.join(REPO, 'benchmarks', 'results.json'), help='Where the JSON results are written')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark (default: 3)')
+    parser.add_argument('--scales', default='100,1000,5000', help='Strings per synthetic panel, comma separated (default: 100,1000,5000)')
+    parser.add_argument('--corpus', default=os.path.join(REPO, 'uploads'), help='Directory with the IDF corpus (default: uploads/)')
+    parser.add_argument('--skip-corpus', action='store_true', help='Only run the synthetic panels')
+    parser.add_argument('--skip-synthetic', action='store_true', help='Only run the corpus')
+    parser.add_argument('--skip-roundtrip', action='store_true', help='Do not time the Flask round trip')
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp(prefix='idf-benchmarks-')
+    roundtrip = None if args.skip_roundtrip else RoundTrip(folder)
+
+    datasets = []
+    if not args.skip_corpus:
+        datasets += sorted(path for path in glob.glob(os.path.join(args.corpus, '*')) if path.lower().endswith('.idf'))
+    if not args.skip_synthetic:
+        for nr_strings in [int(scale) for scale in args.scales.split(',') if scale]:
+            path = os.path.join(folder, f'synthetic_{nr_strings}.IDF')
+            with open(path, 'w') as f:
+                f.write(synthetic_panel(nr_strings))
+            datasets.append(path)
+
+    results = []
+    try:
+        for path in datasets:
+            result = {'dataset': os.path.basename(path), 'synthetic': path.startswith(folder), 'bytes': os.path.getsize(path)}
+            try:
+                document = idf.parse_document(path)
+                result['components'] = len(document)
+                result['benchmarks'] = benchmark_functions(path, args.repeat)
+                if roundtrip is not None:
+                    result['benchmarks'].update(roundtrip.benchmark(path, args.repeat))
+            except Exception as error:
+                result['error'] = f'{type(error).__name__}: {error}'
+            results.append(result)
+            status = result.get('error') or ', '.join(f"{name} {timing['median_s'] * 1000:.1f} ms" for name, timing in result.get('benchmarks', {}).items())
+            print(f"{result['dataset']}: {status}", file=sys.stderr)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    totals = {}
+    for result in results:
+        for name, timing in result.get('benchmarks', {}).items():
+            total = totals.setdefault(name, {'median_s': 0.0, 'peak_bytes': 0})
+            total['median_s'] += timing['median_s']
+            total['peak_bytes'] = max(total['peak_bytes'], timing['peak_bytes'])
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'totals': totals,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,11 @@
 import os
 import sys
 import logging
-import re
 import webbrowser
 import signal
+import secrets
 import subprocess
+import contextlib
 from threading import Timer
 from datetime import datetime
 
@@ -12,10 +13,19 @@ from datetime import datetime
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from flask import Flask, render_template, request, redirect, flash, session, send_file, url_for, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, redirect, flash, session, send_file, url_for, jsonify, send_from_directory, g, stream_with_context
 from flask_session import Session
 import idf_tool.parse_idf as idf
+import idf_tool.metrics as metrics
+import idf_tool.validate as validate
+import idf_tool.batch as batch
+import idf_tool.layout as layout
+from idf_tool.jobs import JobQueue, DONE, FAILED
+from idf_tool.history import EditHistory
+from idf_tool.store import DocumentStore, SharedDocumentStore, ParseCache, Workspace, atomic_copy, atomic_write, content_hash, new_handle, save_stream, value_size
+from idf_tool.sessions import SqliteSessionInterface
 import json
+import numpy as np
 import plotly
 import plotly.graph_objects as go
 from werkzeug.utils import secure_filename
@@ -43,11 +53,42 @@ app.config.update(
 
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['UPLOAD_FOLDER'] = resource_path("uploads")
+app.config['SOURCE_FOLDER'] = resource_path("sources")  # Uploads by content hash, the parsed documents map these files
 app.config['EXPORT_FOLDER'] = resource_path("submits")
-app.config['MAX_CONTENT_LENGTH'] = 15 * 1024 * 1024  # 15MB max file size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('IDF_MAX_UPLOAD_MB', '500')) * 1024 * 1024  # 500MB max file size by default, uploads are streamed to disk
 app.config['ALLOWED_EXTENSIONS'] = {'idf'}
-
-Session(app)
+app.config['PER_COMPONENT_LEGEND'] = False  # One plot trace per placement instead of one per component type
+
+app.config['STORE_FOLDER'] = resource_path("workspaces")
+app.config['STORE_MAX_BYTES'] = 256 * 1024 * 1024  # In-memory budget of the document store, older workspaces spill to disk
+app.config['PARSE_CACHE_FOLDER'] = resource_path("parse_cache")
+app.config['PARSE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+app.config['SESSION_WORKSPACES'] = 10  # Uploads per session that stay available for the bundle export
+app.config['PROFILE_FOLDER'] = os.environ.get('IDF_PROFILE_FOLDER')  # When set, ?profile=1 dumps a cProfile of that request here
+app.config['JOB_FOLDER'] = resource_path("jobs")
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', '2'))  # Threads that run background jobs (parsing, diffs, batches, bundle exports)
+app.config['JOB_TTL'] = 3600  # Seconds a finished job and its result files are kept
+app.config['BATCH_PROCESSES'] = 2  # Worker processes of one batch correction job
+app.config['STATE_DATABASE'] = os.environ.get('IDF_STATE_DATABASE')  # SQLite file shared by gunicorn workers, see docker-compose.yml
+
+if app.config['STATE_DATABASE']:
+    # Multi-worker profile: sessions, workspaces and job status live in SQLite, shared by all worker processes
+    os.makedirs(os.path.dirname(os.path.abspath(app.config['STATE_DATABASE'])), exist_ok=True)
+    app.session_interface = SqliteSessionInterface(app, app.config['STATE_DATABASE'])
+    store = SharedDocumentStore(app.config['STATE_DATABASE'], app.config['STORE_MAX_BYTES'])
+else:
+    Session(app)
+    store = DocumentStore(app.config['STORE_FOLDER'], app.config['STORE_MAX_BYTES'])
+os.makedirs(app.config['SOURCE_FOLDER'], exist_ok=True)
+parse_cache = ParseCache(app.config['PARSE_CACHE_FOLDER'], idf.PARSER_VERSION, app.config['PARSE_CACHE_MAX_BYTES'])
+job_queue = JobQueue(app.config['JOB_FOLDER'], app.config['JOB_WORKERS'], app.config['JOB_TTL'], app.config['STATE_DATABASE'])
+
+metrics.instrument(idf, ['parse_lines', 'read_buffer', 'read_file', 'draw_board', 'board_traces', 'figure_patch', 'translate', 'rotate', 'rotate_batch', 'autogenerate_string_coordinates',
+                         'regenerate_idf_file_content', 'add_components', 'change_string_names', 'change_sbar_height',
+                         'generate_string_outline', 'reverse_engineer_string_outline', 'generate_diff', 'diff_page'])
+metrics.instrument(validate, ['validate'])
+metrics.instrument(layout, ['layout_strings'])
+metrics.init_app(app, workspace_size=lambda: value_size(g.get('workspace', {})))
 
 logging.basicConfig(filename='app.log', level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
@@ -56,10 +97,141 @@ def allowed_file(filename):
 
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+CONFLICT_MESSAGE = 'The file was changed by another request at the same time. Please reload the page.'
+
+def lock_workspace(handle):
+    """
+    Hold the lock of a workspace until the request ends, the threads of a worker share the workspace objects
+    (e.g. the /api/figure requests of a page run at the same time).
+    """
+    locks = g.setdefault('workspace_locks', {})
+    if handle not in locks:
+        lock = store.lock(handle)
+        lock.acquire()
+        locks[handle] = lock
+
+@app.teardown_request
+def release_workspaces(error):
+    for lock in g.pop('workspace_locks', {}).values():
+        lock.release()
+
+def get_workspace():
+    """ Server-side state of the current session. The session itself only holds the workspace handle. """
+    if 'workspace' not in g:
+        handle = session.get('workspace')
+        if handle:
+            lock_workspace(handle)
+        workspace = store.get(handle) if handle else None
+        g.workspace = workspace if workspace is not None else Workspace()
+    return g.workspace
+
+def open_workspace(digest, workspace=None):
+    """ Start a new workspace for uploaded or generated IDF content with hash `digest`. Earlier workspaces stay available for the bundle export. """
+    handle = new_handle(digest)
+    handles = session.get('workspaces', []) + [handle]
+    for old_handle in handles[:-app.config['SESSION_WORKSPACES']]:
+        store.discard(old_handle)
+    session['workspaces'] = handles[-app.config['SESSION_WORKSPACES']:]
+    session['workspace'] = handle
+    lock_workspace(handle)
+    g.workspace = Workspace() if workspace is None else Workspace(workspace)
+    return g.workspace
+
+def save_workspace(route):
+    """
+    Store the workspace of the request. Routes call this after they changed it, in place or not; nothing else
+    stores it. Returns False when another worker stored the workspace while the request ran: its changes are
+    kept instead of these, and the route tells the user to reload (CONFLICT_MESSAGE).
+    """
+    handle = session.get('workspace')
+    # Without an upload there is nothing to store
+    if not handle or store.put(handle, get_workspace()):
+        return True
+    logging.warning(f"Route: {route} - Workspace {handle} was changed by another request, changes not stored")
+    return False
+
+def clear_workspace():
+    for handle in set(session.get('workspaces', []) + [session.get('workspace')]):
+        store.discard(handle)
+    session.clear()
+    g.workspace = Workspace()
+
+@metrics.timed
+def figure_json(fig):
+    graph_json = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    metrics.observe_size('graph_json', len(graph_json))
+    return graph_json
+
+def figure_response(version, graph_json):
+    # The figure is already JSON, embed it instead of decoding and encoding it again
+    return Response(f'{{"version": {json.dumps(version)}, "figure": {graph_json}}}', mimetype='application/json')
+
+def store_figure_model(workspace, version, traces):
+    """ Keep the traces of the figure sent to the browser, as flat arrays so a spilled workspace stores them in its .npz file. """
+    workspace['figure_version'] = version
+    workspace['figure_x'] = np.concatenate([x for _, _, x, _, _ in traces])
+    workspace['figure_y'] = np.concatenate([y for _, _, _, y, _ in traces])
+    workspace['figure_lengths'] = np.array([len(x) for _, _, x, _, _ in traces], dtype=np.int64)
+    workspace['figure_traces'] = [[kind, name, text] for kind, name, _, _, text in traces]
+
+def figure_model(workspace):
+    """ Traces of the figure last sent to the browser, in the format of parse_idf.board_traces. """
+    if workspace.get('figure_version', None) is None:
+        return None
+    splits = np.cumsum(workspace['figure_lengths'])[:-1]
+    xs = np.split(np.asarray(workspace['figure_x'], dtype=np.float64), splits)
+    ys = np.split(np.asarray(workspace['figure_y'], dtype=np.float64), splits)
+    return [(kind, name, x, y, text) for (kind, name, text), x, y in zip(workspace['figure_traces'], xs, ys)]
+
+def known_string_metadata(document, strings, cell_types, known):
+    """ Metadata of every string, reusing `known` entries. Only strings without one (e.g. renamed since) are analysed. """
+    string_metadata = {}
+    for string in strings:
+        if string in known:
+            string_metadata[string] = known[string]
+        else:
+            dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(document.outline(string), cell_types)
+            string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+    return string_metadata
+
+def editor_context(document):
+    """
+    Template variables of the component editor in manipulate.html. The string placements are not among them,
+    the editor fetches the rows it shows from /api/placements, so the page size doesn't grow with the module.
+    """
+    if document is None:
+        return {'string_count': 0, 'string_names': [], 'busbar_placements': {}, 'busbar_corners': {}}
+    busbar_placements = {}
+    for row in document.rows_of_type('busbar').tolist():
+        busbar_placements.setdefault(document.placement_name(row), []).append((str(document.placements['id'][row]), document.placement(row)))
+    return {
+        'string_count': len(document.rows_of_type('string')),
+        'string_names': document.outline_names('string'),
+        'busbar_placements': busbar_placements,
+        'busbar_corners': {name: document.outline(name)[2].tolist() for name in document.outline_names('busbar')},
+    }
+
+def record_edit(workspace, label):
+    """ Add the changes of this request to the edit history of the workspace, as one undo step. """
+    history = workspace.get('history', None)
+    if history is not None:
+        history.commit(workspace['corrected_document'], workspace['document'], workspace, label)
+
+def history_context(workspace):
+    """ Template variables of the undo and redo buttons in manipulate.html. """
+    history = workspace.get('history', None)
+    return {'history': history.summary() if history is not None else None}
+
+def export_chunks(workspace):
+    """ Text of the file to export. Streamed from the serializer when the stored file content reflects the corrected document. """
+    if workspace.get('content_is_regenerated'):
+        return idf.iter_idf_file_content(workspace['corrected_document'])
+    return idf.text_chunks(workspace.get('new_file_content', ''))
+
 @app.route('/')
 def base():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
-    session.clear()
+    clear_workspace()
     return render_template('home.html', fig_dir=fig_dir, enable_drop=True)
 
 @app.route('/home_src')
@@ -67,7 +239,8 @@ def home():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    graph_json = session.get('graph_json', None)
+    workspace = get_workspace()
+    graph_json = workspace.get('graph_json', None)
 
     return render_template('home.html', graph_json=graph_json, fig_dir=fig_dir, enable_drop=True)
 
@@ -116,34 +289,29 @@ BOARD_FILE 3.0 "IPTE TS1 1.0" {date_str} 1
 
     # now you can write it out:
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(new_file_content)
+    atomic_write(file_path, new_file_content.encode('utf-8'))
 
     # 5) run your existing IDF functions
-    board_outline = idf.board_outline(file_path)
-    component_outlines = idf.component_outlines(file_path)
-    component_placements = idf.component_placements(file_path)
-    sbars, strings = idf.get_component_names_by_type(component_outlines)
-    cell_types = {'M10': [182.0, 182.0, 10, 13.1], 'M10 HC': [182.0, 91.0, 10, 13.1], 'G1': [158.75, 158.75, 5, 16.625]}
+    workspace = open_workspace(content_hash(new_file_content), dict(get_workspace()))
+    document = idf.parse_lines(new_file_content.splitlines(keepends=True))
+    sbars, strings = idf.get_component_names_by_type(document)
+    cell_types = idf.CELL_TYPES
 
     # Data processing
-    corrected_component_outlines = component_outlines.copy()
-    corrected_component_placements = component_placements.copy()
+    corrected_document = document.copy()
 
-    fig = idf.draw_board(board_outline, component_outlines, component_placements)
-    graph_json = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    fig = idf.draw_board(document, per_component=app.config['PER_COMPONENT_LEGEND'])
+    graph_json = figure_json(fig)
 
     w_sbar = {}
     for sbar in sbars:
-        id = [id for id, placement in corrected_component_placements.items() if placement["name"] == sbar][0]
-        w_sbar[sbar] = corrected_component_placements[id]['placement'][3]
+        row = corrected_document.rows_named(sbar)[0]
+        w_sbar[sbar] = corrected_document.placement(row)[3]
     z_sbar = {sbar: False for sbar in sbars}
-    new_string_names = session.get('new_string_names', None)
+    new_string_names = workspace.get('new_string_names', None)
 
-    w_string = {}
-    for id, placement in corrected_component_placements.items():
-        if placement["component_type"] == "string":
-            w_string[id] = corrected_component_placements[id]['placement'][3]
+    string_rows = corrected_document.placements[corrected_document.rows_of_type('string')]
+    w_string = dict(zip(string_rows['id'].tolist(), string_rows['rotation'].tolist()))
 
     w_sbar_prev = {}
     for sbar, value in w_sbar.items():
@@ -162,80 +330,87 @@ BOARD_FILE 3.0 "IPTE TS1 1.0" {date_str} 1
 
     string_metadata = {}
     for string in strings:
-        outline = corrected_component_outlines[string]
-        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(outline['coordinates'], cell_types)
+        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(corrected_document.outline(string), cell_types)
         string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
 
     # Store session data
-    session['string_metadata'] = string_metadata
-    session['cell_types'] = cell_types
-    session['file_content'] = file_content
-    session['new_file_content'] = new_file_content
-    session['graph_json'] = graph_json
-    session['board_outline'] = board_outline
-    session['component_outlines'] = component_outlines
-    session['component_placements'] = component_placements
-    session['corrected_component_outlines'] = corrected_component_outlines
-    session['corrected_component_placements'] = corrected_component_placements
-    session['w_sbar'] = w_sbar
-    session['w_string'] = w_string
-    session['z_sbar'] = z_sbar
-    session['sbars'] = sbars
-    session['strings'] = strings
-    session['w_sbar_prev'] = w_sbar_prev
-    session['w_string_prev'] = w_string_prev
-    session['filename'] = filename
+    workspace['string_metadata'] = string_metadata
+    workspace['cell_types'] = cell_types
+    workspace['file_content'] = file_content
+    workspace['new_file_content'] = new_file_content
+    workspace['graph_json'] = graph_json
+    workspace['document'] = document
+    workspace['corrected_document'] = corrected_document
+    workspace['content_is_regenerated'] = False
+    workspace['w_sbar'] = w_sbar
+    workspace['w_string'] = w_string
+    workspace['z_sbar'] = z_sbar
+    workspace['sbars'] = sbars
+    workspace['strings'] = strings
+    workspace['w_sbar_prev'] = w_sbar_prev
+    workspace['w_string_prev'] = w_string_prev
+    workspace['filename'] = filename
+    workspace['history'] = EditHistory(workspace)
+    if not save_workspace('/create_idf'):
+        flash(CONFLICT_MESSAGE)
 
     logging.info(f"Created IDF {filename} from popup on {request.path}")
 
     # 6) go back to the page the user was on
     return redirect(next_page)
 
-@app.route('/submit', methods=['POST'])
-def submit_file():
-    print("submit_file")
-    session.clear()
-    fig_dir = url_for('static', filename='img/Soltech_Logo.png')
-
-    # File management
-    file = request.files.get('file')
-    if not file or file.filename == '' or not allowed_file(file.filename):
-        print("File not found")
-        return redirect(request.url)
-
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
-    session['filename'] = filename
-    logging.info(f'Route: /submit - File {filename} uploaded')
+def parse_upload(digest, source_path, cell_types, report):
+    """
+    Parse an uploaded file, draw its figure and infer the metadata of its strings. Repeated uploads of the same
+    bytes come from the parse cache.
+
+    :param digest: Hash of the file, see save_upload
+    :param source_path: The file, saved by its hash
+    :param report: Called as report(progress, milestone) while parsing, with milestone None for plain progress
+    :return: The document, the string metadata and the figure JSON
+    """
+    cache_key = digest + ('-legend' if app.config['PER_COMPONENT_LEGEND'] else '')
+    cached = parse_cache.get(cache_key)
+    if cached is not None:
+        report(1.0, 'IDF file loaded from the parse cache')
+        return cached['document'], cached['string_metadata'], cached['graph_json']
+
+    # Parsed through a memory map of the saved file, which never changes: the document refers to it by path, so neither
+    # the workspace nor the parse cache holds a copy of the bytes
+    document = idf.read_file(source_path, immutable=True)
+    report(0.4, 'IDF file parsed')
+
+    fig = idf.draw_board(document, per_component=app.config['PER_COMPONENT_LEGEND'])
+    graph_json = figure_json(fig)
+    report(0.6, None)
 
-    # IDF parsing
-    board_outline = idf.board_outline(file_path)
-    component_outlines = idf.component_outlines(file_path)
-    component_placements = idf.component_placements(file_path)
-    sbars, strings = idf.get_component_names_by_type(component_outlines)
-    cell_types = {'M10': [182.0, 182.0, 10, 13.1], 'M10 HC': [182.0, 91.0, 10, 13.1], 'G1': [158.75, 158.75, 5, 16.625]}
+    string_metadata = {}
+    strings = document.outline_names('string')
+    for i, string in enumerate(strings):
+        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(document.outline(string), cell_types)
+        string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+        report(0.6 + 0.3 * (i + 1) / len(strings), None)
+    parse_cache.put(cache_key, {'document': document, 'string_metadata': string_metadata, 'graph_json': graph_json})
+    return document, string_metadata, graph_json
 
-    logging.info("Route: /submit - IDF file parsed")
+def start_workspace(route, workspace, document, string_metadata, graph_json, cell_types):
+    """ Fill a new workspace from a parsed upload and render the home page with it. """
+    fig_dir = url_for('static', filename='img/Soltech_Logo.png')
+    filename = workspace['filename']
+    sbars, strings = idf.get_component_names_by_type(document)
 
     # Data processing
-    corrected_component_outlines = component_outlines.copy()
-    corrected_component_placements = component_placements.copy()
-
-    fig = idf.draw_board(board_outline, component_outlines, component_placements)
-    graph_json = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    corrected_document = document.copy()
 
     w_sbar = {}
     for sbar in sbars:
-        id = [id for id, placement in corrected_component_placements.items() if placement["name"] == sbar][0]
-        w_sbar[sbar] = corrected_component_placements[id]['placement'][3]
+        row = corrected_document.rows_named(sbar)[0]
+        w_sbar[sbar] = corrected_document.placement(row)[3]
     z_sbar = {sbar: False for sbar in sbars}
-    new_string_names = session.get('new_string_names', None)
+    new_string_names = workspace.get('new_string_names', None)
 
-    w_string = {}
-    for id, placement in corrected_component_placements.items():
-        if placement["component_type"] == "string":
-            w_string[id] = corrected_component_placements[id]['placement'][3]
+    string_rows = corrected_document.placements[corrected_document.rows_of_type('string')]
+    w_string = dict(zip(string_rows['id'].tolist(), string_rows['rotation'].tolist()))
 
     w_sbar_prev = {}
     for sbar, value in w_sbar.items():
@@ -252,63 +427,92 @@ def submit_file():
     if new_string_names is None:
         new_string_names = {string: '' for string in strings}
 
-    file.seek(0)
-    file_content = file.read().decode('utf-8')
-    logging.info("Route: /submit - Data processed")
-
-    string_metadata = {}
-    for string in strings:
-        outline = corrected_component_outlines[string]
-        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(outline['coordinates'], cell_types)
-        string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+    logging.info(f"Route: {route} - Data processed")
 
     # Store session data
-    session['string_metadata'] = string_metadata
-    session['cell_types'] = cell_types
-    session['file_content'] = file_content
-    session['graph_json'] = graph_json
-    session['board_outline'] = board_outline
-    session['component_outlines'] = component_outlines
-    session['component_placements'] = component_placements
-    session['corrected_component_outlines'] = corrected_component_outlines
-    session['corrected_component_placements'] = corrected_component_placements
-    session['w_sbar'] = w_sbar
-    session['w_string'] = w_string
-    session['z_sbar'] = z_sbar
-    session['sbars'] = sbars
-    session['strings'] = strings
-    session['w_sbar_prev'] = w_sbar_prev
-    session['w_string_prev'] = w_string_prev
-    logging.info("Route: /submit - Session data stored")
+    workspace['string_metadata'] = string_metadata
+    workspace['cell_types'] = cell_types
+    workspace['graph_json'] = graph_json
+    workspace['document'] = document
+    workspace['corrected_document'] = corrected_document
+    workspace['w_sbar'] = w_sbar
+    workspace['w_string'] = w_string
+    workspace['z_sbar'] = z_sbar
+    workspace['sbars'] = sbars
+    workspace['strings'] = strings
+    workspace['w_sbar_prev'] = w_sbar_prev
+    workspace['w_string_prev'] = w_string_prev
+    workspace['history'] = EditHistory(workspace)
+    if not save_workspace(route):
+        flash(CONFLICT_MESSAGE)
+        return redirect(url_for('home'))
+    logging.info(f"Route: {route} - Session data stored")
 
     return render_template('home.html', strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, w_sbar=w_sbar, w_string=w_string, new_string_names=new_string_names, z_sbar=z_sbar, fig_dir=fig_dir)
 
+def save_upload(file):
+    """
+    Save an uploaded IDF file in chunks, by its hash to the source folder and under its name to the upload folder.
+    Returns its file name, hash and source path, or None for an invalid upload.
+    """
+    if not file or file.filename == '' or not allowed_file(file.filename):
+        return None
+    filename = secure_filename(file.filename)
+    digest, source_path = save_stream(file.stream, app.config['SOURCE_FOLDER'], '.IDF')
+    # Other worker processes may save an upload with the same name at the same time
+    atomic_copy(source_path, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    return filename, digest, source_path
+
+@app.route('/submit', methods=['POST'])
+def submit_file():
+    print("submit_file")
+
+    # File management
+    upload = save_upload(request.files.get('file'))
+    if upload is None:
+        print("File not found")
+        return redirect(request.url)
+    filename, digest, source_path = upload
+    workspace = open_workspace(digest)
+    workspace['filename'] = filename
+    logging.info(f'Route: /submit - File {filename} uploaded')
+
+    # IDF parsing, repeated uploads of the same bytes come from the parse cache
+    cell_types = idf.CELL_TYPES
+
+    def log_milestone(progress, milestone):
+        if milestone is not None:
+            logging.info(f"Route: /submit - {milestone}")
+
+    document, string_metadata, graph_json = parse_upload(digest, source_path, cell_types, log_milestone)
+    return start_workspace('/submit', workspace, document, string_metadata, graph_json, cell_types)
+
 @app.route('/submit_parameters', methods=['POST'])
 def submit_parameters():
     print("submit_parameters")
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    sbars = session.get('sbars', [])
-    strings = session.get('strings', [])
-    graph_json = session.get('graph_json', None)
-    filename = session.get('filename', None)
-    corrected_component_placements = session.get('corrected_component_placements', None)
-    corrected_component_outlines = session.get('corrected_component_outlines', None)
-    w_sbar_prev = session.get('w_sbar_prev', {})
-    w_string_prev = session.get('w_string_prev', {})
-    w_string = session.get('w_string', {})
-    z_sbar = session.get('z_sbar', {sbar: False for sbar in sbars})
-    w_sbar = session.get('w_sbar', {sbar: 0.0 for sbar in sbars})
-    cell_types = session.get('cell_types', {})
+    workspace = get_workspace()
+    sbars = workspace.get('sbars', [])
+    strings = workspace.get('strings', [])
+    graph_json = workspace.get('graph_json', None)
+    filename = workspace.get('filename', None)
+    corrected_document = workspace.get('corrected_document', None)
+    w_sbar_prev = workspace.get('w_sbar_prev', {})
+    w_string_prev = workspace.get('w_string_prev', {})
+    w_string = workspace.get('w_string', {})
+    z_sbar = workspace.get('z_sbar', {sbar: False for sbar in sbars})
+    w_sbar = workspace.get('w_sbar', {sbar: 0.0 for sbar in sbars})
+    cell_types = workspace.get('cell_types', {})
     logging.info("Route: /submit_parameters - Session data retrieved")
     
     # HTML Parsing
     new_string_names = {key[7:]: request.form[key] for key in request.form if key.startswith('string_')}
 
-    for id, placement in corrected_component_placements.items():
-        if placement["component_type"] == "string":
-            w_string[id] = float(request.form.get(f'string180deg_{id}', 0.0))
+    # The editor only has the rows in view in the DOM, strings that are not in the form keep their angle
+    for id in corrected_document.placements[corrected_document.rows_of_type('string')]['id'].tolist():
+        w_string[id] = float(request.form.get(f'string180deg_{id}', w_string.get(id, 0.0)))
 
     for sbar in sbars:
         w_sbar[sbar] = float(request.form.get(f'sbar180deg_{sbar}', 0.0))
@@ -318,7 +522,7 @@ def submit_parameters():
     # Data processing
     # Place a new busbar or string on the panel
     if request.form.get('new_sbar_name_dyn', None) is not None or request.form.get('new_string_name_dyn', None) is not None:
-        idf.add_components(request.form, corrected_component_outlines, corrected_component_placements, w_sbar, z_sbar, w_string, sbars, strings)
+        idf.add_components(request.form, corrected_document, w_sbar, z_sbar, w_string, sbars, strings)
     
     # Define a new string component
     if request.form.get('cell_type', None) is not None:
@@ -328,13 +532,13 @@ def submit_parameters():
         dist = float(request.form.get('dist', 2.0))
         plus = float(request.form.get('plus', 10.0))
         minus = float(request.form.get('minus', 10.0))
-        corrected_component_outlines = idf.generate_string_outline(cell_type, nr_cells, dist, plus, minus, corrected_component_outlines, cell_name, cell_types, None)
+        idf.generate_string_outline(cell_type, nr_cells, dist, plus, minus, corrected_document, cell_name, cell_types, None)
         strings.append(cell_name)
     
     for i, string in enumerate(strings):
         required = [f'nr_of_cells_{string}', f'dist_{string}', f'plus_{string}', f'minus_{string}']
         if all((request.form.get(k) or '').strip() != '' for k in required):
-            del corrected_component_outlines[string]
+            corrected_document.remove_outline(string)
 
             cell_type = request.form.get(f'cell_type_{string}', "M10 HC")
             nr_cells = int(float(request.form.get(f'nr_of_cells_{string}', 5)))
@@ -345,11 +549,9 @@ def submit_parameters():
                 cell_name = f"String {cell_type} {nr_cells} Cells {int(dist)}mm +{int(plus)}mm -{int(minus)}mm"
             else:
                 cell_name = request.form.get(f'string_{string}')
-            corrected_component_outlines = idf.generate_string_outline(cell_type, nr_cells, dist, plus, minus, corrected_component_outlines, cell_name, cell_types, len(sbars) + i)
-            for id, placement in corrected_component_placements.items():
-                if placement["name"] == string:
-                    placement['name'] = cell_name
-            strings = [name for name, outline in corrected_component_outlines.items() if outline['component_type'] == 'string']
+            idf.generate_string_outline(cell_type, nr_cells, dist, plus, minus, corrected_document, cell_name, cell_types, len(sbars) + i)
+            corrected_document.rename_placements(corrected_document.rows_named(string), cell_name)
+            strings = corrected_document.outline_names('string')
 
     for sbar, value in w_sbar.items():
         if sbar not in w_sbar_prev:
@@ -368,100 +570,100 @@ def submit_parameters():
 
     string_metadata = {}
     for string in strings:
-        outline = corrected_component_outlines[string]
-        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(outline['coordinates'], cell_types)
+        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(corrected_document.outline(string), cell_types)
         string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
 
 
-    idf.translate(corrected_component_placements, corrected_component_outlines, w_sbar_prev, w_string_prev, request.form) 
-    idf.rotate(corrected_component_placements, corrected_component_outlines, w_sbar_prev, w_sbar, w_string_prev, w_string, string_metadata, cell_types)
+    idf.translate(corrected_document, w_sbar_prev, w_string_prev, request.form) 
+    idf.rotate(corrected_document, w_sbar_prev, w_sbar, w_string_prev, w_string, string_metadata, cell_types)
 
-    idf.change_string_names(corrected_component_placements, corrected_component_outlines, new_string_names, strings)
-    idf.change_sbar_height(corrected_component_outlines, z_sbar)
+    idf.change_string_names(corrected_document, new_string_names, strings)
+    idf.change_sbar_height(corrected_document, z_sbar)
 
     for sbar in sbars:
-        id = [id for id, placement in corrected_component_placements.items() if placement["name"] == sbar][0] 
-        w_sbar[sbar] = corrected_component_placements[id]['placement'][3]
+        row = corrected_document.rows_named(sbar)[0]
+        w_sbar[sbar] = corrected_document.placement(row)[3]
 
-    for id, placement in corrected_component_placements.items():
-        if placement["component_type"] == "string":
-            w_string[id] = corrected_component_placements[id]['placement'][3]
+    string_rows = corrected_document.placements[corrected_document.rows_of_type('string')]
+    w_string.update(zip(string_rows['id'].tolist(), string_rows['rotation'].tolist()))
 
     offset_x       = request.form.get('string_offset_x', type=float)
     offset_y       = request.form.get('string_offset_y', type=float)
     offset_between = request.form.get('offset_between_strings', type=float)
     strings_to_autogenerate = request.form.getlist('strings_to_autogenerate') or None
+    not_placed = []
 
     if offset_x is not None and offset_y is not None and offset_between is not None and strings_to_autogenerate is not None:
-        idf.autogenerate_string_coordinates(offset_x=offset_x, offset_y=offset_y, offset_between=offset_between, corrected_component_placements=corrected_component_placements, string_metadata=string_metadata, cell_types=cell_types, strings_to_autogenerate=strings_to_autogenerate)
-
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    new_file_content = idf.regenerate_idf_file_content(file_path, corrected_component_outlines, corrected_component_placements)
+        if request.form.get('layout', 'pack') == 'row':
+            idf.autogenerate_string_coordinates(offset_x=offset_x, offset_y=offset_y, offset_between=offset_between, document=corrected_document, string_metadata=string_metadata, cell_types=cell_types, strings_to_autogenerate=strings_to_autogenerate)
+        else:
+            placed, not_placed = layout.layout_strings(corrected_document, ids=strings_to_autogenerate, margin_x=offset_x, margin_y=offset_y, spacing=offset_between, allow_rotation=bool(request.form.get('layout_rotate', False)))
+            # A turned string is at its new angle already, the next submit must not turn it again
+            for id in placed:
+                rotation = corrected_document.placement(corrected_document.row(id))[3]
+                if rotation != w_string.get(id):
+                    w_string[id] = rotation
+                    w_string_prev[id] = [rotation, rotation]
+
+    new_file_content = idf.regenerate_idf_file_content(corrected_document)
+    validation_issues, validation_state = validate.validate(corrected_document, workspace.get('validation_state', None))
+    validation_issues = validation_issues + [{'kind': 'not_placed', 'ids': [id], 'message': f'{id} does not fit on the board'} for id in not_placed]
     logging.info("Route: /submit_parameters - Data processed")
 
     # Store session data
-    session['string_metadata'] = string_metadata
-    session['new_file_content'] = new_file_content
-    session['new_string_names'] = new_string_names
-    session['corrected_component_placements'] = corrected_component_placements
-    session['corrected_component_outlines'] = corrected_component_outlines
-    session['w_sbar'] = w_sbar
-    session['w_string'] = w_string
-    session['z_sbar'] = z_sbar
-    session['w_sbar_prev'] = w_sbar_prev
-    session['w_string_prev'] = w_string_prev
-    session['strings'] = strings
-    logging.info("Route: /submit_parameters - Session data stored")
-    # Clear input fields
+    workspace['string_metadata'] = string_metadata
+    workspace['new_file_content'] = new_file_content
+    workspace['content_is_regenerated'] = True
+    workspace['new_string_names'] = new_string_names
+    workspace['corrected_document'] = corrected_document
+    workspace['w_sbar'] = w_sbar
+    workspace['w_string'] = w_string
+    workspace['z_sbar'] = z_sbar
+    workspace['w_sbar_prev'] = w_sbar_prev
+    workspace['w_string_prev'] = w_string_prev
+    workspace['strings'] = strings
+    workspace['validation_issues'] = validation_issues
+    workspace['validation_state'] = validation_state
+    # Clear input fields, before storing: the stored names are the ones the page shows
     for key in new_string_names.keys():
         new_string_names[key] = ""
+    record_edit(workspace, 'Submit parameters')
+    if not save_workspace('/submit_parameters'):
+        flash(CONFLICT_MESSAGE)
+        return redirect(url_for('manipulate'))
+    logging.info("Route: /submit_parameters - Session data stored")
 
-    return render_template('manipulate.html', string_metadata=string_metadata , manipulate_after_submit_parameters = True, strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, new_string_names=new_string_names, w_sbar=w_sbar, w_string=w_string, z_sbar=z_sbar, fig_dir=fig_dir,corrected_component_placements= corrected_component_placements, corrected_component_outlines=corrected_component_outlines)
+    return render_template('manipulate.html', string_metadata=string_metadata , manipulate_after_submit_parameters = True, strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, new_string_names=new_string_names, w_sbar=w_sbar, w_string=w_string, z_sbar=z_sbar, fig_dir=fig_dir, validation_issues=validation_issues, **editor_context(corrected_document), **history_context(workspace))
 
 
 @app.route('/observe_src')
 def preview(): 
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
-
-    # Session retrieval 
-    graph_json = session.get('graph_json', json.dumps(go.Figure(), cls=plotly.utils.PlotlyJSONEncoder))
-    board_outline = session.get('board_outline', None)
-    corrected_component_outlines = session.get('corrected_component_outlines', {})
-    corrected_component_placements = session.get('corrected_component_placements', {})
     logging.info("Route: /observe_src - Session data retrieved")
 
-    # Data processing
-    if board_outline is None or corrected_component_outlines is None or corrected_component_placements is None:
-        return render_template('observe.html', section='visualize', graph_json=graph_json, graph_json2=json.dumps(go.Figure(), cls=plotly.utils.PlotlyJSONEncoder), fig_dir=fig_dir)
-
-    fig2 = idf.draw_board(board_outline, corrected_component_outlines, corrected_component_placements)
-    graph_json2 = json.dumps(fig2, cls=plotly.utils.PlotlyJSONEncoder)
-    logging.info("Route: /observe_src - Data processed")
-
-    # Store session data
-    session['graph_json2'] = graph_json2
-    logging.info("Route: /observe_src - Session data stored")
-    return render_template('observe.html', section='visualize', graph_json=graph_json, graph_json2=graph_json2, fig_dir=fig_dir)
+    # The page fetches both figures from /api/figure, which only sends what changed since the browser's copy
+    return render_template('observe.html', section='visualize', graph_json=True, graph_json2=True, fig_dir=fig_dir)
 
 @app.route('/manipulate_src')
 def manipulate():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    string_metadata = session.get('string_metadata', {})
-    strings = session.get('strings', [])
-    sbars = session.get('sbars', [])
-    filename = session.get('filename', None)
-    w_sbar = session.get('w_sbar', {})
-    w_string = session.get('w_string', {})
-    z_sbar = session.get('z_sbar', {})
-    new_string_names = session.get('new_string_names', {})
-    corrected_component_placements = session.get('corrected_component_placements', None)
-    corrected_component_outlines = session.get('corrected_component_outlines', None)
+    workspace = get_workspace()
+    string_metadata = workspace.get('string_metadata', {})
+    strings = workspace.get('strings', [])
+    sbars = workspace.get('sbars', [])
+    filename = workspace.get('filename', None)
+    w_sbar = workspace.get('w_sbar', {})
+    w_string = workspace.get('w_string', {})
+    z_sbar = workspace.get('z_sbar', {})
+    new_string_names = workspace.get('new_string_names', {})
+    corrected_document = workspace.get('corrected_document', None)
+    validation_issues = workspace.get('validation_issues', [])
     logging.info("Route: /manipulate_src - Session data retrieved")
 
     print(filename)
-    return render_template('manipulate.html', string_metadata=string_metadata, manipulate_after_submit_parameters = True, strings=strings, sbars=sbars, filename=filename, w_sbar=w_sbar, w_string=w_string, new_string_names=new_string_names, z_sbar=z_sbar, corrected_component_placements= corrected_component_placements, fig_dir=fig_dir, corrected_component_outlines=corrected_component_outlines)
+    return render_template('manipulate.html', string_metadata=string_metadata, manipulate_after_submit_parameters = True, strings=strings, sbars=sbars, filename=filename, w_sbar=w_sbar, w_string=w_string, new_string_names=new_string_names, z_sbar=z_sbar, fig_dir=fig_dir, validation_issues=validation_issues, **editor_context(corrected_document), **history_context(workspace))
 
 @app.route('/remove_busbar', methods=['POST'])
 def remove_busbar():
@@ -469,18 +671,18 @@ def remove_busbar():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    cell_types = session.get('cell_types', {})
-    new_string_names = session.get('new_string_names', {})
-    sbars = session.get('sbars', [])
-    strings = session.get('strings', [])
-    graph_json = session.get('graph_json', None)
-    w_sbar = session.get('w_sbar', {})
-    w_string = session.get('w_string', {})
-    z_sbar = session.get('z_sbar', {})
-    filename = session.get('filename', None)
-    corrected_component_placements = session.get('corrected_component_placements', None)
-    corrected_component_outlines = session.get('corrected_component_outlines', None)
-    string_metadata = session.get('string_metadata', {})
+    workspace = get_workspace()
+    cell_types = workspace.get('cell_types', {})
+    new_string_names = workspace.get('new_string_names', {})
+    sbars = workspace.get('sbars', [])
+    strings = workspace.get('strings', [])
+    graph_json = workspace.get('graph_json', None)
+    w_sbar = workspace.get('w_sbar', {})
+    w_string = workspace.get('w_string', {})
+    z_sbar = workspace.get('z_sbar', {})
+    filename = workspace.get('filename', None)
+    corrected_document = workspace.get('corrected_document', None)
+    string_metadata = workspace.get('string_metadata', {})
     logging.info("Route: /remove_busbar - Session data retrieved")
 
     # HTML Parsing
@@ -488,33 +690,32 @@ def remove_busbar():
     logging.info(f"Route: /remove_busbar - {sbar_to_delete} to be deleted")
 
     # Data processing
-    del corrected_component_outlines[sbar_to_delete]
-    keys_to_delete = [id for id, placement in corrected_component_placements.items() if placement["name"] == sbar_to_delete]
-    for key in keys_to_delete:
-        del corrected_component_placements[key]
+    corrected_document.remove_outline(sbar_to_delete)
+    corrected_document.remove_placements(corrected_document.rows_named(sbar_to_delete))
     del z_sbar[sbar_to_delete]
     del w_sbar[sbar_to_delete]
     sbars = [sbar for sbar in sbars if sbar != sbar_to_delete]
     logging.info("Route: /remove_busbar - Data processed")
 
-    string_metadata = {}
-    for string in strings:
-        outline = corrected_component_outlines[string]
-        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(outline['coordinates'], cell_types)
-        string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+    # Deleting a busbar leaves every string outline as it was, so the known metadata stays valid
+    string_metadata = known_string_metadata(corrected_document, strings, cell_types, string_metadata)
 
     # Store session data
-    session['corrected_component_placements'] = corrected_component_placements
-    session['corrected_component_outlines'] = corrected_component_outlines
-    session['sbars'] = sbars
-    session['z_sbar'] = z_sbar
-    session['w_sbar'] = w_sbar
-    session['strings'] = strings
-    session['w_string'] = w_string
-    session['string_metadata'] = string_metadata
+    workspace['corrected_document'] = corrected_document
+    workspace['content_is_regenerated'] = False
+    workspace['sbars'] = sbars
+    workspace['z_sbar'] = z_sbar
+    workspace['w_sbar'] = w_sbar
+    workspace['strings'] = strings
+    workspace['w_string'] = w_string
+    workspace['string_metadata'] = string_metadata
+    record_edit(workspace, f'Remove busbar {sbar_to_delete}')
+    if not save_workspace('/remove_busbar'):
+        flash(CONFLICT_MESSAGE)
+        return redirect(url_for('manipulate'))
     logging.info("Route: /remove_busbar - Session data stored")
 
-    return render_template('manipulate.html', string_metadata=string_metadata, manipulate_after_submit_parameters = True, strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, new_string_names=new_string_names, w_sbar=w_sbar, w_string=w_string, z_sbar=z_sbar, fig_dir=fig_dir,corrected_component_placements= corrected_component_placements, corrected_component_outlines=corrected_component_outlines)
+    return render_template('manipulate.html', string_metadata=string_metadata, manipulate_after_submit_parameters = True, strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, new_string_names=new_string_names, w_sbar=w_sbar, w_string=w_string, z_sbar=z_sbar, fig_dir=fig_dir, **editor_context(corrected_document), **history_context(workspace))
 
 @app.route('/remove_string', methods=['POST'])
 def remove_string():
@@ -522,19 +723,19 @@ def remove_string():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    cell_types = session.get('cell_types', {})
-    new_string_names = session.get('new_string_names', {})
-    sbars = session.get('sbars', [])
-    strings = session.get('strings', [])
-    graph_json = session.get('graph_json', None)
-    w_sbar = session.get('w_sbar', {})
-    w_string = session.get('w_string', {})
-    z_sbar = session.get('z_sbar', {})
-    filename = session.get('filename', None)
-    corrected_component_placements = session.get('corrected_component_placements', None)
-    corrected_component_outlines = session.get('corrected_component_outlines', None)
-    w_string_prev = session.get('w_string_prev', {})
-    string_metadata = session.get('string_metadata', {})
+    workspace = get_workspace()
+    cell_types = workspace.get('cell_types', {})
+    new_string_names = workspace.get('new_string_names', {})
+    sbars = workspace.get('sbars', [])
+    strings = workspace.get('strings', [])
+    graph_json = workspace.get('graph_json', None)
+    w_sbar = workspace.get('w_sbar', {})
+    w_string = workspace.get('w_string', {})
+    z_sbar = workspace.get('z_sbar', {})
+    filename = workspace.get('filename', None)
+    corrected_document = workspace.get('corrected_document', None)
+    w_string_prev = workspace.get('w_string_prev', {})
+    string_metadata = workspace.get('string_metadata', {})
     logging.info("Route: /remove_string - Session data retrieved")
 
     # HTML Parsing
@@ -542,59 +743,274 @@ def remove_string():
     logging.info(f"Route: /remove_string - {string_to_delete} to be deleted")
 
     # Data processing
-    count = 0
-    for id, placement in corrected_component_placements.items():
-        if placement['name'] == corrected_component_placements[string_to_delete]['name']:
-            count += 1
-    if count ==1:
-        del corrected_component_outlines[corrected_component_placements[string_to_delete]['name']]
-        strings = [string for string in strings if string != corrected_component_placements[string_to_delete]['name']]
-    del corrected_component_placements[string_to_delete]
+    row = corrected_document.row(string_to_delete)
+    string_name = corrected_document.placement_name(row)
+    if len(corrected_document.rows_named(string_name)) == 1:
+        corrected_document.remove_outline(string_name)
+        strings = [string for string in strings if string != string_name]
+    corrected_document.remove_placements([row])
     del w_string[string_to_delete]
     del w_string_prev[string_to_delete]
     logging.info("Route: /remove_string - Data processed")
 
-    string_metadata = {}
-    for string in strings:
-        outline = corrected_component_outlines[string]
-        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(outline['coordinates'], cell_types)
-        string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+    string_metadata = known_string_metadata(corrected_document, strings, cell_types, string_metadata)
 
     # Store session data
-    session['string_metadata'] = string_metadata
-    session['corrected_component_placements'] = corrected_component_placements
-    session['corrected_component_outlines'] = corrected_component_outlines
-    session['strings'] = strings
-    session['w_string'] = w_string
+    workspace['string_metadata'] = string_metadata
+    workspace['corrected_document'] = corrected_document
+    workspace['content_is_regenerated'] = False
+    workspace['strings'] = strings
+    workspace['w_string'] = w_string
+    record_edit(workspace, f'Remove string {string_to_delete}')
+    if not save_workspace('/remove_string'):
+        flash(CONFLICT_MESSAGE)
+        return redirect(url_for('manipulate'))
     logging.info("Route: /remove_string - Session data stored")
 
-    return render_template('manipulate.html', string_metadata=string_metadata, manipulate_after_submit_parameters = True, strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, new_string_names=new_string_names, w_sbar=w_sbar, w_string=w_string, z_sbar=z_sbar, fig_dir=fig_dir,corrected_component_placements= corrected_component_placements, corrected_component_outlines=corrected_component_outlines)
+    return render_template('manipulate.html', string_metadata=string_metadata, manipulate_after_submit_parameters = True, strings=strings, graph_json=graph_json, sbars=sbars, filename=filename, new_string_names=new_string_names, w_sbar=w_sbar, w_string=w_string, z_sbar=z_sbar, fig_dir=fig_dir, **editor_context(corrected_document), **history_context(workspace))
+
+@app.route('/api/operations', methods=['POST'])
+def api_operations():
+    """
+    Apply a list of edit operations (see parse_idf.apply_operations) and return only the changed components
+    and their IDF records, instead of resubmitting and re-rendering the whole manipulate form.
+    """
+    # Session retrieval
+    workspace = get_workspace()
+    corrected_document = workspace.get('corrected_document', None)
+    if corrected_document is None:
+        return jsonify(error='Please submit a file first.'), 400
+    sbars = workspace.get('sbars', [])
+    strings = workspace.get('strings', [])
+    w_sbar = workspace.get('w_sbar', {})
+    z_sbar = workspace.get('z_sbar', {})
+    w_string = workspace.get('w_string', {})
+    w_sbar_prev = workspace.get('w_sbar_prev', {})
+    w_string_prev = workspace.get('w_string_prev', {})
+    string_metadata = workspace.get('string_metadata', {})
+    cell_types = workspace.get('cell_types', idf.CELL_TYPES)
+    logging.info("Route: /api/operations - Session data retrieved")
+
+    # JSON parsing
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get('operations', [])
+    if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+        return jsonify(error='Expected {"operations": [{"op": ...}, ...]}'), 400
+    logging.info("Route: /api/operations - JSON parsed")
+
+    # Data processing
+    try:
+        changes = idf.apply_operations(corrected_document, operations, w_sbar, z_sbar, w_string, w_sbar_prev, w_string_prev,
+                                       sbars, strings, string_metadata, cell_types)
+        error = None
+    except ValueError as exception:
+        # Operations before the failing one stay applied, so the client should reload its view
+        changes = None
+        error = str(exception)
+    records = idf.changed_records(corrected_document, changes) if changes is not None else None
+    validation_issues, validation_state = validate.validate(corrected_document, workspace.get('validation_state', None))
+    logging.info("Route: /api/operations - Data processed")
+
+    # Store session data, the file content is regenerated from the document on export and preview
+    workspace['corrected_document'] = corrected_document
+    workspace['content_is_regenerated'] = True
+    workspace['sbars'] = sbars
+    workspace['strings'] = strings
+    workspace['w_sbar'] = w_sbar
+    workspace['z_sbar'] = z_sbar
+    workspace['w_string'] = w_string
+    workspace['w_sbar_prev'] = w_sbar_prev
+    workspace['w_string_prev'] = w_string_prev
+    workspace['string_metadata'] = string_metadata
+    workspace['validation_issues'] = validation_issues
+    workspace['validation_state'] = validation_state
+    # Operations that were applied before a failing one are still one step, so they can be undone
+    record_edit(workspace, 'Edit ' + ', '.join(str(operation.get('op')) for operation in operations))
+    if not save_workspace('/api/operations'):
+        return jsonify(error=CONFLICT_MESSAGE), 409
+    logging.info("Route: /api/operations - Session data stored")
+
+    if error is not None:
+        return jsonify(error=error, issues=validation_issues, history=history_context(workspace)['history']), 400
+    records['issues'] = validation_issues
+    records['history'] = history_context(workspace)['history']
+    return jsonify(records)
+
+@app.route('/api/undo', methods=['POST'])
+def api_undo():
+    return history_step('/api/undo', 'undo')
+
+@app.route('/api/redo', methods=['POST'])
+def api_redo():
+    return history_step('/api/redo', 'redo')
+
+@app.route('/api/history')
+def api_history():
+    workspace = get_workspace()
+    if workspace.get('history', None) is None:
+        return jsonify(error='Please submit a file first.'), 400
+    return jsonify(history_context(workspace)['history'])
+
+def history_step(route, direction):
+    """
+    Undo or redo one step of the edit history. Like /api/operations, only the components the step changed
+    are returned, with their IDF records.
+    """
+    # Session retrieval
+    workspace = get_workspace()
+    history = workspace.get('history', None)
+    corrected_document = workspace.get('corrected_document', None)
+    if history is None or corrected_document is None:
+        return jsonify(error='Please submit a file first.'), 400
+    logging.info(f"Route: {route} - Session data retrieved")
+
+    # Data processing
+    original = workspace['document']
+    change = history.undo(corrected_document, original) if direction == 'undo' else history.redo(corrected_document, original)
+    if change is None:
+        return jsonify(error=f'Nothing to {direction}.', history=history.summary()), 400
+    records = idf.changed_records(corrected_document, change.components())
+    validation_issues, validation_state = validate.validate(corrected_document, workspace.get('validation_state', None))
+    logging.info(f"Route: {route} - {'Undid' if direction == 'undo' else 'Redid'} {change.label}")
+
+    # Store session data
+    workspace.update(history.editor_state())
+    workspace['content_is_regenerated'] = True
+    workspace['validation_issues'] = validation_issues
+    workspace['validation_state'] = validation_state
+    if not save_workspace(route):
+        return jsonify(error=CONFLICT_MESSAGE), 409
+    logging.info(f"Route: {route} - Session data stored")
+
+    records['issues'] = validation_issues
+    records['history'] = history.summary()
+    return jsonify(records)
+
+@app.route('/api/placements')
+def api_placements():
+    """
+    One window of the string or busbar placements for the virtualized component editor, e.g.
+    /api/placements?type=string&q=STR01&sort=x&order=desc&offset=100&limit=50
+    """
+    # Session retrieval
+    workspace = get_workspace()
+    corrected_document = workspace.get('corrected_document', None)
+    if corrected_document is None:
+        return jsonify(error='Please submit a file first.'), 400
+    w_string = workspace.get('w_string', {})
+    w_sbar = workspace.get('w_sbar', {})
+
+    # HTML Parsing
+    component_type = request.args.get('type', 'string')
+    sort = request.args.get('sort', 'file')
+    if component_type not in ('string', 'busbar') or sort not in idf.PLACEMENT_SORT_KEYS:
+        return jsonify(error=f"Expected type string or busbar and sort one of {', '.join(idf.PLACEMENT_SORT_KEYS)}"), 400
+    query = request.args.get('q', '').strip()
+    descending = request.args.get('order', 'asc') == 'desc'
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+    # Data processing
+    if component_type == 'string':
+        angles = w_string
+    else:
+        # Busbar angles are set per busbar name
+        angles = {}
+        for row in corrected_document.rows_of_type('busbar').tolist():
+            name = corrected_document.placement_name(row)
+            if name in w_sbar:
+                angles[str(corrected_document.placements['id'][row])] = w_sbar[name]
+    total, rows = idf.placement_window(corrected_document, component_type, angles, query, sort, descending, offset, limit)
+    return jsonify(total=total, offset=offset, limit=limit, rows=rows)
 
 @app.route('/preview_src')
 def preview_src():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    file_content = session.get('file_content', 'No file content found')
-    new_file_content = session.get('new_file_content', file_content)
-    filename = session.get('filename', '')
-    output_filename = f'{os.path.splitext(filename)[0]}_output.IDF'
+    workspace = get_workspace()
+    file_content, new_file_content, filename, output_filename = diff_inputs(workspace)
+    reformatted = request.args.get('reformatted', '0') == '1'
     logging.info("Route: /preview_src - Session data retrieved")
 
-    diff_lines = idf.generate_diff(file_content, new_file_content, filename, output_filename)
-    diff_text = '\n'.join(diff_lines)
-    return render_template('observe.html', section='preview', diff_text=diff_text, fig_dir=fig_dir)
+    # Only the first page of hunks is rendered, the page loads the others from /api/diff
+    diff = idf.diff_page(file_content, new_file_content, filename, output_filename, reformatted=reformatted)
+    diff_text = '\n'.join(diff['lines'])
+    return render_template('observe.html', section='preview', diff_text=diff_text, diff_pages=diff['pages'],
+                           diff_reformatted=diff['reformatted'], reformatted=reformatted, fig_dir=fig_dir)
+
+@app.route('/api/diff')
+def api_diff():
+    """ One page of hunks of the preview diff, see parse_idf.diff_page. """
+    workspace = get_workspace()
+    file_content, new_file_content, filename, output_filename = diff_inputs(workspace)
+    page = max(request.args.get('page', 0, type=int), 0)
+    reformatted = request.args.get('reformatted', '0') == '1'
+    diff = idf.diff_page(file_content, new_file_content, filename, output_filename, page=page, reformatted=reformatted)
+    return jsonify(diff_text='\n'.join(diff['lines']), page=diff['page'], pages=diff['pages'], reformatted=diff['reformatted'])
+
+def diff_inputs(workspace):
+    """ Uploaded and corrected file content of a workspace, with the file names shown in the diff. """
+    file_content = workspace.get('file_content')
+    if file_content is None and 'document' in workspace:
+        # Uploads keep their text as the source of the parsed document
+        file_content = workspace['document'].source_text()
+    if file_content is None:
+        file_content = 'No file content found'
+    if workspace.get('content_is_regenerated'):
+        new_file_content = idf.regenerate_idf_file_content(workspace['corrected_document'])
+    else:
+        new_file_content = workspace.get('new_file_content', file_content)
+    filename = workspace.get('filename', '')
+    return file_content, new_file_content, filename, f'{os.path.splitext(filename)[0]}_output.IDF'
 
 @app.route('/visualize_src')
 def visualize_src():
     fig_dir = url_for('static', filename='img/Soltech_Logo.png')
+    logging.info("Route: /visualize_src - Session data retrieved")
+
+    return render_template('observe.html', section='visualize', graph_json=True, graph_json2=True, fig_dir=fig_dir)
 
+@app.route('/api/figure/<name>')
+def api_figure(name):
+    """
+    Figure of the uploaded or the corrected document. With ?since=<version> of the figure the browser already
+    has, only the trace segments that changed since then are sent (see parse_idf.figure_patch).
+    """
     # Session retrieval
-    graph_json2 = session.get('graph_json2', json.dumps(go.Figure(), cls=plotly.utils.PlotlyJSONEncoder))
-    graph_json = session.get('graph_json', json.dumps(go.Figure(), cls=plotly.utils.PlotlyJSONEncoder))
-    logging.info("Route: /visualize_src - Session data retrieved")
+    workspace = get_workspace()
+    handle = session.get('workspace', '')
+    since = request.args.get('since', None)
+    logging.info(f"Route: /api/figure/{name} - Session data retrieved")
+
+    # The uploaded figure never changes within a workspace
+    if name == 'uploaded':
+        version = f'{handle}-uploaded'
+        if since == version:
+            return jsonify(version=version, patch=[])
+        return figure_response(version, workspace.get('graph_json', None) or figure_json(go.Figure()))
+    if name != 'corrected':
+        return jsonify(error=f'Unknown figure {name}'), 404
+
+    corrected_document = workspace.get('corrected_document', None)
+    if corrected_document is None:
+        return figure_response('', figure_json(go.Figure()))
+    per_component = app.config['PER_COMPONENT_LEGEND']
+    traces = idf.board_traces(corrected_document, per_component)
+    version = workspace.get('figure_version', None)
+    patch = idf.figure_patch(figure_model(workspace), traces) if since is not None and since == version else None
+    if patch == []:
+        return jsonify(version=version, patch=[])
 
-    return render_template('observe.html', section='visualize', graph_json=graph_json, graph_json2=graph_json2, fig_dir=fig_dir)
+    # Data processing
+    version = f'{handle}-{secrets.token_hex(4)}'
+    store_figure_model(workspace, version, traces)
+    if not save_workspace(f'/api/figure/{name}'):
+        return jsonify(error=CONFLICT_MESSAGE), 409
+    logging.info(f"Route: /api/figure/{name} - Data processed")
+    if patch is None:
+        return figure_response(version, figure_json(idf.draw_board(corrected_document, per_component, traces)))
+    return jsonify(version=version, patch=patch)
 
 @app.route('/about_src')
 def about():
@@ -606,27 +1022,225 @@ def about():
 @app.route('/export', methods=['POST'])
 def export():
     print("export")
-    fig_dir = url_for('static', filename='img/Soltech_Logo.png')
 
     # Session retrieval
-    filename = session.get('filename', None)
-    new_lines = session.get('new_file_content', '')
-
+    workspace = get_workspace()
+    filename = workspace.get('filename', None)
 
     # Get the output directory from the form
-    output_file_path = os.path.join(app.config['EXPORT_FOLDER'], f'{os.path.splitext(filename)[0]}_output.IDF')
+    download_name = f'{os.path.splitext(filename)[0]}_output.IDF'
+    output_file_path = os.path.join(app.config['EXPORT_FOLDER'], download_name)
     logging.info("Route: /export - Session data retrieved")
 
-    # Export idf
-    idf.export(filename, output_file_path, new_lines)
-    export_bytes = BytesIO(new_lines.encode('utf-8'))
-    export_bytes.seek(0)
-    logging.info("Route: /export - File exported")
-
-    return send_file(export_bytes,
-                     as_attachment=True,
-                     download_name=f'{os.path.splitext(filename)[0]}_output.IDF',
-                     mimetype='text/plain')
+    # Export idf, the submits/ copy is written from the same chunks that are streamed
+    chunks = idf.export(output_file_path, export_chunks(workspace))
+    mimetype = 'text/plain'
+    if request.form.get('gzip', None) is not None:
+        chunks = idf.gzip_chunks(chunks)
+        download_name += '.gz'
+        mimetype = 'application/gzip'
+    logging.info("Route: /export - File export streamed")
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
+
+@app.route('/export_bundle', methods=['POST'])
+def export_bundle():
+    # Session retrieval
+    handles = session.get('workspaces', [])
+    logging.info("Route: /export_bundle - Session data retrieved")
+
+    workspaces = bundle_snapshots(handles)
+    logging.info(f"Route: /export_bundle - Streaming {len(workspaces)} files")
+    response = Response(stream_with_context(idf.zip_chunks(bundle_files(workspaces))), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename='IDF_export.zip')
+    return response
+
+def bundle_snapshots(handles):
+    """ Copies of the workspaces with a file, so edits while the bundle is built don't change it. """
+    snapshots = []
+    for handle in handles:
+        held = handle in g.get('workspace_locks', {})
+        with contextlib.nullcontext() if held else store.lock(handle):
+            workspace = store.get(handle)
+            if workspace and workspace.get('filename', None) is not None:
+                snapshot = {key: workspace[key] for key in ('filename', 'content_is_regenerated', 'new_file_content') if key in workspace}
+                if workspace.get('content_is_regenerated'):
+                    snapshot['corrected_document'] = workspace['corrected_document'].copy()
+                snapshots.append(snapshot)
+    return snapshots
+
+def bundle_files(workspaces, report=None, total=None):
+    """ Name and export chunks of every workspace with a file, for parse_idf.zip_chunks. """
+    names = set()
+    for i, workspace in enumerate(workspaces):
+        if not workspace or workspace.get('filename', None) is None:
+            continue
+        stem = os.path.splitext(workspace['filename'])[0]
+        name = f'{stem}_output.IDF'
+        counter = 1
+        while name in names:
+            counter += 1
+            name = f'{stem}_output_{counter}.IDF'
+        names.add(name)
+        if report is not None:
+            report(i / total, f'Exporting {name}')
+        output_file_path = os.path.join(app.config['EXPORT_FOLDER'], name)
+        yield name, idf.export(output_file_path, export_chunks(workspace))
+
+# Background jobs
+
+def remember_job(job):
+    """ Jobs are only visible to the session that started them. """
+    session['jobs'] = (session.get('jobs', []) + [job.id])[-50:]
+
+def session_job(id):
+    if id not in session.get('jobs', []):
+        return None
+    return job_queue.get(id)
+
+def parse_job(job, filename, digest, source_path, cell_types):
+    # The upload saved by its hash never changes, a later upload with the same name only replaces the one in uploads/
+    parse_upload(digest, source_path, cell_types, job.report)
+    return {'filename': filename, 'digest': digest, 'path': source_path, 'cell_types': cell_types}
+
+def diff_job(job, file_content, new_file_content, filename, output_filename):
+    job.report(0.1, 'Comparing files')
+    diff_lines = idf.generate_diff(file_content, new_file_content, filename, output_filename)
+    return {'data': {'diff_text': '\n'.join(diff_lines)}}
+
+def batch_job(job, files, recipe):
+    input_folder = os.path.join(job.folder, 'input')
+    output_folder = os.path.join(job.folder, 'output')
+    os.makedirs(input_folder, exist_ok=True)
+    for filename, content in files:
+        with open(os.path.join(input_folder, filename), 'wb') as f:
+            f.write(content)
+
+    def progress(done, total, result):
+        job.report(0.9 * done / total, f"Corrected {result['file']} ({done}/{total})")
+
+    results = batch.run_batch(input_folder, recipe, output_folder, app.config['BATCH_PROCESSES'], progress=progress)
+    job.report(0.9, 'Compressing')
+    outputs = [(os.path.basename(result['output']), result['output']) for result in results if result['ok']]
+    path = os.path.join(job.folder, 'IDF_batch.zip')
+    with open(path, 'wb') as f:
+        for chunk in idf.zip_chunks((name, read_chunks(output)) for name, output in outputs):
+            f.write(chunk)
+    report = [{key: result[key] for key in ('file', 'ok', 'seconds', 'error')} for result in results]
+    return {'data': {'files': report}, 'path': path, 'download_name': 'IDF_batch.zip'}
+
+def export_bundle_job(job, workspaces):
+    path = os.path.join(job.folder, 'IDF_export.zip')
+    with open(path, 'wb') as f:
+        for chunk in idf.zip_chunks(bundle_files(workspaces, job.report, len(workspaces))):
+            f.write(chunk)
+    return {'path': path, 'download_name': 'IDF_export.zip'}
+
+def read_chunks(path, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+@app.route('/api/jobs/submit', methods=['POST'])
+def api_jobs_submit():
+    """ Parse an upload in the background. When the job is done, /submit_job/<id> opens it like /submit does. """
+    upload = save_upload(request.files.get('file'))
+    if upload is None:
+        return jsonify(error='Please upload an .idf file.'), 400
+    filename, digest, source_path = upload
+    job = job_queue.submit('parse', parse_job, filename, digest, source_path, idf.CELL_TYPES)
+    remember_job(job)
+    logging.info(f'Route: /api/jobs/submit - File {filename} queued as job {job.id}')
+    return jsonify(job.status()), 202
+
+@app.route('/submit_job/<id>')
+def submit_job(id):
+    job = session_job(id)
+    if job is None or job.kind != 'parse' or job.state != DONE:
+        flash('The upload is not processed (yet), please submit the file again.')
+        return redirect(url_for('home'))
+    result = job.result
+    workspace = open_workspace(result['digest'])
+    workspace['filename'] = result['filename']
+    logging.info(f"Route: /submit_job - File {result['filename']} opened from job {id}")
+
+    # The job has put the parsed document in the parse cache, which every worker process shares
+    def log_milestone(progress, milestone):
+        if milestone is not None:
+            logging.info(f"Route: /submit_job - {milestone}")
+
+    document, string_metadata, graph_json = parse_upload(result['digest'], result['path'], result['cell_types'], log_milestone)
+    return start_workspace('/submit_job', workspace, document, string_metadata, graph_json, result['cell_types'])
+
+@app.route('/api/jobs/diff', methods=['POST'])
+def api_jobs_diff():
+    """ Diff of the uploaded and the corrected file, computed in the background. """
+    job = job_queue.submit('diff', diff_job, *diff_inputs(get_workspace()))
+    remember_job(job)
+    return jsonify(job.status()), 202
+
+@app.route('/api/jobs/batch', methods=['POST'])
+def api_jobs_batch():
+    """
+    Apply a batch recipe (see batch.py) to the uploaded files in the background. The form has the files as
+    `files` and the recipe as JSON text in `recipe`; the corrected files are downloaded as one zip.
+    """
+    files = [(secure_filename(file.filename), file.read()) for file in request.files.getlist('files') if allowed_file(file.filename)]
+    if not files:
+        return jsonify(error='Please upload at least one .idf file.'), 400
+    try:
+        recipe = json.loads(request.form.get('recipe', '{}'))
+    except ValueError as error:
+        return jsonify(error=f'Invalid recipe: {error}'), 400
+    unknown = set(recipe) - batch.RECIPE_KEYS if isinstance(recipe, dict) else None
+    if unknown is None or unknown:
+        return jsonify(error=f"Unknown recipe keys: {', '.join(sorted(unknown or []))}"), 400
+    job = job_queue.submit('batch', batch_job, files, recipe)
+    remember_job(job)
+    logging.info(f'Route: /api/jobs/batch - {len(files)} files queued as job {job.id}')
+    return jsonify(job.status()), 202
+
+@app.route('/api/jobs/export_bundle', methods=['POST'])
+def api_jobs_export_bundle():
+    """ Build the zip of /export_bundle in the background, from copies of the workspaces (see bundle_snapshots). """
+    workspaces = bundle_snapshots(session.get('workspaces', []))
+    job = job_queue.submit('export_bundle', export_bundle_job, workspaces)
+    remember_job(job)
+    logging.info(f'Route: /api/jobs/export_bundle - {len(workspaces)} files queued as job {job.id}')
+    return jsonify(job.status()), 202
+
+@app.route('/api/jobs/<id>')
+def api_job(id):
+    job = session_job(id)
+    if job is None:
+        return jsonify(error='Unknown job'), 404
+    return jsonify(job.status())
+
+@app.route('/api/jobs/<id>/result')
+def api_job_result(id):
+    job = session_job(id)
+    if job is None:
+        return jsonify(error='Unknown job'), 404
+    if job.state == FAILED:
+        return jsonify(job.status()), 500
+    if job.state != DONE:
+        return jsonify(job.status()), 409
+    result = dict(job.result.get('data', {}))
+    if 'path' in job.result:
+        result['download'] = url_for('api_job_download', id=id)
+    return jsonify(result)
+
+@app.route('/api/jobs/<id>/download')
+def api_job_download(id):
+    job = session_job(id)
+    if job is None or job.state != DONE or 'path' not in job.result:
+        return jsonify(error='No download for this job'), 404
+    return send_file(job.result['path'], as_attachment=True, download_name=job.result['download_name'])
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
@@ -636,20 +1250,13 @@ def request_entity_too_large(error):
 @app.route('/generate_busbar_name', methods=['GET'])
 def generate_busbar_name():    
     print("generate_busbar_name")
-    corrected_component_placements = session.get('corrected_component_placements', {})
-
-    bb_keys = [key for key in corrected_component_placements.keys() if key.startswith('BB')]
-
-    if bb_keys:
-        max_index = max(int(key[2:]) for key in bb_keys)
-    else:
-        max_index = 0
+    workspace = get_workspace()
+    corrected_document = workspace.get('corrected_document', None)
 
     # Generate new busbar name and ID
-    new_index = max_index + 1
-    new_id = f'BB{new_index:03}'
+    new_id = corrected_document.next_id('BB') if corrected_document is not None else 'BB001'
 
-    sbars = session.get('sbars', [])
+    sbars = workspace.get('sbars', [])
     if sbars:
         base_name = sbars[-1].split('_')[0]
     else:
@@ -664,21 +1271,12 @@ def generate_busbar_name():
 @app.route('/generate_string_id', methods=['GET'])
 def generate_string_id():
     print("generate_string_id")
-    corrected_component_placements = session.get('corrected_component_placements', {})
-
-    str_keys = [key for key in corrected_component_placements.keys() if re.match(r'STR\d{3}', key)]
-
-    if not str_keys:
+    workspace = get_workspace()
+    corrected_document = workspace.get('corrected_document', None)
+    if corrected_document is None:
         return jsonify(string_id='STR000')
 
-    # Extract the numeric part and find the maximum
-    max_num = max(int(key[3:]) for key in str_keys)
-
-    # Increment the number and format it back to STR###
-    next_num = max_num + 1
-    next_str_key = f'STR{next_num:03}'
-
-    return jsonify(string_id=next_str_key)
+    return jsonify(string_id=corrected_document.next_id('STR', first=0, min_digits=3))
 
 @app.route('/generate_string_name', methods=['GET'])
 def generate_string_name():
@@ -0,0 +1,142 @@
+import os
+import sys
+import glob
+import fnmatch
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import idf_tool.parse_idf as idf
+from idf_tool.layout import layout_strings
+
+# Example recipe (JSON or YAML), every key is optional:
+# {
+#     "rotate_sbars": {"*": 180},                 # busbar name (or "*") -> angle
+#     "rotate_strings": {"STR001": 180},          # string id (or "*") -> angle
+#     "rename_strings": {"old name": "new name"},
+#     "sbar_height": {"*": true},                 # busbar name (or "*") -> soldering pad under the busbar
+#     "autogenerate": {"offset_x": 10, "offset_y": 10, "offset_between": 5, "strings": ["STR001", "STR002"],
+#                      "layout": "pack", "rotate": false}  # "pack" (default) or "row", rotate: allow 90 degree turns
+# }
+RECIPE_KEYS = {'rotate_sbars', 'rotate_strings', 'rename_strings', 'sbar_height', 'autogenerate'}
+
+def load_recipe(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("YAML recipes need PyYAML (pip install pyyaml), or use a JSON recipe")
+            recipe = yaml.safe_load(f) or {}
+        else:
+            recipe = json.load(f)
+    unknown = set(recipe) - RECIPE_KEYS
+    if unknown:
+        raise SystemExit(f"Unknown recipe keys: {', '.join(sorted(unknown))}")
+    return recipe
+
+def expand(mapping, keys):
+    """ Resolve a recipe mapping with an optional "*" wildcard to a value per key. """
+    values = {key: mapping['*'] for key in keys} if '*' in mapping else {}
+    values.update({key: value for key, value in mapping.items() if key in keys})
+    return values
+
+def apply_recipe(document, recipe):
+    """ Apply a recipe to a document, in the same order as /submit_parameters applies the form. """
+    sbars, strings = idf.get_component_names_by_type(document)
+    string_metadata = {}
+    for string in strings:
+        dist, cell_type, nr_cells, plus, minus = idf.reverse_engineer_string_outline(document.outline(string), idf.CELL_TYPES)
+        string_metadata[string] = {'dist': dist, 'cell_type': cell_type, 'nr_cells': nr_cells, 'plus': plus, 'minus': minus}
+
+    # Rotations are relative to the angles in the file
+    w_sbar_prev = {sbar: [document.placement(document.rows_named(sbar)[0])[3]] for sbar in sbars if len(document.rows_named(sbar))}
+    string_ids = document.placements[document.rows_of_type('string')]['id'].tolist()
+    w_string_prev = {id: [document.placement(document.row(id))[3]] for id in string_ids}
+    w_sbar = expand(recipe.get('rotate_sbars', {}), w_sbar_prev)
+    w_string = expand(recipe.get('rotate_strings', {}), w_string_prev)
+    idf.rotate(document, w_sbar_prev, w_sbar, w_string_prev, w_string, string_metadata, idf.CELL_TYPES)
+
+    rename = recipe.get('rename_strings', {})
+    idf.change_string_names(document, rename, strings)
+    for old_name, new_name in rename.items():
+        if old_name in string_metadata and new_name != '':
+            string_metadata[new_name] = string_metadata.pop(old_name)
+
+    sbars = idf.get_component_names_by_type(document)[0]
+    idf.change_sbar_height(document, {sbar: bool(value) for sbar, value in expand(recipe.get('sbar_height', {}), sbars).items()})
+
+    autogenerate = recipe.get('autogenerate')
+    if autogenerate and autogenerate.get('layout', 'pack') == 'pack':
+        layout_strings(document, ids=autogenerate.get('strings'), margin_x=float(autogenerate['offset_x']),
+                       margin_y=float(autogenerate['offset_y']), spacing=float(autogenerate['offset_between']),
+                       allow_rotation=bool(autogenerate.get('rotate', False)))
+    elif autogenerate:
+        idf.autogenerate_string_coordinates(offset_x=float(autogenerate['offset_x']), offset_y=float(autogenerate['offset_y']),
+                                            offset_between=float(autogenerate['offset_between']), document=document,
+                                            string_metadata=string_metadata, cell_types=idf.CELL_TYPES,
+                                            strings_to_autogenerate=autogenerate.get('strings'))
+    return document
+
+def process_file(file_path, recipe, output_folder):
+    """ Correct one file. Runs in a worker process, so it reports errors instead of raising them. """
+    start = time.perf_counter()
+    filename = os.path.basename(file_path)
+    output_file_path = os.path.join(output_folder, f'{os.path.splitext(filename)[0]}_output.IDF')
+    try:
+        document = apply_recipe(idf.parse_document(file_path), recipe)
+        for _ in idf.export(output_file_path, idf.iter_idf_file_content(document)):
+            pass
+        return {'file': filename, 'output': output_file_path, 'ok': True, 'seconds': time.perf_counter() - start, 'error': None}
+    except Exception as error:
+        return {'file': filename, 'output': None, 'ok': False, 'seconds': time.perf_counter() - start,
+                'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+
+def run_batch(input_folder, recipe, output_folder, workers=None, pattern='*.idf', progress=None):
+    """ Correct every matching file. `progress`, when given, is called as progress(done, total, result) per finished file. """
+    paths = sorted(path for path in glob.glob(os.path.join(input_folder, '*'))
+                   if fnmatch.fnmatch(os.path.basename(path).lower(), pattern.lower()))
+    os.makedirs(output_folder, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_file, path, recipe, output_folder) for path in paths]
+        for future in as_completed(futures):
+            results.append(future.result())
+            if progress is not None:
+                progress(len(results), len(futures), results[-1])
+    return sorted(results, key=lambda result: result['file'])
+
+def print_report(results, total_seconds, out=sys.stdout):
+    width = max([len(result['file']) for result in results] + [4])
+    for result in results:
+        status = 'ok' if result['ok'] else 'ERROR'
+        line = f"{result['file']:<{width}}  {status:<5}  {result['seconds'] * 1000:9.1f} ms"
+        if not result['ok']:
+            line += f"  {result['error']}"
+        print(line, file=out)
+    failed = sum(not result['ok'] for result in results)
+    print(f"{len(results)} files, {len(results) - failed} ok, {failed} failed in {total_seconds:.2f} s", file=out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m idf_tool', description='Headless IDF corrections.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    batch = commands.add_parser('batch', help='Apply an edit recipe to every IDF file in a directory.')
+    batch.add_argument('input_folder', help='Directory with the IDF files, e.g. uploads/')
+    batch.add_argument('recipe', help='JSON or YAML edit recipe')
+    batch.add_argument('-o', '--output-folder', default='submits', help='Where the corrected files are written (default: submits)')
+    batch.add_argument('-w', '--workers', type=int, default=None, help='Worker processes (default: one per CPU)')
+    batch.add_argument('--pattern', default='*.idf', help='File name pattern, case insensitive (default: *.idf)')
+    batch.add_argument('--report', help='Also write the per-file report as JSON to this path')
+    args = parser.parse_args(argv)
+
+    recipe = load_recipe(args.recipe)
+    start = time.perf_counter()
+    results = run_batch(args.input_folder, recipe, args.output_folder, args.workers, args.pattern)
+    total_seconds = time.perf_counter() - start
+    print_report(results, total_seconds)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'seconds': total_seconds, 'files': results}, f, indent=2)
+    return 0 if all(result['ok'] for result in results) else 1
@@ -0,0 +1,615 @@
+import bisect
+import re
+import mmap
+
+import numpy as np
+
+# Component types every document knows about, stored as small integer codes
+STRING = 0
+BUSBAR = 1
+COMPONENT_TYPES = ['string', 'busbar']
+
+# Cached record text that is still the text of the record in the source, see IdfDocument
+SOURCE_TEXT = object()
+
+# Generated ids are a prefix and a zero padded number, e.g. BB001 or STR000
+ID_NUMBER = re.compile(r'([A-Za-z]+)(\d+)$')
+ID_NUMBERS = re.compile(r'^([A-Za-z]+)(\d+)$', re.M)
+
+def map_file(file_path):
+    """ Read-only memory map of a file that isn't empty, which mmap can't map. """
+    with open(file_path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def placement_dtype(id_width=16):
+    return np.dtype([
+        ('id', f'U{id_width}'),
+        ('name', np.int32),
+        ('type', np.int8),
+        ('x', np.float64),
+        ('y', np.float64),
+        ('z', np.float64),
+        ('rotation', np.float64),
+    ])
+
+def group_rows(column, rows):
+    """
+    Dict of value -> ascending list of the rows that hold it.
+
+    :param rows: list(range(len(column))), the lists share its int objects instead of holding their own
+    """
+    order = np.argsort(column, kind='stable')
+    values, starts = np.unique(column[order], return_index=True)
+    return {value: list(map(rows.__getitem__, group.tolist())) for value, group in zip(values.tolist(), np.split(order, starts[1:]))}
+
+class IdfDocument:
+    """
+    Columnar in-memory model of an IDF file.
+
+    Placements live in one structured array (one row per placement, in file order). Component names are
+    interned in `names` and referenced by index. All outline vertices share one float64 buffer; each name
+    owns the slice `vertices[offsets[i, 0]:offsets[i, 1]]`, and `outline_order` keeps the order of the
+    .MECHANICAL blocks.
+
+    `placement_text` (per row) and `outline_text` (per name) cache the rendered IDF records; None marks a
+    record that changed since it was last rendered. Code that writes to the arrays directly must call
+    `touch` or `touch_outline` for the records it changed.
+
+    `source` is the text the document was read from (bytes or a read-only memory map), or None. Copies
+    share it, it is never modified. `source_path` is set when the source maps a file that never changes
+    (an upload saved by its hash): the state of the document then refers to that file instead of holding
+    the bytes. `sections` lists the (keyword, start, stop, outline name) byte ranges of
+    all its sections, including the ones the document doesn't model, and `placement_spans` and
+    `outline_spans` the range of every record. A record whose cached text is SOURCE_TEXT is unchanged and
+    is written back as its range of the source.
+
+    Every change is also noted in a journal: the ids and outline names that were touched, and the placements and
+    outlines that were added or removed, in order, with their values at that moment. `take_changes` hands it over
+    to the edit history (see history.py), which only stores those records.
+
+    Lookups by id, name and type go through indexes (id -> row, name -> rows, type -> rows and the highest
+    number per id prefix and digit count) that every placement method keeps up to date, so lookups don't
+    scan the array. The indexes are derived from the placements and are not part of the state.
+    """
+    __slots__ = ('header', 'board_outline', 'types', 'names', 'placements', 'outline_types', 'heights',
+                 'offsets', 'outline_order', 'vertices', 'vertex_count', 'placement_text', 'outline_text',
+                 'source', 'source_path', 'sections', 'placement_spans', 'outline_spans', '_changed_ids', '_changed_names', '_events',
+                 '_name_index', '_id_index', '_name_rows', '_type_rows', '_id_numbers')
+
+    def __init__(self, header='', board_outline=None):
+        self.header = header
+        self.board_outline = np.empty((0, 3)) if board_outline is None else board_outline
+        self.types = list(COMPONENT_TYPES)
+        self.names = []
+        self.placements = np.empty(0, dtype=placement_dtype())
+        self.outline_types = np.empty(0, dtype=np.int8)
+        self.heights = []
+        self.offsets = np.empty((0, 2), dtype=np.int64)
+        self.outline_order = []
+        self.vertices = np.empty((0, 3))
+        self.vertex_count = 0
+        self.placement_text = []
+        self.outline_text = []
+        self.source = None
+        self.source_path = None
+        self.sections = None
+        self.placement_spans = np.empty((0, 2), dtype=np.int64)
+        self.outline_spans = np.empty((0, 2), dtype=np.int64)
+        self._changed_ids = set()
+        self._changed_names = set()
+        self._events = []
+        self._name_index = {}
+        self._id_index = {}
+        self._name_rows = {}
+        self._type_rows = {}
+        self._id_numbers = {}
+
+    @classmethod
+    def build(cls, header, board_outline, placements, outlines):
+        """
+        Build a document from parsed records.
+
+        :param placements: Dict of component id -> (name, component_type, [x, y, z, rotation])
+        :param outlines: Dict of component name -> (component_type, height, list of [x, y, z])
+        """
+        coordinates = np.array([placement if placement else [np.nan] * 4 for _, _, placement in placements.values()],
+                               dtype=np.float64).reshape(-1, 4)
+        vertices = np.array([point for _, _, points in outlines.values() for point in points], dtype=np.float64).reshape(-1, 3)
+        return cls.from_columns(header, board_outline, list(placements), [name for name, _, _ in placements.values()],
+                                [component_type for _, component_type, _ in placements.values()], coordinates,
+                                list(outlines), [component_type for component_type, _, _ in outlines.values()],
+                                [height for _, height, _ in outlines.values()], vertices,
+                                [len(points) for _, _, points in outlines.values()])
+
+    @classmethod
+    def from_columns(cls, header, board_outline, ids, names, types, coordinates, outline_names, outline_types, heights,
+                     vertices, counts, source=None, sections=None, placement_spans=None, outline_spans=None):
+        """
+        Build a document from parsed columns, one entry per placement and per outline, in file order.
+
+        :param ids: Sequence or NumPy str array of the placement ids
+
+        :param coordinates: (placements, 4) array of x, y, z and rotation, NaN for a placement without them
+        :param vertices: (vertices, 3) array of all outline vertices, outline after outline
+        :param counts: Number of vertices of every outline
+        :param placement_spans: (placements, 2) array with the byte range of every placement in `source`, -1 for none
+        :param outline_spans: The same for every outline
+        """
+        document = cls(header, board_outline)
+        document.source = source
+        document.sections = sections
+        for name in list(outline_names) + list(names):
+            if name not in document._name_index:
+                document._name_index[name] = len(document.names)
+                document.names.append(name)
+        document.outline_types = np.full(len(document.names), -1, dtype=np.int8)
+        document.heights = [None] * len(document.names)
+        document.offsets = np.zeros((len(document.names), 2), dtype=np.int64)
+        document.outline_text = [None] * len(document.names)
+        document.outline_spans = np.full((len(document.names), 2), -1, dtype=np.int64)
+
+        ids = np.asarray(ids, dtype=str)
+        rows = np.empty(len(ids), dtype=placement_dtype(max(16, ids.dtype.itemsize // 4)))
+        rows['id'] = ids
+        rows['name'] = [document._name_index[name] for name in names]
+        type_codes = {component_type: document.type_index(component_type) for component_type in dict.fromkeys(types)}
+        rows['type'] = [type_codes[component_type] for component_type in types]
+        for column, i in (('x', 0), ('y', 1), ('z', 2), ('rotation', 3)):
+            rows[column] = coordinates[:, i]
+        document.placements = rows
+        document.placement_spans = np.full((len(rows), 2), -1, dtype=np.int64) if placement_spans is None else np.asarray(placement_spans, dtype=np.int64)
+        document.placement_text = [SOURCE_TEXT if start >= 0 else None for start in document.placement_spans[:, 0].tolist()]
+        document._reindex()
+
+        counts = np.asarray(counts, dtype=np.int64)
+        stops = np.cumsum(counts)
+        document.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        document.vertex_count = len(document.vertices)
+        for name, component_type, height, start, stop in zip(outline_names, outline_types, heights, stops - counts, stops):
+            index = document._name_index[name]
+            document.outline_types[index] = document.type_index(component_type)
+            document.heights[index] = height
+            document.offsets[index] = (start, stop)
+            document.outline_order.append(index)
+        if outline_spans is not None:
+            for name, span in zip(outline_names, np.asarray(outline_spans, dtype=np.int64).tolist()):
+                index = document._name_index[name]
+                document.outline_spans[index] = span
+                if span[0] >= 0:
+                    document.outline_text[index] = SOURCE_TEXT
+        return document
+
+    def copy(self):
+        document = IdfDocument(self.header, self.board_outline.copy())
+        document.types = list(self.types)
+        document.names = list(self.names)
+        document.placements = self.placements.copy()
+        document.outline_types = self.outline_types.copy()
+        document.heights = list(self.heights)
+        document.offsets = self.offsets.copy()
+        document.outline_order = list(self.outline_order)
+        document.vertices = self.vertices[:self.vertex_count].copy()
+        document.vertex_count = self.vertex_count
+        document.placement_text = list(self.placement_text)
+        document.outline_text = list(self.outline_text)
+        document.source = self.source
+        document.source_path = self.source_path
+        document.sections = self.sections
+        document.placement_spans = self.placement_spans.copy()
+        document.outline_spans = self.outline_spans.copy()
+        document._name_index = dict(self._name_index)
+        document._id_index = dict(self._id_index)
+        document._name_rows = {name: list(rows) for name, rows in self._name_rows.items()}
+        document._type_rows = {component_type: list(rows) for component_type, rows in self._type_rows.items()}
+        document._id_numbers = {prefix: dict(numbers) for prefix, numbers in self._id_numbers.items()}
+        return document
+
+    def nbytes(self):
+        arrays = (self.board_outline, self.placements, self.outline_types, self.offsets, self.vertices, self.placement_spans,
+                  self.outline_spans)
+        # A mapped file is in the page cache, not in the memory of the process
+        source = len(self.source) if self.source is not None and self.source_path is None else 0
+        return sum(array.nbytes for array in arrays) + len(self.header) + sum(len(name) for name in self.names) + source
+
+    def source_text(self):
+        """ The text the document was read from, or None. """
+        if self.source is None:
+            return None
+        return bytes(self.source).decode('utf-8')
+
+    def state(self):
+        """ Split the document into NumPy arrays and JSON serializable fields, e.g. to store it in an .npz file. """
+        arrays = {
+            'board_outline': self.board_outline,
+            'placements': self.placements,
+            'outline_types': self.outline_types,
+            'offsets': self.offsets,
+            'vertices': self.vertices[:self.vertex_count],
+        }
+        if self.source is not None and self.source_path is None:
+            arrays['source'] = np.frombuffer(self.source, dtype=np.uint8)
+        if self.sections is not None:
+            # The record caches are not stored, only the ranges of the records that are still unchanged
+            unchanged = np.array([text is SOURCE_TEXT for text in self.placement_text], dtype=bool)
+            arrays['placement_spans'] = np.where(unchanged[:, None], self.placement_spans, -1)
+            unchanged = np.array([text is SOURCE_TEXT for text in self.outline_text], dtype=bool)
+            arrays['outline_spans'] = np.where(unchanged[:, None], self.outline_spans, -1)
+        fields = {
+            'header': self.header,
+            'types': self.types,
+            'names': self.names,
+            'heights': self.heights,
+            'outline_order': self.outline_order,
+            'sections': self.sections,
+        }
+        if self.source_path is not None:
+            fields['source_path'] = self.source_path
+        return arrays, fields
+
+    @classmethod
+    def from_state(cls, arrays, fields):
+        document = cls(fields['header'], np.array(arrays['board_outline']))
+        document.types = list(fields['types'])
+        document.names = list(fields['names'])
+        document.placements = np.array(arrays['placements'])
+        document.outline_types = np.array(arrays['outline_types'])
+        document.heights = list(fields['heights'])
+        document.offsets = np.array(arrays['offsets'])
+        document.outline_order = list(fields['outline_order'])
+        document.vertices = np.array(arrays['vertices'])
+        document.vertex_count = len(document.vertices)
+        document.placement_text = [None] * len(document.placements)
+        document.outline_text = [None] * len(document.names)
+        source = arrays.get('source')
+        document.source = source.tobytes() if isinstance(source, np.ndarray) else source
+        document.source_path = fields.get('source_path')
+        if document.source_path is not None and document.source is None:
+            document.source = map_file(document.source_path)
+        document.sections = fields.get('sections')
+        if document.sections is not None:
+            document.placement_spans = np.array(arrays['placement_spans'])
+            document.outline_spans = np.array(arrays['outline_spans'])
+            document.placement_text = [SOURCE_TEXT if start >= 0 else None for start in document.placement_spans[:, 0].tolist()]
+            document.outline_text = [SOURCE_TEXT if start >= 0 else None for start in document.outline_spans[:, 0].tolist()]
+        else:
+            document.placement_spans = np.full((len(document.placements), 2), -1, dtype=np.int64)
+            document.outline_spans = np.full((len(document.names), 2), -1, dtype=np.int64)
+        document._name_index = {name: index for index, name in enumerate(document.names)}
+        document._reindex()
+        return document
+
+    # Journal
+
+    def take_changes(self):
+        """
+        Hand over and clear the journal.
+
+        :return: The touched placement ids, the touched outline names and the list of structural events:
+                 ('add', id, values), ('remove', rows, [(id, values), ...]), ('add_outline', position, name, values)
+                 and ('remove_outline', position, name, values), with values as returned by `placement_values` and
+                 `outline_values`
+        """
+        changes = self._changed_ids, self._changed_names, self._events
+        self._changed_ids, self._changed_names, self._events = set(), set(), []
+        return changes
+
+    def placement_values(self, row):
+        """ (name, component type, x, y, z, rotation) of a placement. """
+        _, name, component_type, x, y, z, rotation = self.placements[row].item()
+        return (self.names[name], self.types[component_type], x, y, z, rotation)
+
+    def outline_values(self, name):
+        """ (component type, height, vertices) of an outline, with a read-only copy of the vertices. """
+        coordinates = self.outline(name).copy()
+        coordinates.setflags(write=False)
+        return (self.outline_type(name), self.outline_height(name), coordinates)
+
+    # Interning
+
+    def name_index(self, name):
+        index = self._name_index.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self._name_index[name] = index
+            self.outline_types = np.append(self.outline_types, np.int8(-1))
+            self.heights.append(None)
+            self.offsets = np.vstack([self.offsets, np.zeros((1, 2), dtype=np.int64)])
+            self.outline_spans = np.vstack([self.outline_spans, np.full((1, 2), -1, dtype=np.int64)])
+            self.outline_text.append(None)
+        return index
+
+    def type_index(self, component_type):
+        if component_type not in self.types:
+            self.types.append(component_type)
+        return self.types.index(component_type)
+
+    # Indexes
+
+    def _reindex(self):
+        """ Rebuild the placement indexes from the placements array. """
+        ids = self.placements['id'].tolist()
+        rows = list(range(len(ids)))
+        self._id_index = dict(zip(ids, rows))
+        self._name_rows = group_rows(self.placements['name'], rows)
+        self._type_rows = group_rows(self.placements['type'], rows)
+        self._id_numbers = {}
+        for prefix, digits in map(re.Match.groups, ID_NUMBERS.finditer('\n'.join(ids))):
+            numbers = self._id_numbers.setdefault(prefix, {})
+            numbers[len(digits)] = max(numbers.get(len(digits), 0), int(digits))
+
+    def _count_id(self, id):
+        match = ID_NUMBER.match(id)
+        if match is not None:
+            prefix, digits = match.groups()
+            numbers = self._id_numbers.setdefault(prefix, {})
+            numbers[len(digits)] = max(numbers.get(len(digits), 0), int(digits))
+
+    def _move_row(self, index, row, old, new):
+        if old == new:
+            return
+        if old is not None:
+            rows = index[old]
+            del rows[bisect.bisect_left(rows, row)]
+            if not rows:
+                del index[old]
+        bisect.insort(index.setdefault(new, []), row)
+
+    def next_id(self, prefix, first=1, min_digits=1):
+        """
+        Id after the highest one made of `prefix` and at least `min_digits` digits, e.g. BB008 after BB007, or
+        `first` without such ids.
+        """
+        numbers = [number for width, number in self._id_numbers.get(prefix, {}).items() if width >= min_digits]
+        return f'{prefix}{max(numbers) + 1 if numbers else first:03}'
+
+    # Placements
+
+    def __len__(self):
+        return len(self.placements)
+
+    def __contains__(self, id):
+        return id in self._id_index
+
+    def ids(self):
+        return self.placements['id'].tolist()
+
+    def row(self, id):
+        return self._id_index[id]
+
+    def rows_of_type(self, component_type):
+        return np.array(self._type_rows.get(self.type_index(component_type), ()), dtype=np.intp)
+
+    def rows_named(self, name):
+        return np.array(self._name_rows.get(self._name_index.get(name), ()), dtype=np.intp)
+
+    def placement_name(self, row):
+        return self.names[self.placements['name'][row]]
+
+    def placement_type(self, row):
+        return self.types[self.placements['type'][row]]
+
+    def placement(self, row):
+        return self.placements[['x', 'y', 'z', 'rotation']][row].tolist()
+
+    def touch(self, rows):
+        """ Mark placements as changed, so they get rendered again. """
+        rows = np.atleast_1d(rows)
+        for row in rows.tolist():
+            self.placement_text[row] = None
+        self._changed_ids.update(self.placements['id'][rows].tolist())
+
+    def add_placement(self, id, name, component_type, placement):
+        name_index = self.name_index(name)
+        type_index = self.type_index(component_type)
+        if id in self._id_index:
+            row = self._id_index[id]
+            old_name, old_type = self.placements[['name', 'type']][row].item()
+        else:
+            if len(id) > self.placements.dtype['id'].itemsize // 4:
+                self.placements = self.placements.astype(placement_dtype(len(id)))
+            row = len(self.placements)
+            self.placements = np.append(self.placements, np.zeros(1, dtype=self.placements.dtype))
+            self.placement_spans = np.vstack([self.placement_spans, np.full((1, 2), -1, dtype=np.int64)])
+            self.placement_text.append(None)
+            self._id_index[id] = row
+            self._count_id(id)
+            self._events.append(('add', id, (name, component_type, *map(float, placement))))
+            old_name = old_type = None
+        self._move_row(self._name_rows, row, old_name, name_index)
+        self._move_row(self._type_rows, row, old_type, type_index)
+        record = self.placements[row]
+        record['id'] = id
+        record['name'] = name_index
+        record['type'] = type_index
+        record['x'], record['y'], record['z'], record['rotation'] = placement
+        self.placement_text[row] = None
+        self._changed_ids.add(id)
+        return row
+
+    def insert_placements(self, rows, records):
+        """
+        Put removed placements back, the inverse of `remove_placements`.
+
+        :param rows: Ascending rows the placements had before they were removed
+        :param records: (id, values) of every placement, values as returned by `placement_values`
+        """
+        ids = [id for id, _ in records]
+        width = max([self.placements.dtype['id'].itemsize // 4] + [len(id) for id in ids])
+        if width > self.placements.dtype['id'].itemsize // 4:
+            self.placements = self.placements.astype(placement_dtype(width))
+        inserted = np.zeros(len(records), dtype=self.placements.dtype)
+        inserted['id'] = ids
+        inserted['name'] = [self.name_index(values[0]) for _, values in records]
+        inserted['type'] = [self.type_index(values[1]) for _, values in records]
+        for column, i in (('x', 2), ('y', 3), ('z', 4), ('rotation', 5)):
+            inserted[column] = [values[i] for _, values in records]
+        # np.insert positions refer to the array before the insert
+        positions = np.asarray(rows, dtype=np.intp) - np.arange(len(rows))
+        self.placements = np.insert(self.placements, positions, inserted)
+        self.placement_spans = np.insert(self.placement_spans, positions, -1, axis=0)
+        for row in rows:
+            self.placement_text.insert(row, None)
+        self._changed_ids.update(ids)
+        self._reindex()
+
+    def remove_placements(self, rows):
+        rows = np.unique(np.atleast_1d(np.asarray(rows, dtype=np.intp)))
+        records = [(id, self.placement_values(row)) for id, row in zip(self.placements['id'][rows].tolist(), rows.tolist())]
+        self._events.append(('remove', rows.tolist(), records))
+        self._changed_ids.update(id for id, _ in records)
+        self.placements = np.delete(self.placements, rows)
+        self.placement_spans = np.delete(self.placement_spans, rows, axis=0)
+        removed = set(rows.tolist())
+        self.placement_text = [text for row, text in enumerate(self.placement_text) if row not in removed]
+        # Rows after the removed ones shift, so the indexes are rebuilt
+        self._reindex()
+
+    def rename_placements(self, rows, name):
+        name_index = self.name_index(name)
+        rows = np.atleast_1d(rows)
+        renamed = rows[self.placements['name'][rows] != name_index]
+        for row, old_name in zip(renamed.tolist(), self.placements['name'][renamed].tolist()):
+            self._move_row(self._name_rows, row, old_name, name_index)
+        self.touch(renamed)
+        self.placements['name'][rows] = name_index
+
+    # Outlines
+
+    def has_outline(self, name):
+        index = self._name_index.get(name)
+        return index is not None and self.outline_types[index] >= 0
+
+    def outline_names(self, component_type=None):
+        names = [self.names[index] for index in self.outline_order]
+        if component_type is None:
+            return names
+        type_index = self.type_index(component_type)
+        return [self.names[index] for index in self.outline_order if self.outline_types[index] == type_index]
+
+    def outline_type(self, name):
+        return self.types[self.outline_types[self._name_index[name]]]
+
+    def outline_height(self, name):
+        return self.heights[self._name_index[name]]
+
+    def set_outline_height(self, name, height):
+        name_index = self._name_index[name]
+        if self.heights[name_index] != height:
+            self.heights[name_index] = height
+            self.outline_text[name_index] = None
+            self._changed_names.add(name)
+
+    def touch_outline(self, name):
+        """ Mark an outline as changed, so it gets rendered again. """
+        self.outline_text[self._name_index[name]] = None
+        self._changed_names.add(name)
+
+    def outline(self, name):
+        """ Writable view of the vertices of an outline. """
+        if not self.has_outline(name):
+            raise KeyError(name)
+        start, stop = self.offsets[self._name_index[name]]
+        return self.vertices[start:stop]
+
+    def set_outline(self, name, component_type, height, coordinates, index=None):
+        """
+        Add or replace an outline. New outlines are inserted at position `index` of the outline order
+        (appended when `index` is None); replaced outlines keep their position.
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+        exists = self.has_outline(name)
+        name_index = self.name_index(name)
+        type_index = self.type_index(component_type)
+        # Removed outlines keep their vertices until the buffer is compacted, so setting the same outline
+        # again (e.g. regenerating an unchanged string) keeps the rendered text
+        start, stop = self.offsets[name_index]
+        unchanged = (self.outline_text[name_index] is not None and self.outline_types[name_index] in (-1, type_index)
+                     and self.heights[name_index] == height and np.array_equal(self.vertices[start:stop], coordinates))
+        if not unchanged:
+            self._release(name_index)
+            start = self._reserve(len(coordinates))
+            self.vertices[start:start + len(coordinates)] = coordinates
+            self.offsets[name_index] = (start, start + len(coordinates))
+            self.outline_text[name_index] = None
+        self.outline_types[name_index] = type_index
+        self.heights[name_index] = height
+        self._changed_names.add(name)
+        if not exists:
+            if index is None or index >= len(self.outline_order):
+                index = len(self.outline_order)
+            self.outline_order.insert(index, name_index)
+            if not coordinates.flags.writeable:
+                values = (component_type, height, coordinates)
+            else:
+                values = self.outline_values(name)
+            self._events.append(('add_outline', index, name, values))
+
+    def remove_outline(self, name):
+        if not self.has_outline(name):
+            raise KeyError(name)
+        name_index = self._name_index[name]
+        self._events.append(('remove_outline', self.outline_order.index(name_index), name, self.outline_values(name)))
+        self._changed_names.add(name)
+        self.outline_types[name_index] = -1
+        self.outline_order.remove(name_index)
+
+    def rename_outline(self, name, new_name):
+        """ Move an outline to a new name. Like a dict pop/insert, a new name ends up last in the outline order. """
+        name_index = self._name_index[name]
+        coordinates = self.outline(name).copy()
+        component_type = self.outline_type(name)
+        height = self.heights[name_index]
+        self.remove_outline(name)
+        self._release(name_index)
+        self.set_outline(new_name, component_type, height, coordinates)
+
+    def _reserve(self, count):
+        if self.vertex_count + count > len(self.vertices):
+            self._compact()
+        if self.vertex_count + count > len(self.vertices):
+            capacity = max(2 * len(self.vertices), self.vertex_count + count, 64)
+            vertices = np.empty((capacity, 3))
+            vertices[:self.vertex_count] = self.vertices[:self.vertex_count]
+            self.vertices = vertices
+        start = self.vertex_count
+        self.vertex_count += count
+        return start
+
+    def _release(self, name_index):
+        self.offsets[name_index] = (0, 0)
+        self.outline_text[name_index] = None
+
+    def _compact(self):
+        """ Drop vertices that no outline refers to anymore. """
+        live = [index for index in self.outline_order if self.outline_types[index] >= 0]
+        for index in set(range(len(self.names))) - set(live):
+            self._release(index)
+        used = int(sum(self.offsets[index, 1] - self.offsets[index, 0] for index in live))
+        if used == self.vertex_count:
+            return
+        vertices = np.empty_like(self.vertices)
+        position = 0
+        for index in live:
+            start, stop = self.offsets[index]
+            vertices[position:position + stop - start] = self.vertices[start:stop]
+            self.offsets[index] = (position, position + stop - start)
+            position += stop - start
+        self.vertices = vertices
+        self.vertex_count = position
+
+    # Dict views, used by the templates
+
+    def component_placements(self):
+        placements = {}
+        for id, name, component_type, x, y, z, rotation in self.placements.tolist():
+            placements[id] = {'name': self.names[name], 'component_type': self.types[component_type], 'placement': [x, y, z, rotation]}
+        return placements
+
+    def component_outlines(self):
+        outlines = {}
+        for index in self.outline_order:
+            start, stop = self.offsets[index]
+            coordinates = self.vertices[start:stop].copy() if stop > start else []
+            outlines[self.names[index]] = {'component_type': self.types[self.outline_types[index]], 'height': self.heights[index], 'coordinates': coordinates}
+        return outlines
@@ -0,0 +1,415 @@
+import bisect
+
+import numpy as np
+
+from idf_tool.document import SOURCE_TEXT
+
+# Workspace values of the component editor, restored together with the corrected document
+EDITOR_FIELDS = ('sbars', 'strings', 'w_sbar', 'z_sbar', 'w_string', 'w_sbar_prev', 'w_string_prev', 'string_metadata')
+
+# Key that is not in an editor dict
+MISSING = object()
+
+def detach(value):
+    """ Copy of an editor value that shares no list or dict with the workspace, e.g. the w_sbar_prev lists. """
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+def same(a, b):
+    # NaN coordinates and angles of placements without a position count as unchanged
+    return a == b or (isinstance(a, float) and isinstance(b, float) and a != a and b != b)
+
+def same_placement(a, b):
+    if a is None or b is None:
+        return a is b
+    return a[:2] == b[:2] and all(same(x, y) for x, y in zip(a[2:], b[2:]))
+
+def same_outline(a, b):
+    if a is None or b is None:
+        return a is b
+    return a[:2] == b[:2] and np.array_equal(a[2], b[2])
+
+def original_outline(original, name):
+    """ Outline values of the uploaded document, sharing its vertices through a read-only view. """
+    if not original.has_outline(name):
+        return None
+    coordinates = original.outline(name).view()
+    coordinates.setflags(write=False)
+    return (original.outline_type(name), original.outline_height(name), coordinates)
+
+def reuse_source_text(document, original, ids, names):
+    """
+    Mark placements and outlines that are back at their uploaded values as unchanged again, so they are
+    written as their text in the source, like before they were edited.
+    """
+    if document.source is None or document.source is not original.source:
+        return
+    for id in ids:
+        if id in document and id in original:
+            row, original_row = document.row(id), original.row(id)
+            if (original.placement_text[original_row] is SOURCE_TEXT
+                    and same_placement(document.placement_values(row), original.placement_values(original_row))):
+                document.placement_text[row] = SOURCE_TEXT
+                document.placement_spans[row] = original.placement_spans[original_row]
+    for name in names:
+        if document.has_outline(name) and original.has_outline(name):
+            index, original_index = document.name_index(name), original.name_index(name)
+            if (original.outline_text[original_index] is SOURCE_TEXT
+                    and same_outline(document.outline_values(name), original_outline(original, name))):
+                document.outline_text[index] = SOURCE_TEXT
+                document.outline_spans[index] = original.outline_spans[original_index]
+
+def pack_vertices(vertices):
+    """ One array with the outline vertices of a list of arrays, with the offset and length of each. """
+    counts = np.array([len(array) for array in vertices], dtype=np.int64)
+    return {
+        'vertices': np.concatenate(vertices) if vertices else np.empty((0, 3)),
+        'offsets': np.cumsum(counts) - counts,
+        'counts': counts,
+    }
+
+def unpack_vertices(arrays):
+    """ Inverse of pack_vertices, as read-only views of one array. """
+    all_vertices = np.array(arrays['vertices'])
+    vertices = []
+    for offset, count in zip(np.asarray(arrays['offsets']).tolist(), np.asarray(arrays['counts']).tolist()):
+        coordinates = all_vertices[offset:offset + count]
+        coordinates.setflags(write=False)
+        vertices.append(coordinates)
+    return vertices
+
+class Change:
+    """
+    One step of the edit history: the placements (by id) and outlines (by name) that differ, each as a
+    (before, after) pair of values or None where it doesn't exist, the structural events of the document journal
+    (see IdfDocument.take_changes) and the changed editor values.
+    """
+    __slots__ = ('label', 'placements', 'outlines', 'events', 'editor')
+
+    def __init__(self, label, placements, outlines, events, editor):
+        self.label = label
+        self.placements = placements
+        self.outlines = outlines
+        self.events = events
+        self.editor = editor
+
+    def state(self, vertices, refs):
+        """
+        JSON serializable fields of the step. Outline vertices are appended to `vertices` and referred to by
+        index; `refs` maps the id of every array in `vertices` to its index, so steps that share an array write
+        it once. Steps never change once recorded.
+        """
+        def pack(values):
+            if values is None:
+                return None
+            if id(values[2]) not in refs:
+                refs[id(values[2])] = len(vertices)
+                vertices.append(values[2])
+            return [values[0], values[1], refs[id(values[2])]]
+
+        events = []
+        for event in self.events:
+            if event[0] in ('add_outline', 'remove_outline'):
+                events.append([event[0], event[1], event[2], pack(event[3])])
+            else:
+                events.append(list(event))
+        return {
+            'label': self.label,
+            'placements': self.placements,
+            'outlines': {name: [pack(before), pack(after)] for name, (before, after) in self.outlines.items()},
+            'events': events,
+            'editor': self.editor,
+        }
+
+    @classmethod
+    def from_state(cls, fields, vertices):
+        """ Inverse of state, with the outline vertices as a list of arrays (see unpack_vertices). """
+        def unpack(values):
+            return None if values is None else (values[0], values[1], vertices[values[2]])
+
+        def placement(values):
+            return None if values is None else tuple(values)
+
+        events = []
+        for event in fields['events']:
+            if event[0] == 'add':
+                events.append(('add', event[1], placement(event[2])))
+            elif event[0] == 'remove':
+                events.append(('remove', event[1], [(id, placement(values)) for id, values in event[2]]))
+            else:
+                events.append((event[0], event[1], event[2], unpack(event[3])))
+        editor = {}
+        for field, (before, after) in fields['editor'].items():
+            # Dict fields store the changed keys only
+            if isinstance(after, dict):
+                editor[field] = ({key: detach(item) for key, item in before.items()}, {key: detach(item) for key, item in after.items()})
+            else:
+                editor[field] = (detach(before), detach(after))
+        return cls(
+            fields['label'],
+            {id: (placement(before), placement(after)) for id, (before, after) in fields['placements'].items()},
+            {name: (unpack(before), unpack(after)) for name, (before, after) in fields['outlines'].items()},
+            events,
+            editor,
+        )
+
+    def components(self):
+        """ Ids and names of the components this change touches, in the format of parse_idf.changed_records. """
+        changes = {'placements': set(self.placements), 'outlines': set(self.outlines)}
+        for event in self.events:
+            if event[0] == 'add':
+                changes['placements'].add(event[1])
+            elif event[0] == 'remove':
+                changes['placements'].update(id for id, _ in event[2])
+            else:
+                changes['outlines'].add(event[2])
+        return changes
+
+class EditHistory:
+    """
+    Undo/redo history of the corrected document of a workspace.
+
+    Every commit stores only the components the request changed, so a step costs memory in proportion to
+    the edit, not to the document. The value a component had before a step is the value it got in the latest
+    earlier step that changed it, or its value in the uploaded document, which is never modified and is the
+    baseline of the history. Consecutive steps share those values instead of copying them.
+
+    The editor values in EDITOR_FIELDS are tracked per key the same way; `editor` holds them as of the current
+    step.
+    """
+
+    def __init__(self, editor):
+        self.changes = []
+        self.position = 0
+        self.editor = {field: self._detach_field(editor[field]) for field in EDITOR_FIELDS if field in editor}
+        self._placement_steps = {}
+        self._outline_steps = {}
+
+    @staticmethod
+    def _detach_field(value):
+        if isinstance(value, dict):
+            return {key: detach(item) for key, item in value.items()}
+        return detach(value)
+
+    def summary(self):
+        return {
+            'position': self.position,
+            'steps': len(self.changes),
+            'can_undo': self.position > 0,
+            'can_redo': self.position < len(self.changes),
+            'undo': self.changes[self.position - 1].label if self.position > 0 else None,
+            'redo': self.changes[self.position].label if self.position < len(self.changes) else None,
+        }
+
+    def editor_state(self):
+        """ Fresh copies of the editor values of the current step, to put back in the workspace. """
+        return {field: {key: detach(item) for key, item in value.items()} if isinstance(value, dict) else detach(value)
+                for field, value in self.editor.items()}
+
+    # Recording
+
+    def _latest(self, steps, key):
+        # Latest step before the current position that changed `key`, or None
+        indexes = steps.get(key)
+        if not indexes:
+            return None
+        i = bisect.bisect_left(indexes, self.position) - 1
+        return indexes[i] if i >= 0 else None
+
+    def _placement_before(self, id, original):
+        step = self._latest(self._placement_steps, id)
+        if step is not None:
+            return self.changes[step].placements[id][1]
+        return original.placement_values(original.row(id)) if id in original else None
+
+    def _outline_before(self, name, original):
+        step = self._latest(self._outline_steps, name)
+        if step is not None:
+            return self.changes[step].outlines[name][1]
+        return original_outline(original, name)
+
+    def commit(self, document, original, editor, label):
+        """
+        Record the changes in the journal of `document` since the last commit as a new step. Steps that were
+        undone are dropped. Nothing is recorded when the request didn't change anything.
+
+        :param original: The uploaded document, `document` as it was before the first step
+        :param editor: The workspace, with the editor values after the request
+        :return: The new Change, or None
+        """
+        ids, names, events = document.take_changes()
+        placements = {}
+        for id in ids:
+            before = self._placement_before(id, original)
+            after = document.placement_values(document.row(id)) if id in document else None
+            if not same_placement(before, after):
+                placements[id] = (before, after)
+        outlines = {}
+        for name in names:
+            before = self._outline_before(name, original)
+            after = document.outline_values(name) if document.has_outline(name) else None
+            if not same_outline(before, after):
+                outlines[name] = (before, after)
+        editor_changes = self._editor_changes(editor)
+        structural = any(event[0] in ('add', 'remove') for event in events) or self._order_changed(document, events)
+        if not (placements or outlines or editor_changes or structural):
+            return None
+
+        for step in self.changes[self.position:]:
+            for steps, keys in ((self._placement_steps, step.placements), (self._outline_steps, step.outlines)):
+                for key in keys:
+                    steps[key].pop()
+                    if not steps[key]:
+                        del steps[key]
+        del self.changes[self.position:]
+
+        change = Change(label, placements, outlines, events, editor_changes)
+        for id in placements:
+            self._placement_steps.setdefault(id, []).append(len(self.changes))
+        for name in outlines:
+            self._outline_steps.setdefault(name, []).append(len(self.changes))
+        self.changes.append(change)
+        self._apply_editor(change.editor, 1)
+        self.position += 1
+        return change
+
+    def _editor_changes(self, editor):
+        changes = {}
+        for field, previous in self.editor.items():
+            if field not in editor:
+                continue
+            value = editor[field]
+            if value == previous:
+                continue
+            if isinstance(previous, dict):
+                changed = [key for key, item in value.items() if previous.get(key, MISSING) != item]
+                before = {key: previous[key] for key in changed if key in previous and not same(previous[key], value[key])}
+                after = {key: detach(value[key]) for key in changed if key in before or key not in previous}
+                for key in previous.keys() - value.keys():
+                    before[key] = previous[key]
+                if before or after:
+                    changes[field] = (before, after)
+            else:
+                changes[field] = (previous, detach(value))
+        return changes
+
+    @staticmethod
+    def _order_changed(document, events):
+        # Removing and adding an outline again (e.g. regenerating a string) only matters when it moved
+        if not events:
+            return False
+        order = [document.names[index] for index in document.outline_order]
+        current = list(order)
+        for event in reversed(events):
+            if event[0] == 'add_outline':
+                del order[event[1]]
+            elif event[0] == 'remove_outline':
+                order.insert(event[1], event[2])
+        return order != current
+
+    # Undo and redo
+
+    def undo(self, document, original):
+        """ Put the document and the editor values back to the step before. Returns the undone Change, or None. """
+        if self.position == 0:
+            return None
+        change = self.changes[self.position - 1]
+        for event in reversed(change.events):
+            if event[0] == 'add':
+                document.remove_placements([document.row(event[1])])
+            elif event[0] == 'remove':
+                document.insert_placements(event[1], event[2])
+            elif event[0] == 'add_outline':
+                document.remove_outline(event[2])
+            else:
+                _, position, name, (component_type, height, coordinates) = event
+                document.set_outline(name, component_type, height, coordinates, position)
+        self._restore(document, original, change, 0)
+        self.position -= 1
+        return change
+
+    def redo(self, document, original):
+        """ Apply the step that was undone last again. Returns the Change, or None. """
+        if self.position == len(self.changes):
+            return None
+        change = self.changes[self.position]
+        for event in change.events:
+            if event[0] == 'add':
+                _, id, (name, component_type, *placement) = event
+                document.add_placement(id, name, component_type, placement)
+            elif event[0] == 'remove':
+                document.remove_placements(event[1])
+            elif event[0] == 'add_outline':
+                _, position, name, (component_type, height, coordinates) = event
+                document.set_outline(name, component_type, height, coordinates, position)
+            else:
+                document.remove_outline(event[2])
+        self._restore(document, original, change, 1)
+        self.position += 1
+        return change
+
+    def _restore(self, document, original, change, side):
+        """ Set the placements and outlines of `change` to their values before (side 0) or after (side 1) it. """
+        for id, values in change.placements.items():
+            if values[side] is not None:
+                name, component_type, *placement = values[side]
+                document.add_placement(id, name, component_type, placement)
+        for name, values in change.outlines.items():
+            if values[side] is not None:
+                document.set_outline(name, *values[side])
+        self._apply_editor(change.editor, side)
+        # Undo and redo are not edits of their own
+        touched = document.take_changes()
+        reuse_source_text(document, original, touched[0], touched[1])
+
+    def _apply_editor(self, changes, side):
+        for field, values in changes.items():
+            if isinstance(self.editor[field], dict):
+                for key in values[1 - side]:
+                    if key not in values[side]:
+                        del self.editor[field][key]
+                self.editor[field].update(values[side])
+            else:
+                self.editor[field] = values[side]
+
+    # State
+
+    def nbytes(self):
+        arrays = {}
+        for change in self.changes:
+            for values in change.outlines.values():
+                for value in values:
+                    if value is not None:
+                        arrays[id(value[2])] = value[2].nbytes
+        return sum(arrays.values()) + 64 * sum(len(change.placements) + len(change.events) for change in self.changes)
+
+    def state(self, steps=True):
+        """
+        Split the history into NumPy arrays and JSON serializable fields, like IdfDocument.state.
+
+        :param steps: False to leave out the steps, e.g. when they are stored one by one with Change.state
+        """
+        vertices, refs = [], {}
+        changes = [change.state(vertices, refs) for change in self.changes] if steps else None
+        fields = {'position': self.position, 'editor': self.editor, 'changes': changes}
+        return pack_vertices(vertices), fields
+
+    @classmethod
+    def from_state(cls, arrays, fields, changes=None):
+        """ Inverse of state. Pass the steps as `changes` when they were left out of the state. """
+        history = cls({})
+        history.editor = {field: cls._detach_field(value) for field, value in fields['editor'].items()}
+        if changes is None:
+            vertices = unpack_vertices(arrays)
+            changes = [Change.from_state(change, vertices) for change in fields['changes']]
+        history.changes = list(changes)
+        for step, change in enumerate(history.changes):
+            for id in change.placements:
+                history._placement_steps.setdefault(id, []).append(step)
+            for name in change.outlines:
+                history._outline_steps.setdefault(name, []).append(step)
+        history.position = fields['position']
+        return history
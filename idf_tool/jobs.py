@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import shutil
+import logging
+import secrets
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from idf_tool.store import Database
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class JobQueue:
+    """
+    Local queue for work that is too slow for a request: the route submits a job and returns its id, a pool
+    of worker threads runs it, and the browser polls the status until the result is ready.
+
+    A job function is called as `function(job, *args)`. It reports its progress with `job.report(fraction,
+    message)` and can write result files into `job.folder`. Its return value is the result of the job.
+    Finished jobs, and their folders, are dropped `ttl` seconds after they finished.
+
+    With a `database`, the job status and result (which must then be JSON serializable) are kept in SQLite,
+    so any worker process can answer the polls for a job that runs in another one.
+    """
+
+    def __init__(self, folder, workers=2, ttl=3600, database=None):
+        self.folder = folder
+        self.ttl = ttl
+        self.database = None
+        if database is not None:
+            self.database = Database(database, """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT NOT NULL, state TEXT NOT NULL, progress REAL NOT NULL,
+                    message TEXT NOT NULL, result TEXT, error TEXT, created REAL NOT NULL, finished REAL)
+            """)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        os.makedirs(folder, exist_ok=True)
+
+    def submit(self, kind, function, *args):
+        self._expire()
+        job = Job(self, kind, os.path.join(self.folder, secrets.token_hex(8)))
+        with self._lock:
+            self._jobs[job.id] = job
+        self.save(job)
+        self._executor.submit(job.run, function, args)
+        logging.info(f"Job {job.id} ({kind}) queued")
+        return job
+
+    def get(self, id):
+        """ Job with `id`, or None when it is unknown or expired. """
+        if self.database is None:
+            with self._lock:
+                return self._jobs.get(id)
+        with self.database.connection(write=False) as db:
+            row = db.execute('SELECT kind, state, progress, message, result, error, created, finished FROM jobs WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        job = Job(self, row[0], os.path.join(self.folder, id))
+        job.state, job.progress, job.message, result, job.error, job.created, job.finished = row[1:]
+        job.result = json.loads(result) if result is not None else None
+        return job
+
+    def save(self, job):
+        if self.database is None:
+            return
+        result = json.dumps(job.result) if job.result is not None else None
+        with self.database.connection() as db:
+            db.execute('INSERT OR REPLACE INTO jobs (id, kind, state, progress, message, result, error, created, finished) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (job.id, job.kind, job.state, job.progress, job.message, result, job.error, job.created, job.finished))
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [job.id for job in self._jobs.values() if job.finished is not None and now - job.finished > self.ttl]
+            for id in expired:
+                del self._jobs[id]
+        if self.database is not None:
+            with self.database.connection() as db:
+                expired = [id for id, in db.execute('SELECT id FROM jobs WHERE finished < ?', (now - self.ttl,))]
+                db.execute('DELETE FROM jobs WHERE finished < ?', (now - self.ttl,))
+        for id in expired:
+            shutil.rmtree(os.path.join(self.folder, id), ignore_errors=True)
+
+class Job:
+    # Progress reports are written to the database at most this often
+    SAVE_INTERVAL = 0.25
+
+    def __init__(self, queue, kind, folder):
+        self.queue = queue
+        self.id = os.path.basename(folder)
+        self.kind = kind
+        self.folder = folder
+        self.state = QUEUED
+        self.progress = 0.0
+        self.message = 'Queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._saved = 0.0
+
+    def report(self, progress, message=None):
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        changed = message is not None and message != self.message
+        if message is not None:
+            self.message = message
+        if changed or time.time() - self._saved > self.SAVE_INTERVAL:
+            self._saved = time.time()
+            self.queue.save(self)
+
+    def run(self, function, args):
+        self.state = RUNNING
+        self.message = 'Running'
+        self.queue.save(self)
+        start = time.perf_counter()
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            self.result = function(self, *args)
+            self.progress = 1.0
+            self.message = 'Done'
+            self.state = DONE
+        except Exception as error:
+            self.error = f'{type(error).__name__}: {error}'
+            self.message = 'Failed'
+            self.state = FAILED
+            logging.error(f"Job {self.id} ({self.kind}) failed\n{traceback.format_exc()}")
+        self.finished = time.time()
+        self.queue.save(self)
+        logging.info(f"Job {self.id} ({self.kind}) {self.state} in {time.perf_counter() - start:.3f} s")
+
+    def status(self):
+        return {'id': self.id, 'kind': self.kind, 'state': self.state, 'progress': self.progress,
+                'message': self.message, 'error': self.error}
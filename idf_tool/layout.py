@@ -0,0 +1,184 @@
+import numpy as np
+
+from idf_tool.validate import points_in_polygon
+
+# Boxes that only touch, e.g. two strings exactly `spacing` apart, don't collide
+EPSILON = 1e-6
+
+def footprint(outline, rotation):
+    """ Bounding box (x0, y0, x1, y1) of an outline turned by `rotation` degrees, relative to the placement point. """
+    angle = rotation * np.pi / 180
+    x = outline[:, 0] * np.cos(angle) - outline[:, 1] * np.sin(angle)
+    y = outline[:, 0] * np.sin(angle) + outline[:, 1] * np.cos(angle)
+    return np.array([x.min(), y.min(), x.max(), y.max()])
+
+def edges_clip_boxes(boxes, ring):
+    """
+    Whether a segment of the closed ring `ring` passes through the interior of each box, with a Liang-Barsky
+    clip of every segment against every box at once.
+
+    :param boxes: (n, 4) array of x0, y0, x1, y1
+    :return: Bool array of length n
+    """
+    p = ring[:-1][None]
+    d = (ring[1:] - ring[:-1])[None]
+    low = boxes[:, None, :2] + EPSILON
+    high = boxes[:, None, 2:] - EPSILON
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t0 = (low - p) / d
+        t1 = (high - p) / d
+    # A segment parallel to an axis is inside the slab of that axis for every t, or for none
+    parallel = d == 0
+    inside = (p > low) & (p < high)
+    enter = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t0, t1))
+    leave = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t0, t1))
+    enter = np.maximum(enter.max(axis=-1), 0)
+    leave = np.minimum(leave.min(axis=-1), 1)
+    return (enter < leave).any(axis=1)
+
+def inside_board(boxes, board):
+    """ Whether each box lies inside the board polygon: all corners inside and no board edge through it. """
+    # Corners on the board outline count as inside
+    shrunk = boxes + (EPSILON, EPSILON, -EPSILON, -EPSILON)
+    corners = np.stack([shrunk[:, [0, 1]], shrunk[:, [2, 1]], shrunk[:, [2, 3]], shrunk[:, [0, 3]]], axis=1).reshape(-1, 2)
+    return points_in_polygon(corners, board).reshape(-1, 4).all(axis=1) & ~edges_clip_boxes(boxes, board)
+
+def cartesian(xs, ys):
+    return np.column_stack([np.repeat(xs, len(ys)), np.tile(ys, len(xs))])
+
+def collides(boxes, placed, spacing):
+    """ Whether each box comes closer than `spacing` to any of the placed boxes. """
+    return ((boxes[:, None, 0] < placed[None, :, 2] + spacing - EPSILON) & (boxes[:, None, 2] > placed[None, :, 0] - spacing + EPSILON) &
+            (boxes[:, None, 1] < placed[None, :, 3] + spacing - EPSILON) & (boxes[:, None, 3] > placed[None, :, 1] - spacing + EPSILON)).any(axis=1)
+
+def pack(sizes, board, obstacles, margin_x, margin_y, spacing):
+    """
+    Bottom-left packing of boxes, in a frame where packing starts at the lowest x and y.
+
+    Boxes are placed one after the other. The candidate positions (anchors) of a box are the corner of the
+    board, the board vertices and the right and top sides of the boxes placed so far and of the obstacles; all
+    of them are scored at once and the lowest free position wins, the leftmost among equally low ones. Boxes
+    therefore fill a row first and start the next row above the lowest box that leaves room. Anchors covered by
+    a placed box are dropped as boxes are placed, so only the free outline of the packing is searched.
+
+    :param sizes: List with, for every box, an (m, 2) array of the width and height of its m allowed orientations
+    :param board: Closed ring (k, 2) of the board, or None for an unbounded board with its corner at the origin
+    :param obstacles: (n, 4) array of boxes that must not be overlapped
+    :return: For every box the (x, y) of its lower left corner and the index of its orientation, or None when it
+             doesn't fit
+    """
+    if board is not None:
+        corner = board.min(axis=0) + (margin_x, margin_y)
+        vertices = np.unique(board[:-1], axis=0) + (margin_x, margin_y)
+        board_x = np.unique(np.append(vertices[:, 0], corner[0]))
+        board_y = np.unique(np.append(vertices[:, 1], corner[1]))
+    else:
+        corner = np.array([margin_x, margin_y])
+        board_x, board_y = corner[:1], corner[1:]
+
+    def anchors_of(boxes):
+        # Right of and above every box, aligned with its bottom or left side or with the board
+        right = boxes[:, 2] + spacing
+        top = boxes[:, 3] + spacing
+        return np.concatenate([np.column_stack([right, boxes[:, 1]]), np.column_stack([boxes[:, 0], top]),
+                               cartesian(board_x, top), cartesian(right, board_y)])
+
+    def usable(anchors, boxes):
+        # An anchor within the spacing around a box can't be the corner of another box
+        anchors = anchors[(anchors[:, 0] >= corner[0] - EPSILON) & (anchors[:, 1] >= corner[1] - EPSILON)]
+        return anchors[~collides(np.hstack([anchors, anchors]), boxes, spacing)]
+
+    placed = np.asarray(obstacles, dtype=np.float64).reshape(-1, 4)
+    anchors = np.unique(usable(np.concatenate([cartesian(board_x, board_y), anchors_of(placed)]), placed), axis=0)
+    result = []
+    for options in sizes:
+        candidates = np.repeat(anchors, len(options), axis=0)
+        orientation = np.tile(np.arange(len(options)), len(anchors))
+        boxes = np.hstack([candidates, candidates + options[orientation]])
+        free = ~collides(boxes, placed, spacing)
+        if board is not None:
+            free[free] = inside_board(boxes[free] + (-margin_x, -margin_y, margin_x, margin_y), board)
+        if not free.any():
+            result.append(None)
+            continue
+        # Lowest, then leftmost, then the first orientation (the current one)
+        best = np.flatnonzero(free)[np.lexsort((orientation[free], boxes[free, 0], boxes[free, 1]))[0]]
+        box = boxes[best:best + 1]
+        placed = np.vstack([placed, box])
+        anchors = np.unique(np.concatenate([usable(anchors, box), usable(anchors_of(box), placed)]), axis=0)
+        result.append((box[0, 0], box[0, 1], int(orientation[best])))
+    return result
+
+def layout_strings(document, ids=None, margin_x=10.0, margin_y=10.0, spacing=5.0, allow_rotation=False):
+    """
+    Place strings on the board, packed in rows from the corner with the largest x and y (where
+    autogenerate_string_coordinates starts as well), keeping `margin_x` and `margin_y` from the board outline
+    and `spacing` between strings. Footprints are the bounding boxes of the string outlines, ribbons included.
+    Strings that are not laid out stay where they are and are kept clear of; busbars are ignored, they lie on
+    the ribbons.
+
+    Taller strings are placed first, so strings of the same cell type and length end up in the same rows.
+
+    :param ids: Ids of the strings to lay out, all strings when None
+    :param allow_rotation: Also try every string turned by 90 degrees
+    :return: Ids of the strings that were placed, and of the strings that did not fit and were left where they were
+    """
+    string_rows = document.rows_of_type('string')
+    if ids is None:
+        rows = string_rows
+    else:
+        rows = np.array([document.row(id) for id in ids if id in document and document.placement_type(document.row(id)) == 'string'], dtype=np.intp)
+    rows = rows[[document.has_outline(document.placement_name(row)) for row in rows.tolist()]] if len(rows) else rows
+    placements = document.placements
+
+    # Work in a frame turned by 180 degrees, so the packing corner (largest x and y) is the lowest x and y
+    board = -np.asarray(document.board_outline, dtype=np.float64).reshape(-1, 3)[:, :2]
+    board = board if len(board) > 2 else None
+    if board is not None and not np.array_equal(board[0], board[-1]):
+        board = np.vstack([board, board[:1]])
+
+    # Footprints of every distinct outline and angle, relative to the placement point
+    footprints = {}
+    def relative_box(row, rotation):
+        key = (int(placements['name'][row]), float(rotation))
+        if key not in footprints:
+            x0, y0, x1, y1 = footprint(document.outline(document.placement_name(row)), rotation)
+            footprints[key] = np.array([-x1, -y1, -x0, -y0])
+        return footprints[key]
+
+    moving = set(rows.tolist())
+    obstacles = []
+    for row in string_rows.tolist():
+        if row not in moving and document.has_outline(document.placement_name(row)) and not np.isnan(placements['rotation'][row]):
+            obstacles.append(relative_box(row, placements['rotation'][row]) - np.tile([placements['x'][row], placements['y'][row]], 2))
+
+    angles = []
+    sizes = []
+    for row in rows.tolist():
+        rotation = placements['rotation'][row]
+        rotation = 0.0 if np.isnan(rotation) else float(rotation)
+        options = [rotation, (rotation + 90) % 360] if allow_rotation else [rotation]
+        angles.append(options)
+        sizes.append(np.array([relative_box(row, angle)[2:] - relative_box(row, angle)[:2] for angle in options]))
+
+    # Tallest first, then widest, in the requested order otherwise
+    order = sorted(range(len(rows)), key=lambda i: (-sizes[i][0][1], -sizes[i][0][0]))
+    positions = pack([sizes[i] for i in order], board, obstacles, margin_x, margin_y, spacing)
+
+    placed, skipped = [], []
+    for i, position in zip(order, positions):
+        row = int(rows[i])
+        id = str(placements['id'][row])
+        if position is None:
+            skipped.append(id)
+            continue
+        x, y, option = position
+        rotation = angles[i][option]
+        box = relative_box(row, rotation)
+        # The lower left corner of the box in the turned frame is (-x, -y) in the document
+        placements['x'][row] = -(x - box[0])
+        placements['y'][row] = -(y - box[1])
+        placements['rotation'][row] = rotation
+        document.touch(row)
+        placed.append(id)
+    return placed, skipped
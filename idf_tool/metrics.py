@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import logging
+import cProfile
+import functools
+import threading
+from bisect import bisect_left
+from datetime import datetime
+
+from flask import Response, g, has_request_context, request, session, before_render_template, template_rendered
+
+# Prometheus' default latency buckets, and powers of four from 1 kB for payload sizes
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+# Route milestones that are logged as "Route: /x - <milestone>", and the phase that ends with each of them
+MILESTONE_PHASES = {
+    'Session data retrieved': 'session_load',
+    'HTML parsed': 'form_parsing',
+    'JSON parsed': 'form_parsing',
+    'IDF file parsed': 'parsing',
+    'IDF file loaded from the parse cache': 'parsing',
+    'Data processed': 'geometry_edits',
+    'Session data stored': 'session_store',
+}
+MILESTONE = re.compile(r'^Route: (\S+) - (.+)$')
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    """ Histograms of one process, keyed by metric name and label values. """
+
+    def __init__(self):
+        self.help = {}
+        self.buckets = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        self.help[name] = help
+        self.buckets[name] = buckets
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets[name])
+            histogram.observe(value)
+
+    def exposition(self):
+        """ Prometheus text format. """
+        lines = []
+        with self._lock:
+            for name in sorted(self.help):
+                lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+                    prefix = label_text + ',' if label_text else ''
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label_text}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{label_text}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+registry.histogram('idf_request_seconds', 'Latency of a request until the response is returned.')
+registry.histogram('idf_route_phase_seconds', 'Time spent in each phase of a route.')
+registry.histogram('idf_function_seconds', 'Time spent in instrumented parse_idf functions.')
+registry.histogram('idf_payload_bytes', 'Size of session data, workspaces, figures and responses.', BYTES_BUCKETS)
+
+def route_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def timed(function, name=None):
+    """ Wrap `function` so every call is recorded in idf_function_seconds. """
+    name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            registry.observe('idf_function_seconds', time.perf_counter() - start, function=name)
+    return wrapper
+
+def instrument(module, names):
+    """ Replace functions of a module with timed wrappers; calls through the module (also from inside it) are recorded. """
+    for name in names:
+        function = getattr(module, name)
+        if not hasattr(function, '__wrapped__'):
+            setattr(module, name, timed(function))
+
+def observe_size(kind, size):
+    registry.observe('idf_payload_bytes', size, kind=kind)
+
+def end_phase(phase):
+    """ Record the time since the previous phase of the current request ended. """
+    now = time.perf_counter()
+    elapsed = now - g.get('metrics_phase_start', now)
+    g.metrics_phase_start = now
+    registry.observe('idf_route_phase_seconds', elapsed, route=route_label(), phase=phase)
+    return elapsed
+
+class MilestoneFilter(logging.Filter):
+    """ Attach the duration of the phase that a route milestone closes to its log message, and record it. """
+
+    def filter(self, record):
+        if has_request_context() and isinstance(record.msg, str) and not record.args:
+            match = MILESTONE.match(record.msg)
+            if match:
+                milestone = match.group(2)
+                phase = MILESTONE_PHASES.get(milestone, re.sub(r'\W+', '_', milestone.lower()).strip('_'))
+                record.msg = f'{record.msg} ({end_phase(phase) * 1000:.1f} ms)'
+        return True
+
+def init_app(app, workspace_size=None):
+    """
+    Time every request and its phases, and serve the histograms at /metrics.
+
+    :param workspace_size: Optional callable returning the size in bytes of the current request's server-side state
+    """
+    logging.getLogger().addFilter(MilestoneFilter())
+    profile_folder = app.config.get('PROFILE_FOLDER')
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_request_start = g.metrics_phase_start = time.perf_counter()
+        # Opt-in profile of a single request: ?profile=1 or an X-Profile header, when PROFILE_FOLDER is set
+        if profile_folder and (request.args.get('profile') or request.headers.get('X-Profile')):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def stop_request_timer(response):
+        start = g.get('metrics_request_start')
+        if start is None:
+            return response
+        route = route_label()
+        registry.observe('idf_request_seconds', time.perf_counter() - start, route=route, method=request.method)
+        if not response.is_streamed and response.content_length is not None:
+            observe_size('response', response.content_length)
+        observe_size('session', len(json.dumps(dict(session), default=str)))
+        if workspace_size is not None:
+            observe_size('workspace', workspace_size())
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_folder, exist_ok=True)
+            endpoint = request.endpoint or 'unmatched'
+            profiler.dump_stats(os.path.join(profile_folder, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{endpoint}.prof"))
+        return response
+
+    def start_render(sender, template, context, **extra):
+        if has_request_context():
+            end_phase('before_render')
+
+    def end_render(sender, template, context, **extra):
+        if has_request_context():
+            end_phase('template_render')
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(end_render, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.exposition(), mimetype='text/plain; version=0.0.4')
@@ -1,157 +1,329 @@
 import numpy as np
 import plotly.graph_objects as go
-import re
+import io
+import os
+import hashlib
+import functools
+import threading
+import zlib
 import difflib
+import bisect
+import zipfile
+from collections import Counter, OrderedDict
+from idf_tool.document import IdfDocument, SOURCE_TEXT
+from idf_tool.reader import read_buffer, read_file, section_body
 
-def generate_diff(original_text: str, new_text: str, fromfile: str, tofile: str) -> list[str]:
+# Bump whenever parsing, string reverse engineering or the board figure change, it invalidates cached parse results
+PARSER_VERSION = 4
+
+# Cell types: long side, short side, number of ribbons, ribbon offset
+CELL_TYPES = {'M10': [182.0, 182.0, 10, 13.1], 'M10 HC': [182.0, 91.0, 10, 13.1], 'G1': [158.75, 158.75, 5, 16.625]}
+
+def generate_diff(original_text: str, new_text: str, fromfile: str, tofile: str, reformatted: bool = True) -> list[str]:
+    """ Unified diff of two IDF files, see diff_page. """
     original_lines = original_text.splitlines()
     new_lines = new_text.splitlines()
+    opcodes, _ = diff_opcodes(original_lines, new_lines, reformatted)
+    hunks = [format_hunk(group, original_lines, new_lines) for group in group_opcodes(opcodes)]
+    return [f'--- {fromfile}', f'+++ {tofile}'] + [line for hunk in hunks for line in hunk] if hunks else []
 
-    diff = difflib.unified_diff(
-        original_lines,
-        new_lines,
-        fromfile=fromfile,
-        tofile=tofile,
-        lineterm=''
-    )
-    return list(diff)
+def diff_page(original_text, new_text, fromfile, tofile, page=0, page_size=50, reformatted=False):
+    """
+    One page of hunks of the unified diff of two IDF files.
 
-def board_outline(file_path):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-        in_board_outline_section = False
-        coordinates = []
-
-        for line in lines:
-            if '.BOARD_OUTLINE' in line:
-                in_board_outline_section = True
-                continue
-            if '.END_BOARD_OUTLINE' in line:
-                in_board_outline_section = False
-                break
-            if in_board_outline_section:
-                parts = line.split()
-                if len(parts) == 4:
-                    coordinates.append((float(parts[1]), float(parts[2]), float(parts[3])))
-        board_outline = np.array(coordinates)
-        return board_outline
+    Instead of diffing every line, the files are split into records: placements keyed by component id,
+    .MECHANICAL blocks keyed by name and any other line keyed by its text. Only the record sequences are
+    aligned, and only records whose text differs are diffed line by line. Unless `reformatted` is set,
+    lines that only differ in number formatting (e.g. -198.000 and -198.0) count as equal.
 
-def component_placements(file_path):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-        component_placements = {}
-        in_placement_section = False
-
-        for line in lines:
-            if '.PLACEMENT' in line:
-                in_placement_section = True
+    :return: Dict with the diff 'lines' of the page (with the file header lines), the 'page', the number of
+             'pages' and the number of records that were only 'reformatted'
+    """
+    original_lines = original_text.splitlines()
+    new_lines = new_text.splitlines()
+    opcodes, reformatted_count = diff_opcodes(original_lines, new_lines, reformatted)
+    groups = list(group_opcodes(opcodes))
+    lines = [f'--- {fromfile}', f'+++ {tofile}'] if groups else []
+    for group in groups[page * page_size:(page + 1) * page_size]:
+        lines += format_hunk(group, original_lines, new_lines)
+    return {'lines': lines, 'page': page, 'pages': -(-len(groups) // page_size), 'reformatted': reformatted_count}
+
+def diff_records(lines):
+    """ Split the lines of an IDF file into (key, start, stop) records, the units diff_opcodes aligns. """
+    records = []
+    section = None
+    i = 0
+    while i < len(lines):
+        stripped = lines[i].strip()
+        keyword = stripped.split(maxsplit=1)[0] if stripped.startswith('.') else None
+        stop = i + 1
+        if keyword == '.MECHANICAL':
+            while stop < len(lines) and not lines[stop].strip().startswith('.END_MECHANICAL'):
+                stop += 1
+            stop = min(stop + 1, len(lines))
+            name = lines[i + 1].split('"')[1] if i + 1 < len(lines) and lines[i + 1].count('"') >= 2 else ''
+            key = ('outline', name)
+        elif section == 'placement' and stripped.startswith('"'):
+            while stop < len(lines) and not lines[stop].lstrip().startswith(('"', '.')):
+                stop += 1
+            key = ('placement', lines[i].split('"')[-1].strip())
+        else:
+            if keyword == '.PLACEMENT':
+                section = 'placement'
+            elif keyword == '.END_PLACEMENT':
+                section = None
+            key = ('line', lines[i])
+        records.append((key, i, stop))
+        i = stop
+    return records
+
+def line_values(line):
+    """ Tokens of a line with the numbers parsed, so lines that only differ in number formatting compare equal. """
+    values = []
+    for token in line.split():
+        try:
+            values.append(float(token))
+        except ValueError:
+            values.append(token)
+    return tuple(values)
+
+def diff_opcodes(a, b, reformatted=False):
+    """
+    Line opcodes (like difflib.SequenceMatcher.get_opcodes) that turn lines `a` into lines `b`, from the
+    alignment of their records. Records only paired by key are compared line by line.
+
+    :return: The opcodes and the number of records whose lines only differ in number formatting
+    """
+    records_a = diff_records(a)
+    records_b = diff_records(b)
+    opcodes = []
+    reformatted_count = 0
+
+    def emit(tag, i1, i2, j1, j2):
+        if i1 == i2 and j1 == j2:
+            return
+        if opcodes and opcodes[-1][0] == tag == 'equal':
+            opcodes[-1] = ('equal', opcodes[-1][1], i2, opcodes[-1][3], j2)
+        else:
+            opcodes.append((tag, i1, i2, j1, j2))
+
+    for tag, r1, r2, s1, s2 in align_keys([key for key, _, _ in records_a], [key for key, _, _ in records_b]):
+        i1 = records_a[r1][1] if r1 < len(records_a) else len(a)
+        i2 = records_a[r2 - 1][2] if r2 > r1 else i1
+        j1 = records_b[s1][1] if s1 < len(records_b) else len(b)
+        j2 = records_b[s2 - 1][2] if s2 > s1 else j1
+        if tag != 'equal':
+            emit(tag, i1, i2, j1, j2)
+            continue
+        for (_, i1, i2), (_, j1, j2) in zip(records_a[r1:r2], records_b[s1:s2]):
+            lines_a, lines_b = a[i1:i2], b[j1:j2]
+            if lines_a == lines_b:
+                emit('equal', i1, i2, j1, j2)
                 continue
-            if '.END_PLACEMENT' in line:
-                in_placement_section = False
-                break
-            if in_placement_section:
-                if line.startswith('"'):
-                    parts = line.split('"')
-                    name = parts[1].strip()
-                    component_type = parts[3].strip()
-                    component_id = parts[-1].strip()
-                    current_component = {'name': name, 'component_type': component_type, 'placement': []}
-                    component_placements[component_id] = current_component
-                else:
-                    parts = line.split()
-                    if len(parts) == 6:
-                        x, y, z, rotation = map(float, parts[:4])
-                        current_component['placement'] = [x, y, z, rotation]
+            if reformatted:
+                keys_a, keys_b = lines_a, lines_b
+            else:
+                keys_a, keys_b = [line_values(line) for line in lines_a], [line_values(line) for line in lines_b]
+                if keys_a == keys_b:
+                    reformatted_count += 1
+                    emit('equal', i1, i2, j1, j2)
+                    continue
+            for sub_tag, k1, k2, l1, l2 in difflib.SequenceMatcher(None, keys_a, keys_b, autojunk=False).get_opcodes():
+                emit(sub_tag, i1 + k1, i1 + k2, j1 + l1, j1 + l2)
+    return opcodes, reformatted_count
+
+def align_keys(keys_a, keys_b):
+    """
+    Opcodes that turn the sequence `keys_a` into `keys_b`. Keys that occur once in both sequences are matched
+    first (the longest run of them in the same order, as in a patience diff), SequenceMatcher only aligns
+    the gaps between them. Records are mostly unique, so this stays fast when many of them moved.
+    """
+    count_a = Counter(keys_a)
+    positions_b = {key: j for j, key in enumerate(keys_b)}
+    count_b = Counter(keys_b)
+    pairs = [(i, positions_b[key]) for i, key in enumerate(keys_a) if count_a[key] == 1 and count_b[key] == 1]
+
+    # Longest subsequence of the pairs with increasing positions in b
+    tails, tail_positions, previous = [], [], [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        position = bisect.bisect_left(tail_positions, j)
+        previous[k] = tails[position - 1] if position else None
+        if position == len(tails):
+            tails.append(k)
+            tail_positions.append(j)
+        else:
+            tails[position] = k
+            tail_positions[position] = j
+    anchors = []
+    k = tails[-1] if tails else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = previous[k]
+    anchors.reverse()
+
+    blocks = []
+    i0 = j0 = 0
+    for i, j in anchors + [(len(keys_a), len(keys_b))]:
+        if i > i0 and j > j0:
+            matcher = difflib.SequenceMatcher(None, keys_a[i0:i], keys_b[j0:j], autojunk=False)
+            blocks += [(i0 + x, j0 + y, size) for x, y, size in matcher.get_matching_blocks() if size]
+        blocks.append((i, j, 1))
+        i0, j0 = i + 1, j + 1
+    blocks[-1] = (len(keys_a), len(keys_b), 0)
+
+    opcodes = []
+    i = j = 0
+    for block_i, block_j, size in blocks:
+        if i < block_i or j < block_j:
+            opcodes.append(('replace' if i < block_i and j < block_j else 'delete' if i < block_i else 'insert', i, block_i, j, block_j))
+        if size:
+            opcodes.append(('equal', block_i, block_i + size, block_j, block_j + size))
+        i, j = block_i + size, block_j + size
+    return opcodes
+
+def group_opcodes(opcodes, context=3):
+    """ Hunks of opcodes with `context` equal lines around the changes, like difflib.SequenceMatcher.get_grouped_opcodes. """
+    codes = list(opcodes)
+    if codes and codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes and codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def format_hunk(group, a, b):
+    """ Lines of one unified diff hunk. Equal lines are shown as they are in `a`. """
+    def format_range(start, stop):
+        if stop - start == 1:
+            return f'{start + 1}'
+        return f'{start + 1 if stop > start else start},{stop - start}'
+
+    lines = [f'@@ -{format_range(group[0][1], group[-1][2])} +{format_range(group[0][3], group[-1][4])} @@']
+    for tag, i1, i2, j1, j2 in group:
+        if tag == 'equal':
+            lines += [' ' + line for line in a[i1:i2]]
+            continue
+        lines += ['-' + line for line in a[i1:i2]]
+        lines += ['+' + line for line in b[j1:j2]]
+    return lines
+
+def parse_lines(lines):
+    """
+    Parse an IDF file from its lines.
+
+    :param lines: Any iterable of lines, e.g. an open file
+    :return: An IdfDocument holding the header, board outline, placements and mechanical outlines
+    """
+    return read_buffer(''.join(lines).encode('utf-8'))
 
-        return component_placements
+def parse_document(file_path):
+    # Memory mapped, large files are parsed without reading them into Python strings
+    return read_file(file_path)
+
+def board_outline(file_path):
+    return parse_document(file_path).board_outline
+
+def component_placements(file_path):
+    return parse_document(file_path).component_placements()
 
 def component_outlines(file_path):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-        component_outlines = {}
-        current_component = None
-        in_mechanical_section = False
-
-        for line in lines:
-            if '.MECHANICAL' in line:
-                in_mechanical_section = True
-                continue
-            if in_mechanical_section:
-                parts = line.split('"')
-                name = parts[1].strip()
-                component_type = parts[3].strip()
-                height = parts[-1].strip().split()[-1]
-                current_component = {name: {'component_type': component_type, 'height': height, 'coordinates': []}}
-                coordinates = []
-                component_outlines.update(current_component)
-                in_mechanical_section = False
-                continue
-            if '.END_MECHANICAL' in line:
-                current_component = None
-                continue
-            if current_component:
-                parts = line.split()
-                if len(parts) == 4:
-                    component_name = list(current_component.keys())[0]
-                    coordinates.append([float(parts[1]), float(parts[2]), float(parts[3])])
-                    component_outlines[component_name]['coordinates'] = np.array(coordinates)
-    return component_outlines
-
-def get_component_names_by_type(component_outlines):
-    sbars = []
-    strings = []
-
-    for name, details in component_outlines.items():
-        if details['component_type'] == 'busbar':
-            sbars.append(name)
-        elif details['component_type'] == 'string':
-            strings.append(name)
+    return parse_document(file_path).component_outlines()
+
+def get_component_names_by_type(document):
+    sbars = document.outline_names('busbar')
+    strings = document.outline_names('string')
 
     return sbars, strings
 
-def draw_board(board_outline, component_outlines, component_placements):
-    fig = go.Figure()
+def outline_polylines(document, rows):
+    """
+    Rotate and translate the outlines of the placements in `rows` in one batch.
+
+    :return: x and y arrays holding one polyline per placement, each followed by a NaN separator, and the
+             length of every polyline including its separator
+    """
+    placements = document.placements[rows]
+    starts, stops = document.offsets[placements['name']].T
+    counts = stops - starts
+    lengths = counts + 1
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    point = position < counts[owner]
+
+    vertices = document.vertices[(starts[owner] + position)[point]]
+    angle = placements['rotation'][owner[point]] * np.pi / 180
+    cos_angle = np.cos(angle)
+    sin_angle = np.sin(angle)
+
+    x = np.full(len(owner), np.nan)
+    y = np.full(len(owner), np.nan)
+    x[point] = vertices[:, 0] * cos_angle - vertices[:, 1] * sin_angle + placements['x'][owner[point]]
+    y[point] = vertices[:, 0] * sin_angle + vertices[:, 1] * cos_angle + placements['y'][owner[point]]
+    return x, y, lengths
+
+def board_traces(document, per_component=False):
+    """
+    Coordinates of every trace of the board figure, in trace order: the board outline, the component outlines
+    and the placement markers.
+
+    :param per_component: One trace per placement instead of one trace per component type
+    :return: List of (kind, name, x, y, text) tuples, kind is 'board', 'lines' or 'markers' and text holds the
+             hover labels of the markers (None for the other traces)
+    """
+    x, y, z = document.board_outline.T
+    traces = [('board', 'Board Outline', x, y, None)]
+
+    placements = document.placements
+    labels = [f"{id} {document.names[name]}" for id, name in zip(placements['id'].tolist(), placements['name'].tolist())]
+
+    if per_component:
+        x, y, lengths = outline_polylines(document, np.arange(len(placements)))
+        stops = np.cumsum(lengths) - 1
+        for label, start, stop in zip(labels, stops - lengths + 1, stops):
+            traces.append(('lines', label, x[start:stop], y[start:stop], None))
+        for x_offset, y_offset in zip(placements['x'].tolist(), placements['y'].tolist()):
+            traces.append(('markers', None, np.array([x_offset]), np.array([y_offset]), None))
+    else:
+        for type_index, component_type in enumerate(document.types):
+            rows = np.flatnonzero(placements['type'] == type_index)
+            if len(rows) == 0:
+                continue
+            x, y, _ = outline_polylines(document, rows)
+            # Floating point noise beyond a micrometre only bloats the JSON
+            traces.append(('lines', component_type.capitalize(), np.round(x, 3), np.round(y, 3), None))
+        traces.append(('markers', None, np.round(placements['x'], 3), np.round(placements['y'], 3), labels))
+    return traces
+
+def draw_board(document, per_component=False, traces=None):
+    """
+    Plot the board outline, the component outlines and the placement points.
 
-    # Add board outline
-    x, y, z = board_outline.T
-    fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name='Board Outline'))
-
-    # Add component outlines and placements
-    for component_id, component_placement in component_placements.items():
-        component_outline = component_outlines[component_placement['name']]
-
-        angle = component_placement['placement'][3]
-        cos_angle = np.cos(angle * np.pi / 180)
-        sin_angle = np.sin(angle * np.pi / 180)
-
-        rotated_coordinates = []
-        for point in component_outline['coordinates']:
-            x, y, z = point
-            x_rot = x * cos_angle - y * sin_angle
-            y_rot = x * sin_angle + y * cos_angle
-            rotated_coordinates.append([x_rot, y_rot, z])
-
-        x_outline, y_outline, z_outline = np.array(rotated_coordinates).T
-        x_offset, y_offset, z_offset = component_placement['placement'][:3]
-        if component_outline['component_type'] == 'busbar':
-            x_corr = x_outline + x_offset
-            y_corr = y_outline + y_offset
-            z_corr = z_outline + z_offset
+    :param per_component: One trace (and legend entry) per placement instead of one trace per component type
+    :param traces: The result of board_traces, when the caller already has it
+    """
+    fig = go.Figure()
+    if traces is None:
+        traces = board_traces(document, per_component)
+
+    for kind, name, x, y, text in traces:
+        if kind == 'board' or (kind == 'lines' and per_component):
+            fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=name))
+        elif kind == 'lines':
+            fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=name, hoverinfo='skip'))
+        elif text is None:
+            fig.add_trace(go.Scatter(x=x.tolist(), y=y.tolist(), mode='markers', marker=dict(color='red', size=4), showlegend=False))
         else:
-            x_corr = x_outline + x_offset
-            y_corr = y_outline + y_offset
-            z_corr = z_outline + z_offset
-        fig.add_trace(go.Scatter(x=x_corr, y=y_corr, mode='lines', name=f"{component_id} {component_placement['name']}"))
-
-    # Add component placements as scatter points
-    for component_id, component_placement in component_placements.items():
-        fig.add_trace(go.Scatter(
-            x=[component_placement['placement'][0]],
-            y=[component_placement['placement'][1]],
-            mode='markers',
-            marker=dict(color='red', size=4),
-            showlegend=False  
-        ))
+            fig.add_trace(go.Scatter(x=x, y=y, mode='markers', marker=dict(color='red', size=4), text=text, hoverinfo='text', showlegend=False))
 
     # Update layout
     fig.update_layout(
@@ -175,189 +347,341 @@ def draw_board(board_outline, component_outlines, component_placements):
 
     return fig
 
-def translate(corrected_component_placements, corrected_component_outlines, w_sbar_prev, w_string_prev, form_data):
-    for id, placement in corrected_component_placements.items():
-        if placement['component_type'] == 'busbar':
-            if w_sbar_prev[placement["name"]][-1] == w_sbar_prev[placement["name"]][-2]:
-                placement['placement'][0] = float(form_data.get(f'placement_{id}_0', placement['placement'][0]))
-                placement['placement'][1] = float(form_data.get(f'placement_{id}_1', placement['placement'][1]))
-                placement['placement'][2] = float(form_data.get(f'placement_{id}_2', placement['placement'][2]))
-        elif placement['component_type'] == 'string':
-            placement['name'] = form_data.get(f'name_{id}', placement['name'])
-            if w_string_prev[id][-1] == w_string_prev[id][-2] or len(w_string_prev[id]) == 1:
-                placement['placement'][0] = float(form_data.get(f'placement_{id}_0', placement['placement'][0]))
-                placement['placement'][1] = float(form_data.get(f'placement_{id}_1', placement['placement'][1]))
-                placement['placement'][2] = float(form_data.get(f'placement_{id}_2', placement['placement'][2]))
-
-    for name, outline in corrected_component_outlines.items():
-        if outline['component_type'] == 'busbar':
-            if w_sbar_prev[name][-1] == w_sbar_prev[name][-2]:
-                outline['coordinates'][2, 0] = float(form_data.get(f'outline_{name}_0', outline['coordinates'][2, 0]))
-                outline['coordinates'][1, 0] = float(form_data.get(f'outline_{name}_0', outline['coordinates'][2, 0]))
-                outline['coordinates'][2, 1] = float(form_data.get(f'outline_{name}_1', outline['coordinates'][2, 1]))
-                outline['coordinates'][3, 1] = float(form_data.get(f'outline_{name}_1', outline['coordinates'][2, 1]))
-    return
+def json_floats(values):
+    """ Floats as a JSON serializable list, NaN (the polyline separator) becomes null like in the Plotly encoder. """
+    return [None if value != value else value for value in values.tolist()]
 
-def rotate0to180(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types):
-    outline = corrected_component_outlines[corrected_component_placements[id]['name']]['coordinates']
-    if corrected_component_placements[id]['component_type'] == "string":
-        component_long_side = cell_types[string_metadata[corrected_component_placements[id]['name']]['cell_type']][0]
-        component_short_side = string_metadata[corrected_component_placements[id]['name']]['nr_cells'] * cell_types[string_metadata[corrected_component_placements[id]['name']]['cell_type']][1] + (string_metadata[corrected_component_placements[id]['name']]['nr_cells']-1) * string_metadata[corrected_component_placements[id]['name']]['dist']
-    else:
-        component_long_side = np.max(outline)
-        component_short_side = 5
-    if corrected_component_placements[id]['placement'][3] == 0:
-        corrected_component_placements[id]['placement'][0] += component_long_side
-        corrected_component_placements[id]['placement'][1] += component_short_side
-    elif corrected_component_placements[id]['placement'][3] == 90:
-        corrected_component_placements[id]['placement'][0] -= component_short_side
-        corrected_component_placements[id]['placement'][1] += component_long_side
-    elif corrected_component_placements[id]['placement'][3] == 180:
-        corrected_component_placements[id]['placement'][0] -= component_long_side
-        corrected_component_placements[id]['placement'][1] -= component_short_side
-    elif corrected_component_placements[id]['placement'][3] == 270 or corrected_component_placements[id]['placement'][3] == -90:
-        corrected_component_placements[id]['placement'][0] += component_short_side
-        corrected_component_placements[id]['placement'][1] -= component_long_side
-    corrected_component_placements[id]['placement'][3] = (corrected_component_placements[id]['placement'][3] + 180) % 360
-    return
+def figure_patch(previous, traces, gap=8):
+    """
+    The parts of the board traces that changed since `previous`, the traces of the figure the browser has.
+    Changed points closer than `gap` points apart are sent as one segment.
 
-def rotate180to0(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types):
-    outline = corrected_component_outlines[corrected_component_placements[id]['name']]['coordinates']
-    if corrected_component_placements[id]['component_type'] == "string":
-        component_long_side = cell_types[string_metadata[corrected_component_placements[id]['name']]['cell_type']][0]
-        component_short_side = string_metadata[corrected_component_placements[id]['name']]['nr_cells'] * cell_types[string_metadata[corrected_component_placements[id]['name']]['cell_type']][1] + (string_metadata[corrected_component_placements[id]['name']]['nr_cells']-1) * string_metadata[corrected_component_placements[id]['name']]['dist']
-    else:
-        component_long_side = np.max(outline)
-        component_short_side = 5
-    if corrected_component_placements[id]['placement'][3] == 180:
-        corrected_component_placements[id]['placement'][0] -= component_long_side
-        corrected_component_placements[id]['placement'][1] -= component_short_side
-    elif corrected_component_placements[id]['placement'][3] == 270 or corrected_component_placements[id]['placement'][3] == -90:
-        corrected_component_placements[id]['placement'][0] += component_short_side
-        corrected_component_placements[id]['placement'][1] -= component_long_side
-    elif corrected_component_placements[id]['placement'][3] == 0:
-        corrected_component_placements[id]['placement'][0] += component_long_side
-        corrected_component_placements[id]['placement'][1] += component_short_side
-    elif corrected_component_placements[id]['placement'][3] == 90:
-        corrected_component_placements[id]['placement'][0] -= component_short_side
-        corrected_component_placements[id]['placement'][1] += component_long_side
-    corrected_component_placements[id]['placement'][3] = (corrected_component_placements[id]['placement'][3] - 180) % 360
+    :return: List of {'trace': i, 'start': j, 'x': [...], 'y': [...]} segments (plus 'text' for the markers), with
+             'start' None when the trace changed length and is sent whole. None when the figure has to be sent whole.
+    """
+    if previous is None or [trace[:2] for trace in previous] != [trace[:2] for trace in traces]:
+        return None
+    patch = []
+    for i, ((_, _, x0, y0, text0), (_, _, x, y, text)) in enumerate(zip(previous, traces)):
+        if len(x0) != len(x) or (text0 is None) != (text is None):
+            segment = {'trace': i, 'start': None, 'x': json_floats(x), 'y': json_floats(y)}
+            if text is not None:
+                segment['text'] = list(text)
+            patch.append(segment)
+            continue
+        with np.errstate(invalid='ignore'):
+            changed = ~(((x0 == x) | (np.isnan(x0) & np.isnan(x))) & ((y0 == y) | (np.isnan(y0) & np.isnan(y))))
+        if text is not None:
+            changed |= np.array(text0, dtype=object) != np.array(text, dtype=object)
+        points = np.flatnonzero(changed)
+        if len(points) == 0:
+            continue
+        breaks = np.flatnonzero(np.diff(points) > gap)
+        starts = points[np.r_[0, breaks + 1]]
+        stops = points[np.r_[breaks, len(points) - 1]] + 1
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            segment = {'trace': i, 'start': start, 'x': json_floats(x[start:stop]), 'y': json_floats(y[start:stop])}
+            if text is not None:
+                segment['text'] = list(text[start:stop])
+            patch.append(segment)
+    return patch
+
+def translate(document, w_sbar_prev, w_string_prev, form_data):
+    placements = document.placements
+    for row, id in enumerate(document.ids()):
+        component_type = document.placement_type(row)
+        if component_type == 'busbar':
+            prev = w_sbar_prev[document.placement_name(row)]
+            move = prev[-1] == prev[-2]
+        elif component_type == 'string':
+            name = form_data.get(f'name_{id}', None)
+            if name is not None:
+                document.rename_placements(row, name)
+            prev = w_string_prev[id]
+            move = len(prev) == 1 or prev[-1] == prev[-2]
+        else:
+            move = False
+        if move:
+            for axis, column in enumerate(('x', 'y', 'z')):
+                value = float(form_data.get(f'placement_{id}_{axis}', placements[column][row]))
+                if value != placements[column][row]:
+                    placements[column][row] = value
+                    document.touch(row)
+
+    for name in document.outline_names('busbar'):
+        if w_sbar_prev[name][-1] == w_sbar_prev[name][-2]:
+            coordinates = document.outline(name)
+            previous = coordinates.copy()
+            coordinates[2, 0] = float(form_data.get(f'outline_{name}_0', coordinates[2, 0]))
+            coordinates[1, 0] = float(form_data.get(f'outline_{name}_0', coordinates[2, 0]))
+            coordinates[2, 1] = float(form_data.get(f'outline_{name}_1', coordinates[2, 1]))
+            coordinates[3, 1] = float(form_data.get(f'outline_{name}_1', coordinates[2, 1]))
+            if not np.array_equal(coordinates, previous):
+                document.touch_outline(name)
     return
 
-def rotate_to_zero(corrected_component_placements, corrected_component_outlines, id, prev_angle, string_metadata, cell_types):
-    if prev_angle == 90:
-        corrected_component_placements[id]['placement'][3] -= 90
-    elif prev_angle == 180:
-        rotate180to0(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types)
-    elif prev_angle == 270:
-        rotate180to0(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types)
-        corrected_component_placements[id]['placement'][3] -= 90
-
-def rotate(corrected_component_placements, corrected_component_outlines, w_sbar_prev, w_sbar, w_string_prev, w_string, string_metadata, cell_types):
-    for id, component_placement in corrected_component_placements.items():
-        for sbar, _ in w_sbar.items():
-            if sbar == component_placement['name']:
-                prev_angle = w_sbar_prev[sbar][0] if w_sbar_prev[sbar][0] != -90 else 270
-                current_angle = w_sbar[sbar] if w_sbar[sbar] != -90 else 270
-                if w_sbar_prev[sbar][0] != w_sbar[sbar]:
-                    # Rotate back to 0
-                    rotate_to_zero(corrected_component_placements, corrected_component_outlines, id, prev_angle, string_metadata, cell_types)
-
-                    # Rotate to the current angle
-                    if current_angle == 90:
-                        corrected_component_placements[id]['placement'][3] += 90
-                    elif current_angle == 180:
-                        rotate0to180(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types)
-                    elif current_angle == 270:
-                        corrected_component_placements[id]['placement'][3] += 90
-                        rotate0to180(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types)
-                        if w_sbar[sbar] == -90:
-                            corrected_component_placements[id]['placement'][3] = -90
-    for id, _ in w_string.items():
-        prev_angle = w_string_prev[id][0] if w_string_prev[id][0] != -90 else 270
-        current_angle = w_string[id] if w_string[id] != -90 else 270
-        if w_string_prev[id][0] != w_string[id]:
-            # Rotate back to 0
-            rotate_to_zero(corrected_component_placements, corrected_component_outlines, id, prev_angle, string_metadata, cell_types)
-
-            # Rotate to the current angle
-            if current_angle == 90:
-                corrected_component_placements[id]['placement'][3] += 90
-            elif current_angle == 180:
-                rotate0to180(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types)
-            elif current_angle == 270:
-                corrected_component_placements[id]['placement'][3] += 90
-                rotate0to180(id, corrected_component_placements, corrected_component_outlines, string_metadata, cell_types)
-                if w_string[id] == -90:
-                    corrected_component_placements[id]['placement'][3] = -90
+def component_sides(document, row, string_metadata, cell_types):
+    long_sides, short_sides = component_sides_batch(document, [row], string_metadata, cell_types)
+    return long_sides[0], short_sides[0]
+
+def component_sides_batch(document, rows, string_metadata, cell_types):
+    """
+    Long and short side of every placement in `rows`, looked up once per distinct component name.
+
+    :return: Two float arrays aligned with `rows`
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    # The component type decides the formula, so look up each distinct (name, is string) pair once
+    is_string = document.placements['type'][rows] == document.type_index('string')
+    keys, inverse = np.unique(document.placements['name'][rows].astype(np.int64) * 2 + is_string, return_inverse=True)
+    long_sides = np.empty(len(keys))
+    short_sides = np.empty(len(keys))
+    for i, key in enumerate(keys.tolist()):
+        name = document.names[key // 2]
+        if key % 2:
+            metadata = string_metadata[name]
+            cell_type = cell_types[metadata['cell_type']]
+            long_sides[i] = cell_type[0]
+            short_sides[i] = metadata['nr_cells'] * cell_type[1] + (metadata['nr_cells']-1) * metadata['dist']
+        else:
+            long_sides[i] = np.max(document.outline(name))
+            short_sides[i] = 5
+    return long_sides[inverse], short_sides[inverse]
+
+def flip_offsets(rotation, long_sides, short_sides):
+    # Shift the origin to the opposite corner, so the component keeps its footprint after a 180 degree turn
+    conditions = [rotation == 0, rotation == 90, rotation == 180, (rotation == 270) | (rotation == -90)]
+    dx = np.select(conditions, [long_sides, -short_sides, -long_sides, short_sides], 0.0)
+    dy = np.select(conditions, [short_sides, long_sides, -short_sides, -long_sides], 0.0)
+    return dx, dy
+
+def rotate_batch(document, ids, prev_angles, target_angles, string_metadata, cell_types):
+    """
+    Rotate many placements at once. Every placement is turned back to 0 degrees from its previous angle
+    and then to its target angle, flipping the origin where the turn passes through 180 degrees.
+
+    :param ids: Component ids of the placements to rotate
+    :param prev_angles: Angle each placement was set to before (0, 90, 180, 270 or -90)
+    :param target_angles: Angle each placement should end up at
+    """
+    rows = np.array([document.row(id) for id in ids], dtype=np.intp)
+    prev = np.asarray(prev_angles, dtype=np.float64)
+    target = np.asarray(target_angles, dtype=np.float64)
+    changed = prev != target
+    rows, prev, target = rows[changed], prev[changed], target[changed]
+    if len(rows) == 0:
+        return
+
+    placements = document.placements
+    x = placements['x'][rows]
+    y = placements['y'][rows]
+    rotation = placements['rotation'][rows]
+    prev_angle = np.where(prev == -90, 270, prev)
+    target_angle = np.where(target == -90, 270, target)
+
+    # Only placements that pass through 180 degrees need their sides
+    needs_flip = np.isin(prev_angle, (180, 270)) | np.isin(target_angle, (180, 270))
+    long_sides = np.zeros(len(rows))
+    short_sides = np.zeros(len(rows))
+    if needs_flip.any():
+        long_sides[needs_flip], short_sides[needs_flip] = component_sides_batch(document, rows[needs_flip], string_metadata, cell_types)
+
+    # Rotate back to 0
+    rotation[prev_angle == 90] -= 90
+    flip = np.isin(prev_angle, (180, 270))
+    dx, dy = flip_offsets(rotation, long_sides, short_sides)
+    x[flip] += dx[flip]
+    y[flip] += dy[flip]
+    rotation[flip] = (rotation[flip] - 180) % 360
+    rotation[prev_angle == 270] -= 90
+
+    # Rotate to the target angle
+    rotation[np.isin(target_angle, (90, 270))] += 90
+    flip = np.isin(target_angle, (180, 270))
+    dx, dy = flip_offsets(rotation, long_sides, short_sides)
+    x[flip] += dx[flip]
+    y[flip] += dy[flip]
+    rotation[flip] = (rotation[flip] + 180) % 360
+    rotation[target == -90] = -90
+
+    placements['x'][rows] = x
+    placements['y'][rows] = y
+    placements['rotation'][rows] = rotation
+    document.touch(rows)
+
+def rotate(document, w_sbar_prev, w_sbar, w_string_prev, w_string, string_metadata, cell_types):
+    # Busbars rotate every placement that uses the busbar name
+    sbar_rows = np.sort(np.concatenate([document.rows_named(sbar) for sbar in w_sbar] + [np.empty(0, dtype=np.intp)]))
+    sbar_names = [document.placement_name(row) for row in sbar_rows]
+    rotate_batch(document, document.placements['id'][sbar_rows], [w_sbar_prev[sbar][0] for sbar in sbar_names],
+                 [w_sbar[sbar] for sbar in sbar_names], string_metadata, cell_types)
+
+    ids = list(w_string)
+    rotate_batch(document, ids, [w_string_prev[id][0] for id in ids], [w_string[id] for id in ids], string_metadata, cell_types)
     return
 
-def autogenerate_string_coordinates(offset_x, offset_y, offset_between, corrected_component_placements, string_metadata, cell_types, strings_to_autogenerate):
+def autogenerate_string_coordinates(offset_x, offset_y, offset_between, document, string_metadata, cell_types, strings_to_autogenerate):
 
     # Build the processing list
     if strings_to_autogenerate is None:
-        # All string components (preserves dict iteration order)
-        ids_to_process = [
-            cid for cid, pl in corrected_component_placements.items()
-            if pl.get("component_type") == "string"
-        ]
+        # All string components (preserves placement order)
+        rows_to_process = document.rows_of_type('string').tolist()
     else:
         # Only requested IDs, preserve the requested order
-        ids_to_process = [
-            cid for cid in strings_to_autogenerate
-            if corrected_component_placements.get(cid, {}).get("component_type") == "string"
+        rows_to_process = [
+            document.row(cid) for cid in strings_to_autogenerate
+            if cid in document and document.placement_type(document.row(cid)) == "string"
         ]
 
     counter = 1
-    for id in ids_to_process:
-        string_width = cell_types[string_metadata[corrected_component_placements[id]['name']]['cell_type']][0]
-        string_length = string_metadata[corrected_component_placements[id]['name']]['nr_cells'] * cell_types[string_metadata[corrected_component_placements[id]['name']]['cell_type']][1] + (string_metadata[corrected_component_placements[id]['name']]['nr_cells']-1) * string_metadata[corrected_component_placements[id]['name']]['dist']
-        corrected_component_placements[id]["placement"][0] = -offset_x - counter*string_width - (counter-1)*offset_between
-        corrected_component_placements[id]["placement"][1] = -offset_y - string_length
+    for row in rows_to_process:
+        string_width, string_length = component_sides(document, row, string_metadata, cell_types)
+        document.placements['x'][row] = -offset_x - counter*string_width - (counter-1)*offset_between
+        document.placements['y'][row] = -offset_y - string_length
+        document.touch(row)
         counter += 1
 
-def regenerate_idf_file_content(file_path, corrected_component_outlines, corrected_component_placements):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    new_lines = ''
-    for i in range(len(lines)):
-        if i < 12:
-            new_lines += f'{lines[i]}'
-
-    new_lines += '.PLACEMENT' + '\n'
-    for component_id, component_placement in corrected_component_placements.items():
-        if component_placement['component_type'] == 'string':
-            new_lines += f'"{component_placement["name"]}" "{component_placement["component_type"]}" {component_id}\n'
-            new_lines += f'{component_placement["placement"][0]} {component_placement["placement"][1]} {component_placement["placement"][2]} {component_placement["placement"][3]} TOP PLACED\n'
-    for component_id, component_placement in corrected_component_placements.items():
-        if component_placement['component_type'] == 'busbar':
-            new_lines += f'"{component_placement["name"]}" "{component_placement["component_type"]}" {component_id}\n'
-            new_lines += f'{component_placement["placement"][0]} {component_placement["placement"][1]} {component_placement["placement"][2]} {component_placement["placement"][3]} TOP PLACED\n'
-    new_lines += '.END_PLACEMENT' + '\n'
-
-    for component_id, corrected_component_outline in corrected_component_outlines.items():
-        if corrected_component_outline['component_type'] == 'busbar':
-            new_lines += '.MECHANICAL' + '\n'
-            new_lines += f'"{component_id}" "{corrected_component_outline["component_type"]}" MM {corrected_component_outline["height"]}\n'
-            for coordinate in corrected_component_outline['coordinates']:
-                new_lines += f'0 {coordinate[0]} {coordinate[1]} {coordinate[2]}\n'
-            new_lines += '.END_MECHANICAL' + '\n'
-    for component_id, corrected_component_outline in corrected_component_outlines.items():
-        names = []
-        for _, placement in corrected_component_placements.items():
-            names += [placement['name']]
-        if corrected_component_outline["component_type"] == "string" and component_id in names:
-            new_lines += '.MECHANICAL' + '\n'
-            new_lines += f'"{component_id}" "{corrected_component_outline["component_type"]}" MM {corrected_component_outline["height"]}\n'
-            for coordinate in corrected_component_outline['coordinates']:
-                new_lines += f'0 {coordinate[0]} {coordinate[1]} {coordinate[2]}\n'
-            new_lines += '.END_MECHANICAL' + '\n'
-    return new_lines
+def render_placement(document, row):
+    component_id, name_index, type_index, x, y, z, rotation = document.placements[row].item()
+    return f'"{document.names[name_index]}" "{document.types[type_index]}" {component_id}\n{x} {y} {z} {rotation} TOP PLACED\n'
+
+def render_outline(document, name_index):
+    name = document.names[name_index]
+    start, stop = document.offsets[name_index]
+    lines = [f'.MECHANICAL\n"{name}" "{document.types[document.outline_types[name_index]]}" MM {document.heights[name_index]}\n']
+    lines += [f'0 {x} {y} {z}\n' for x, y, z in document.vertices[start:stop].tolist()]
+    lines.append('.END_MECHANICAL\n')
+    return ''.join(lines)
+
+def source_text(document, start, stop):
+    """ Text of the byte range `start` to `stop` of the source of a document, with \\n line ends like rendered records. """
+    return bytes(document.source[start:stop]).decode('utf-8').replace('\r\n', '\n')
+
+def placement_record(document, row):
+    """ IDF text of a placement: its original text while it is unchanged, else rendered (and cached). """
+    text = document.placement_text[row]
+    if text is SOURCE_TEXT:
+        return source_text(document, *document.placement_spans[row].tolist())
+    if text is None:
+        text = document.placement_text[row] = render_placement(document, row)
+    return text
+
+def outline_record(document, name_index):
+    """ IDF text of an outline: its original .MECHANICAL section while it is unchanged, else rendered (and cached). """
+    text = document.outline_text[name_index]
+    if text is SOURCE_TEXT:
+        return source_text(document, *document.outline_spans[name_index].tolist())
+    if text is None:
+        text = document.outline_text[name_index] = render_outline(document, name_index)
+    return text
+
+def written_outlines(document):
+    """ Indexes of the outlines an export writes, in order: busbars, the strings that are placed, then any other type. """
+    placed = np.zeros(len(document.names), dtype=bool)
+    placed[document.placements['name']] = True
+    busbar, string = document.type_index('busbar'), document.type_index('string')
+    return ([index for index in document.outline_order if document.outline_types[index] == busbar] +
+            [index for index in document.outline_order if document.outline_types[index] == string and placed[index]] +
+            [index for index in document.outline_order if document.outline_types[index] not in (busbar, string)])
+
+def iter_placement_records(document):
+    """
+    The placement records in export order (strings, busbars, then any other type). Unchanged records that
+    follow each other in the source come out as one piece of it.
+    """
+    component_types = ['string', 'busbar'] + [component_type for component_type in document.types if component_type not in ('string', 'busbar')]
+    order = np.concatenate([document.rows_of_type(component_type) for component_type in component_types])
+    if len(order) == 0:
+        return
+    unchanged = np.array([text is SOURCE_TEXT for text in document.placement_text], dtype=bool)[order]
+    spans = document.placement_spans[order]
+    # A piece ends at a changed record, and where the next record doesn't start where the previous one stopped
+    breaks = ~unchanged | np.append(True, ~unchanged[:-1] | (spans[1:, 0] != spans[:-1, 1]))
+    firsts = np.flatnonzero(breaks)
+    for first, stop in zip(firsts.tolist(), np.append(firsts[1:], len(order)).tolist()):
+        if unchanged[first]:
+            yield source_text(document, int(spans[first, 0]), int(spans[stop - 1, 1]))
+        else:
+            yield placement_record(document, int(order[first]))
 
+def iter_sections(document):
+    """
+    Render a document that was read from a source section by section. Sections the document doesn't model
+    (the header, the board outline, drilled holes, notes, ...) and unchanged records are copied from the
+    source, only the changed placements and outlines are rendered again.
+    """
+    sections = [tuple(section) for section in document.sections]
+    keywords = [keyword for keyword, _, _, _ in sections]
+    # Without a .PLACEMENT section in the source, it goes before the first .MECHANICAL section; new outlines
+    # go after the last one, both at the end when there is none
+    placement_at = keywords.index('.PLACEMENT') if '.PLACEMENT' in keywords else keywords.index('.MECHANICAL') if '.MECHANICAL' in keywords else len(sections)
+    outlines_at = len(keywords) - keywords[::-1].index('.MECHANICAL') if '.MECHANICAL' in keywords else max(placement_at, len(sections))
+
+    written = written_outlines(document)
+    remaining = set(written)
+
+    def new_outlines():
+        for index in written:
+            if index in remaining:
+                yield outline_record(document, index)
+        remaining.clear()
+
+    for i, (keyword, start, stop, name) in enumerate(sections + [(None, 0, 0, None)]):
+        if i == outlines_at and keyword == '.PLACEMENT':
+            yield from new_outlines()
+        if i == placement_at:
+            if keyword == '.PLACEMENT':
+                body_start, body_stop = section_body(document.source, start, stop)
+                yield source_text(document, start, body_start)
+                yield from iter_placement_records(document)
+                yield source_text(document, body_stop, stop)
+                continue
+            if len(document.placements):
+                yield '.PLACEMENT\n'
+                yield from iter_placement_records(document)
+                yield '.END_PLACEMENT\n'
+        if i == outlines_at:
+            yield from new_outlines()
+        if keyword == '.MECHANICAL' and name is not None:
+            # An outline is written where it was, or dropped when it was removed. A name repeated in the
+            # source is written once, with the outline of its last block
+            if document.has_outline(name) and document.name_index(name) in remaining:
+                remaining.discard(document.name_index(name))
+                yield outline_record(document, document.name_index(name))
+            continue
+        if stop > start:
+            yield source_text(document, start, stop)
+
+def iter_idf_file_content(document):
+    """
+    Render the document as IDF text, one record at a time. Records are rendered once and cached in the
+    document, so only the placements and outlines that changed since the last call are rendered again.
+    """
+    if document.sections is not None:
+        # A rendered record must not continue a source line that had no line end (e.g. at the end of the file)
+        line_open = False
+        for text in iter_sections(document):
+            if text:
+                if line_open and not text.startswith('\n'):
+                    yield '\n'
+                yield text
+                line_open = not text.endswith('\n')
+        return
+
+    # Documents built from records only have the first 12 lines of their file
+    yield document.header
+    yield '.PLACEMENT\n'
+    yield from iter_placement_records(document)
+    yield '.END_PLACEMENT\n'
+    for index in written_outlines(document):
+        yield outline_record(document, index)
+
+def regenerate_idf_file_content(document):
+    return ''.join(iter_idf_file_content(document))
 
 import numpy as np
 
-def add_components(form_data, corrected_component_outlines, corrected_component_placements, w_sbar, z_sbar, w_string, sbars, strings):
+def add_components(form_data, document, w_sbar, z_sbar, w_string, sbars, strings):
     # Initialize sbar_checkboxes
     if form_data.get('new_sbar_name_dyn') is not None:
         for sbar in form_data.getlist('sbars'):
@@ -374,164 +698,117 @@ def add_components(form_data, corrected_component_outlines, corrected_component_
         new_outline_width = form_data.get('new_outline_width_dyn')
         new_sbar_data = (new_sbar_name, 0.0, False, float(new_placement_x), float(new_placement_y), float(new_placement_z), float(new_outline_height), float(new_outline_width))
         sbars.append(new_sbar_name)
-        add_busbar(corrected_component_outlines, corrected_component_placements, w_sbar, z_sbar, new_sbar_data)
+        add_busbar(document, w_sbar, z_sbar, new_sbar_data)
 
     if form_data.get('new_string_name_dyn') is not None:
         new_placement_x = form_data.get('new_placement_x_dyn')
         new_placement_y = form_data.get('new_placement_y_dyn')
         new_placement_z = form_data.get('new_placement_z_dyn')
         new_string_data = (0.0, float(new_placement_x), float(new_placement_y), float(new_placement_z), 182.00, 1000.00)
-        add_string(corrected_component_placements, w_string, new_string_data, strings)
+        add_string(document, w_string, new_string_data, strings)
     return
 
-def add_busbar(corrected_component_outlines, corrected_component_placements, w_sbar, z_sbar, new_sbar_data):
+def add_busbar(document, w_sbar, z_sbar, new_sbar_data):
     new_sbar_name, new_sbar180deg, new_sbarheight, new_placement_x, new_placement_y, new_placement_z, new_outline_height, new_outline_width = new_sbar_data
     outline = [[0.0, 0.0, 0.0], [float(new_outline_height), 0.0, 0.0], [float(new_outline_height), float(new_outline_width), 0.0], [0.0, float(new_outline_width), 0.0], [0.0, 0.0, 0.0]]
     placement = [float(new_placement_x), float(new_placement_y), float(new_placement_z), 0.0]
 
-    bb_keys = [key for key in corrected_component_placements.keys() if key.startswith('BB')]
-
-    if bb_keys:
-        max_index = max(int(key[2:]) for key in bb_keys)
-    else:
-        max_index = 0
-
-    new_index = max_index + 1
-    new_id = f'BB{new_index:03}'
+    new_id = document.next_id('BB')
 
-    corrected_component_outlines[new_sbar_name] = {'component_type': 'busbar', 'height': new_sbarheight, 'coordinates': np.array(outline)}
-    corrected_component_placements[new_id] = {'name': new_sbar_name, 'component_type': 'busbar', 'placement': placement}
+    document.set_outline(new_sbar_name, 'busbar', new_sbarheight, outline)
+    document.add_placement(new_id, new_sbar_name, 'busbar', placement)
     w_sbar[new_sbar_name] = new_sbar180deg
     z_sbar[new_sbar_name] = new_sbarheight
 
-def add_string(corrected_component_placements, w_string, new_string_data, strings):
+def add_string(document, w_string, new_string_data, strings):
     print("Adding string")
     new_string180deg, new_placement_x, new_placement_y, new_placement_z, _, _ = new_string_data
     placement = [float(new_placement_x), float(new_placement_y), float(new_placement_z), 0.0]
 
-    str_keys = [key for key in corrected_component_placements.keys() if re.match(r'STR\d{3}', key)]
-
-    if not str_keys:
-        next_str_key = 'STR000'
-    else:
-        max_num = max(int(key[3:]) for key in str_keys)
-        next_num = max_num + 1
-        next_str_key = f'STR{next_num:03}'
+    next_str_key = document.next_id('STR', first=0, min_digits=3)
 
-    corrected_component_placements[next_str_key] = {'name': strings[0], 'component_type': 'string', 'placement': placement}
+    document.add_placement(next_str_key, strings[0], 'string', placement)
     w_string[next_str_key] = new_string180deg
 
-def change_string_names(corrected_component_placements, corrected_component_outlines, new_string_names, strings):
+def change_string_names(document, new_string_names, strings):
     for string_name, new_string_name in new_string_names.items():
-        ids = []
         if new_string_name != '':
-            for id, placement in corrected_component_placements.items():
-                if placement['name'] == string_name:
-                    ids.append(id)
-            for id in ids:
-                corrected_component_placements[id]['name'] = new_string_name
-            if string_name in corrected_component_outlines:
-                corrected_component_outlines[new_string_name] = corrected_component_outlines.pop(string_name)
+            document.rename_placements(document.rows_named(string_name), new_string_name)
+            if document.has_outline(string_name):
+                document.rename_outline(string_name, new_string_name)
             if string_name in strings:
                 strings[strings.index(string_name)] = new_string_name
     return
 
-def insert_at_index(d, key, value, index):
-    """
-    Insert a key-value pair at a specific index in a dictionary.
-
-    :param d: The original dictionary
-    :param key: The key to insert
-    :param value: The value to insert
-    :param index: The index at which to insert the key-value pair
-    :return: A new dictionary with the key-value pair inserted at the specified index
-    """
-    new_dict = {}
-
-    if index is None:
-        index = 999
-
-    for i, (k, v) in enumerate(d.items()):
-        if i == index:
-            new_dict[key] = value
-        new_dict[k] = v
 
+def outline_blocks(xs, ys):
+    """ Interleave point sequences: row k of the result is (xs[k % n][k // n], ys[k % n][k // n]) for n = len(xs). """
+    count = next(np.size(values) for values in xs + ys if np.ndim(values))
+    block = np.empty((count, len(xs), 2))
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        block[:, i, 0] = x
+        block[:, i, 1] = y
+    return block.reshape(-1, 2)
 
-    if index >= len(d):
-        new_dict[key] = value
-
-    return new_dict
-
-
-def generate_string_outline(cell_type, nr_cells, dist, plus, minus, corrected_component_outlines, cell_name, cell_types, index):
-    outline = []
-    outline.append([cell_types[cell_type][0], 0, 0])
-    for i in range(nr_cells-1):
-        outline.append([cell_types[cell_type][0], (i+1)*cell_types[cell_type][1] + i*dist, 0],)
-        outline.append([cell_types[cell_type][0] - cell_types[cell_type][3], (i+1)*cell_types[cell_type][1] + i*dist, 0],)
-        outline.append([cell_types[cell_type][0] - cell_types[cell_type][3], (i+1)*cell_types[cell_type][1] + (i + 1)*dist, 0],)
-        outline.append([cell_types[cell_type][0], (i+1)*cell_types[cell_type][1] + (i + 1)*dist, 0],)
-    outline.append([cell_types[cell_type][0], nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist, 0],)
-
-    ribbon_to_ribbon = (cell_types[cell_type][0] - (2*cell_types[cell_type][3] + 0.2) ) / (cell_types[cell_type][2]-1)
-
-    outline.append([cell_types[cell_type][0] - cell_types[cell_type][3], nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist, 0],)
-    outline.append([cell_types[cell_type][0] - cell_types[cell_type][3], nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist + plus, 0],)
-    outline.append([cell_types[cell_type][0] - cell_types[cell_type][3] - 0.1, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist + plus, 0],)
-    outline.append([cell_types[cell_type][0] - cell_types[cell_type][3] - 0.1, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist, 0],)
-
-    for i in range(cell_types[cell_type][2]-1):
-        outline.append([cell_types[cell_type][0] - cell_types[cell_type][3] - (i+1)*0.1 - (i+1)*ribbon_to_ribbon, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist, 0],)
-        outline.append([cell_types[cell_type][0] - cell_types[cell_type][3] - (i+1)*0.1 - (i+1)*ribbon_to_ribbon, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist + plus, 0],)
-        outline.append([cell_types[cell_type][0] - cell_types[cell_type][3] - (i+2)*0.1 - (i+1)*ribbon_to_ribbon, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist + plus, 0],)
-        outline.append([cell_types[cell_type][0] - cell_types[cell_type][3] - (i+2)*0.1 - (i+1)*ribbon_to_ribbon, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist, 0],)
-    outline.append([0, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist, 0],)
-
-    for i in range(nr_cells-1):
-        outline.append([0, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist - (i+1)*cell_types[cell_type][1] - i*dist, 0],)
-        outline.append([cell_types[cell_type][3], nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist - (i+1)*cell_types[cell_type][1] - i*dist, 0],)
-        outline.append([cell_types[cell_type][3], nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist - (i+1)*cell_types[cell_type][1] - (i+1)*dist, 0],)
-        outline.append([0, nr_cells*cell_types[cell_type][1] + (nr_cells-1)*dist - (i+1)*cell_types[cell_type][1] - (i+1)*dist, 0],)
-    outline.append([0, 0, 0],)
-
-    outline.append([13.1, 0, 0],)
-    outline.append([13.1, -minus, 0],)
-    outline.append([13.2, -minus, 0],)
-    outline.append([13.2, 0, 0],)
-    for i in range(cell_types[cell_type][2]-1):
-        outline.append([13.2 + i*0.1 + (i+1)*ribbon_to_ribbon, 0, 0],)
-        outline.append([13.2 + i*0.1 + (i+1)*ribbon_to_ribbon, -minus, 0],)
-        outline.append([13.2 + (i+1)*0.1 + (i+1)*ribbon_to_ribbon, -minus, 0],)
-        outline.append([13.2 + (i+1)*0.1 + (i+1)*ribbon_to_ribbon, 0, 0],)
-    outline.append([cell_types[cell_type][0], 0, 0],)
-
-    outline = np.array(outline)
-
-    outline = np.around(outline, decimals=3)
-    new_dict = insert_at_index(corrected_component_outlines, cell_name, {'component_type': 'string', 'height': '1', 'coordinates': outline}, index)
-    corrected_component_outlines = new_dict
-    return corrected_component_outlines
-
-def reverse_engineer_string_outline(outline, cell_types):
-
-    def count_nr_cells(values, high, low):
-        oscillation_pattern = [high, high, low, low]
-        pattern_length = len(oscillation_pattern)
-        count = 0
-        i = 0
+@functools.lru_cache(maxsize=256)
+def string_outline(cell_type, nr_cells, dist, plus, minus):
+    """
+    Outline vertices of a string, built as NumPy blocks. Cached, so the same parameters give the same shared
+    read-only array.
 
-        while i <= len(values) - pattern_length:
-            if np.all(values[i:i + pattern_length] == oscillation_pattern):
-                count += 1
-                i += pattern_length
-            else:
-                i += 1
+    :param cell_type: Tuple (long side, short side, number of ribbons, ribbon offset), a CELL_TYPES entry
+    """
+    long_side, short_side, ribbons, offset = cell_type
+    top = nr_cells*short_side + (nr_cells-1)*dist
+    ribbon_to_ribbon = (long_side - (2*offset + 0.2) ) / (ribbons-1)
+    cells = np.arange(nr_cells - 1, dtype=np.float64)
+    gaps = np.arange(ribbons - 1, dtype=np.float64)
+
+    parts = [
+        [[long_side, 0]],
+        # Cell gaps along the right side
+        outline_blocks([long_side, long_side - offset, long_side - offset, long_side],
+                       [(cells+1)*short_side + cells*dist] * 2 + [(cells+1)*short_side + (cells+1)*dist] * 2),
+        [[long_side, top], [long_side - offset, top], [long_side - offset, top + plus], [long_side - offset - 0.1, top + plus], [long_side - offset - 0.1, top]],
+        # Ribbons at the top
+        outline_blocks([long_side - offset - (gaps+1)*0.1 - (gaps+1)*ribbon_to_ribbon] * 2 + [long_side - offset - (gaps+2)*0.1 - (gaps+1)*ribbon_to_ribbon] * 2,
+                       [top, top + plus, top + plus, top]),
+        [[0, top]],
+        # Cell gaps along the left side
+        outline_blocks([0, offset, offset, 0],
+                       [top - (cells+1)*short_side - cells*dist] * 2 + [top - (cells+1)*short_side - (cells+1)*dist] * 2),
+        [[0, 0], [13.1, 0], [13.1, -minus], [13.2, -minus], [13.2, 0]],
+        # Ribbons at the bottom
+        outline_blocks([13.2 + gaps*0.1 + (gaps+1)*ribbon_to_ribbon] * 2 + [13.2 + (gaps+1)*0.1 + (gaps+1)*ribbon_to_ribbon] * 2,
+                       [0, -minus, -minus, 0]),
+        [[long_side, 0]],
+    ]
+    points = np.concatenate([np.asarray(part, dtype=np.float64).reshape(-1, 2) for part in parts])
+    outline = np.around(np.column_stack([points, np.zeros(len(points))]), decimals=3)
+    outline.setflags(write=False)
+    return outline
+
+def generate_string_outline(cell_type, nr_cells, dist, plus, minus, document, cell_name, cell_types, index):
+    outline = string_outline(tuple(cell_types[cell_type]), nr_cells, dist, plus, minus)
+    document.set_outline(cell_name, 'string', '1', outline, index)
+    return
 
-        return count
+def count_nr_cells(values, high, low):
+    """ Number of non-overlapping high, high, low, low runs in `values`, found with shifted comparisons. """
+    starts = np.flatnonzero((values[:-3] == high) & (values[1:-2] == high) & (values[2:-1] == low) & (values[3:] == low))
+    # Runs can only overlap when high equals low, count them greedily from the left like a sliding window would
+    count = 0
+    next_start = 0
+    for start in starts.tolist():
+        if start >= next_start:
+            count += 1
+            next_start = start + 4
+    return count
 
-    outline = np.array(outline)
+def infer_string_metadata(outline, cell_types):
+    outline = np.asarray(outline, dtype=np.float64)
 
-    calculated_minus = float(np.abs(np.min(outline.flatten())))
+    calculated_minus = float(np.abs(np.min(outline)))
 
     calculated_dist = float(outline[3, 1] - outline[2, 1])
 
@@ -542,20 +819,310 @@ def reverse_engineer_string_outline(outline, cell_types):
     else:
         calculated_cell_type = 'G1'
 
-    calculated_nr_cells = count_nr_cells(outline[:, 0], cell_types[calculated_cell_type][0], cell_types[calculated_cell_type][0]-cell_types[calculated_cell_type][3])
+    cell_type = cell_types[calculated_cell_type]
+    calculated_nr_cells = count_nr_cells(outline[:, 0], cell_type[0], cell_type[0]-cell_type[3])
 
-    calculated_plus = float(np.max(outline.flatten()) - (calculated_nr_cells * cell_types[calculated_cell_type][1] + (calculated_nr_cells-1)*calculated_dist))
+    calculated_plus = float(np.max(outline) - (calculated_nr_cells * cell_type[1] + (calculated_nr_cells-1)*calculated_dist))
 
     return calculated_dist, calculated_cell_type, calculated_nr_cells, calculated_plus, calculated_minus
 
-def change_sbar_height(corrected_component_outlines, z_sbar):
+# Inferred string metadata by outline fingerprint, in least recently used order
+STRING_METADATA_CACHE_SIZE = 4096
+_string_metadata_cache = OrderedDict()
+_string_metadata_lock = threading.Lock()
+
+def outline_fingerprint(outline, cell_types):
+    """ Digest of the outline vertices and the cell types they are interpreted with. """
+    digest = hashlib.blake2b(np.ascontiguousarray(outline, dtype=np.float64).tobytes(), digest_size=16)
+    digest.update(repr(sorted((name, list(entry)) for name, entry in cell_types.items())).encode())
+    return digest.digest()
+
+def reverse_engineer_string_outline(outline, cell_types):
+    """
+    Dist, cell type, number of cells, plus and minus of a string outline. Results are cached by the outline
+    fingerprint, so only outlines that were (re)generated since they were last seen are analysed.
+    """
+    key = outline_fingerprint(outline, cell_types)
+    with _string_metadata_lock:
+        if key in _string_metadata_cache:
+            _string_metadata_cache.move_to_end(key)
+            return _string_metadata_cache[key]
+    metadata = infer_string_metadata(outline, cell_types)
+    with _string_metadata_lock:
+        _string_metadata_cache[key] = metadata
+        while len(_string_metadata_cache) > STRING_METADATA_CACHE_SIZE:
+            _string_metadata_cache.popitem(last=False)
+    return metadata
+
+def change_sbar_height(document, z_sbar):
     for sbar, height in z_sbar.items():
         if height:
-            corrected_component_outlines[sbar]['height'] = "2.3"
+            document.set_outline_height(sbar, "2.3")
         else:
-            corrected_component_outlines[sbar]['height'] = "0.3"
+            document.set_outline_height(sbar, "0.3")
     return
 
-def export(filename, output_file_path, new_lines):
-    with open(output_file_path, 'w') as outfile:
-        outfile.write(new_lines)
+ANGLES = (0, 90, 180, 270, -90)
+
+def apply_operations(document, operations, w_sbar, z_sbar, w_string, w_sbar_prev, w_string_prev, sbars, strings, string_metadata, cell_types):
+    """
+    Apply edit operations in order, touching only the components they name. Examples:
+
+        {"op": "move", "id": "STR001", "x": 10.0, "y": -20.0}        # x, y and z are optional
+        {"op": "rotate", "id": "STR001", "angle": 180}               # a string placement
+        {"op": "rotate", "name": "sbar_001", "angle": 90}            # every placement of a busbar
+        {"op": "resize", "name": "sbar_001", "length": 150.0, "width": 5.0}
+        {"op": "rename", "name": "String M10 HC 5 Cells 2mm +10mm -10mm", "new_name": "String A"}
+        {"op": "add", "type": "busbar", "name": "sbar_002", "x": 0, "y": 0, "z": 0, "length": 100, "width": 5}
+        {"op": "add", "type": "string", "name": "String A", "x": 0, "y": 0, "z": 0}
+        {"op": "remove", "id": "STR001"} or {"op": "remove", "name": "sbar_001"}
+
+    :return: Ids of the placements and names of the outlines that were changed, added or removed
+    """
+    changes = {'placements': set(), 'outlines': set()}
+    for i, operation in enumerate(operations):
+        try:
+            op = operation['op']
+            if op == 'move':
+                id = operation['id']
+                row = document.row(id)
+                for column in ('x', 'y', 'z'):
+                    if column in operation:
+                        document.placements[column][row] = float(operation[column])
+                document.touch(row)
+                changes['placements'].add(id)
+
+            elif op == 'rotate':
+                angle = float(operation['angle'])
+                if angle not in ANGLES:
+                    raise ValueError(f"angle must be one of {ANGLES}")
+                # Rotations are relative to the angle the component was last set to, like the form
+                if 'id' in operation:
+                    id = operation['id']
+                    rotate_batch(document, [id], [w_string_prev[id][-1]], [angle], string_metadata, cell_types)
+                    w_string[id] = float(document.placements['rotation'][document.row(id)])
+                    w_string_prev[id] = [angle, angle]
+                    changes['placements'].add(id)
+                else:
+                    name = operation['name']
+                    ids = document.placements['id'][document.rows_named(name)].tolist()
+                    rotate_batch(document, ids, [w_sbar_prev[name][-1]] * len(ids), [angle] * len(ids), string_metadata, cell_types)
+                    w_sbar[name] = float(document.placements['rotation'][document.row(ids[0])])
+                    w_sbar_prev[name] = [angle, angle]
+                    changes['placements'].update(ids)
+
+            elif op == 'resize':
+                name = operation['name']
+                if name not in sbars:
+                    raise KeyError(name)
+                coordinates = document.outline(name)
+                # Only a closed ring of 4 axis-aligned corners can be resized by moving its sides
+                low, high = coordinates[:, :2].min(axis=0), coordinates[:, :2].max(axis=0)
+                on_high = coordinates[:, :2] == high
+                if (len(coordinates) != 5 or not np.array_equal(coordinates[0], coordinates[-1]) or (low == high).any()
+                        or not ((coordinates[:, :2] == low) | on_high).all() or len(np.unique(coordinates[:-1, :2], axis=0)) != 4):
+                    raise ValueError(f"{name!r} is not a rectangle")
+                # Length and width are the sides along x and y, the corner with the lowest x and y stays in place
+                sizes = {axis: float(operation[key]) for axis, key in ((0, 'length'), (1, 'width')) if key in operation}
+                if not all(size > 0 for size in sizes.values()):
+                    raise ValueError("length and width must be positive")
+                for axis, size in sizes.items():
+                    coordinates[on_high[:, axis], axis] = low[axis] + size
+                document.touch_outline(name)
+                changes['outlines'].add(name)
+
+            elif op == 'rename':
+                name, new_name = operation['name'], operation['new_name']
+                if name not in strings:
+                    raise KeyError(name)
+                if new_name == '' or document.has_outline(new_name):
+                    raise ValueError(f"invalid new name {new_name!r}")
+                change_string_names(document, {name: new_name}, strings)
+                string_metadata[new_name] = string_metadata.pop(name)
+                changes['placements'].update(document.placements['id'][document.rows_named(new_name)].tolist())
+                changes['outlines'].update((name, new_name))
+
+            elif op == 'add':
+                x, y, z = float(operation.get('x', 0.0)), float(operation.get('y', 0.0)), float(operation.get('z', 0.0))
+                if operation['type'] == 'busbar':
+                    name = operation['name']
+                    if document.has_outline(name):
+                        raise ValueError(f"{name!r} already exists")
+                    add_busbar(document, w_sbar, z_sbar, (name, 0.0, False, x, y, z, float(operation['length']), float(operation['width'])))
+                    change_sbar_height(document, {name: False})
+                    sbars.append(name)
+                    w_sbar_prev[name] = [0.0, 0.0]
+                    changes['outlines'].add(name)
+                elif operation['type'] == 'string':
+                    name = operation.get('name', strings[0] if strings else None)
+                    if name not in strings:
+                        raise KeyError(name)
+                    add_string(document, w_string, (0.0, x, y, z, 0.0, 0.0), [name])
+                    w_string_prev[str(document.placements['id'][-1])] = [0.0, 0.0]
+                else:
+                    raise ValueError(f"unknown component type {operation['type']!r}")
+                changes['placements'].add(str(document.placements['id'][-1]))
+
+            elif op == 'remove':
+                if 'id' in operation:
+                    id = operation['id']
+                    row = document.row(id)
+                    string_name = document.placement_name(row)
+                    if len(document.rows_named(string_name)) == 1:
+                        document.remove_outline(string_name)
+                        strings.remove(string_name)
+                        string_metadata.pop(string_name, None)
+                        changes['outlines'].add(string_name)
+                    document.remove_placements([row])
+                    del w_string[id]
+                    del w_string_prev[id]
+                    changes['placements'].add(id)
+                else:
+                    name = operation['name']
+                    if name not in sbars:
+                        raise KeyError(name)
+                    rows = document.rows_named(name)
+                    changes['placements'].update(document.placements['id'][rows].tolist())
+                    document.remove_outline(name)
+                    document.remove_placements(rows)
+                    del z_sbar[name]
+                    del w_sbar[name]
+                    w_sbar_prev.pop(name, None)
+                    sbars.remove(name)
+                    changes['outlines'].add(name)
+
+            else:
+                raise ValueError(f"unknown operation {op!r}")
+        except (KeyError, IndexError, TypeError, ValueError) as error:
+            raise ValueError(f"Operation {i}: {type(error).__name__}: {error}") from error
+    return changes
+
+def changed_records(document, changes):
+    """
+    The components named in `changes` as dicts with their rendered IDF records, and the ones that no longer exist.
+    Rendering goes through the record cache of the document, so the next export reuses the text.
+    """
+    placements, outlines = {}, {}
+    for id in sorted(id for id in changes['placements'] if id in document):
+        row = document.row(id)
+        placements[id] = {'name': document.placement_name(row), 'component_type': document.placement_type(row),
+                          'placement': document.placement(row), 'text': placement_record(document, row)}
+    for name in sorted(name for name in changes['outlines'] if document.has_outline(name)):
+        index = document.name_index(name)
+        outlines[name] = {'component_type': document.outline_type(name), 'height': document.outline_height(name),
+                          'coordinates': document.outline(name).tolist(), 'text': outline_record(document, index)}
+    return {
+        'placements': placements,
+        'outlines': outlines,
+        'removed_placements': sorted(id for id in changes['placements'] if id not in document),
+        'removed_outlines': sorted(name for name in changes['outlines'] if not document.has_outline(name)),
+    }
+
+PLACEMENT_SORT_KEYS = ('file', 'id', 'name', 'x', 'y', 'z', 'rotation')
+
+def placement_window(document, component_type, angles, query='', sort='file', descending=False, offset=0, limit=50):
+    """
+    One window of the placements of `component_type` for the component editor: filtered on a substring of
+    their id or name, sorted and sliced, so the page only holds the rows that are visible.
+
+    :param angles: Angle the editor shows per component id, the rotation in the document where it is missing
+    :param sort: One of PLACEMENT_SORT_KEYS, 'file' keeps the order of the placements in the file
+    :return: The number of placements that match and the rows of the window as dicts
+    """
+    rows = document.rows_of_type(component_type)
+    placements = document.placements[rows]
+    names = np.array(document.names, dtype=str)[placements['name']] if len(rows) else np.empty(0, dtype=str)
+    if query:
+        query = query.lower()
+        matches = (np.char.find(np.char.lower(placements['id']), query) >= 0) | (np.char.find(np.char.lower(names), query) >= 0)
+        placements, names = placements[matches], names[matches]
+
+    if sort == 'name':
+        order = np.argsort(names, kind='stable')
+    elif sort != 'file':
+        order = np.argsort(placements[sort], kind='stable')
+    else:
+        order = np.arange(len(placements))
+    if descending:
+        order = order[::-1]
+
+    window = []
+    for i in order[offset:offset + limit].tolist():
+        id, _, _, x, y, z, rotation = placements[i].item()
+        window.append({'id': id, 'name': str(names[i]), 'x': x, 'y': y, 'z': z, 'rotation': angles.get(id, rotation)})
+    return len(placements), window
+
+def export(output_file_path, chunks, chunk_size=64 * 1024):
+    """
+    Write IDF text to `output_file_path` while yielding it as UTF-8 encoded blocks of about `chunk_size` bytes,
+    so a response can stream the file without holding a second copy of it.
+
+    :param chunks: Iterable of text pieces, e.g. iter_idf_file_content(document)
+    """
+    # Written under a temporary name and renamed when complete, other workers may export a file with the same name
+    temporary_path = f'{output_file_path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        with open(temporary_path, 'w') as outfile:
+            block = []
+            size = 0
+            for chunk in chunks:
+                outfile.write(chunk)
+                block.append(chunk)
+                size += len(chunk)
+                if size >= chunk_size:
+                    yield ''.join(block).encode('utf-8')
+                    block = []
+                    size = 0
+            if block:
+                yield ''.join(block).encode('utf-8')
+        os.replace(temporary_path, output_file_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def text_chunks(text, chunk_size=64 * 1024):
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+class _ChunkBuffer(io.RawIOBase):
+    """ Write-only stream that hands out what was written since the last take(). """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def zip_chunks(files):
+    """
+    Stream a zip archive without building it in memory.
+
+    :param files: Iterable of (name in the archive, iterable of bytes)
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in files:
+            with archive.open(name, 'w') as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    data = buffer.take()
+                    if data:
+                        yield data
+    yield buffer.take()
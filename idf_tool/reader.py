@@ -0,0 +1,402 @@
+import io
+import os
+import re
+
+import numpy as np
+
+from idf_tool.document import IdfDocument, map_file
+
+# A dot and a letter as the first non-blank characters make a line a section keyword, e.g. .PLACEMENT
+KEYWORD = re.compile(rb'^[ \t\x0b\x0c\x1c-\x1f]*(\.[A-Za-z\x80-\xff][^ \t\n\r\x0b\x0c\x1c-\x1f]*)', re.M)
+QUOTED_LINE = re.compile(rb'^"[^\n]*', re.M)
+LONE_CR = re.compile(rb'\r(?!\n)')
+
+# Bytes that separate tokens, the ASCII characters str.split() splits on
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[list(b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f')] = True
+
+# Keywords the parser always acts on, they end a section that is missing its .END_ line
+SECTION_STARTS = {'.BOARD_OUTLINE', '.PLACEMENT', '.MECHANICAL'}
+
+# Numeric lines are converted in blocks of about this many bytes, so the temporary arrays stay small
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def read_file(file_path, immutable=False):
+    """
+    Parse an IDF file through a read-only memory map. The document keeps the map as its source, so the text
+    of the file is never copied into Python strings.
+
+    :param immutable: The file never changes (e.g. an upload saved by its hash), so the document can refer to
+                      it by path: stored copies of the document then map the file again instead of holding its bytes
+    """
+    if os.path.getsize(file_path) == 0:
+        return read_buffer(b'')
+    buffer = map_file(file_path)
+    document = read_buffer(buffer)
+    # Old Mac line ends are translated into a copy, which is not the file anymore
+    if immutable and document.source is buffer:
+        document.source_path = os.path.abspath(file_path)
+    return document
+
+def read_buffer(buffer):
+    """
+    Parse IDF text from a bytes-like object (bytes, mmap) without splitting it into lines.
+
+    Section keywords are found with one regular expression over the buffer. The lines in between are
+    tokenized as byte arrays, and the numeric columns of the placement, board outline and mechanical lines
+    are converted to floats in bulk. Only the .MECHANICAL header lines, and placement lines that aren't plain
+    ASCII, are decoded one by one. The result is the same document as a line by line parse.
+    """
+    # Old Mac line ends are rare enough to simply translate
+    if LONE_CR.search(buffer):
+        buffer = LONE_CR.sub(b'\n', buffer)
+    size = len(buffer)
+
+    board = []
+    placement_lines = []
+    mechanical = []
+    outline_headers = []
+
+    # A non-ASCII character after the dot only makes a keyword when it is a letter
+    keywords = [match for match in KEYWORD.finditer(buffer)
+                if match.group(1)[1] < 0x80 or bytes(buffer[match.start():line_end(buffer, match.start())]).decode('utf-8').lstrip()[1:2].isalpha()]
+
+    section = None
+    board_outline_done = False
+    placement_done = False
+    placement_start = None
+    outline_starts = []
+    position = 0
+    for match in keywords + [None]:
+        start = match.start() if match is not None else size
+        if start > position:
+            if section == 'mechanical_header':
+                header_end = line_end(buffer, position)
+                outline_headers.append(bytes(buffer[position:header_end]))
+                outline_starts.append(mechanical_start)
+                mechanical.append((header_end, start, len(outline_headers) - 1))
+                section = 'mechanical'
+            elif section == 'mechanical':
+                mechanical.append((position, start, len(outline_headers) - 1))
+            elif section == 'board_outline':
+                board.append((position, start))
+            elif section == 'placement':
+                placement_lines.append((position, start))
+        if match is None:
+            break
+        position = line_end(buffer, start)
+        keyword = match.group(1).decode('utf-8')
+        if keyword == '.BOARD_OUTLINE' and not board_outline_done:
+            section = 'board_outline'
+        elif keyword == '.END_BOARD_OUTLINE' and section == 'board_outline':
+            board_outline_done = True
+            section = None
+        elif keyword == '.PLACEMENT' and not placement_done:
+            section = 'placement'
+            if placement_start is None:
+                placement_start = start
+        elif keyword == '.END_PLACEMENT' and section == 'placement':
+            placement_done = True
+            section = None
+        elif keyword == '.MECHANICAL':
+            section = 'mechanical_header'
+            mechanical_start = start
+        elif keyword == '.END_MECHANICAL':
+            section = None
+
+    sections = split_sections(buffer, keywords)
+    section_stops = {start: stop for _, start, stop in sections}
+    header = first_lines(buffer, 12)
+
+    # Board outline: the last three numbers of every line with four
+    board_rows, _ = numeric_rows(buffer, board, width=4, first=1, count=3)
+    board_outline = board_rows if len(board_rows) else np.array([])
+
+    # Placements: a quoted line with name, type and id, followed by a line with x, y, z, rotation, side and status
+    data = np.frombuffer(buffer, dtype=np.uint8) if size else np.empty(0, dtype=np.uint8)
+    ids, names, types, starts = placement_records(buffer, data, placement_lines)
+    rows, row_starts = numeric_rows(buffer, placement_lines, width=6, first=0, count=4, skip_quoted=True)
+    coordinates = np.full((len(ids), 4), np.nan)
+    owners = np.searchsorted(starts, row_starts, side='right') - 1
+    # The last coordinate line of a placement wins, lines before the first placement belong to none
+    last = (owners >= 0) & np.append(owners[1:] != owners[:-1], True)
+    coordinates[owners[last]] = rows[last]
+    # The original text of a placement runs from its quoted line to the next one, the first and the last
+    # record also take the rest of the section body, so together they cover it
+    placement_spans = np.full((len(ids), 2), -1, dtype=np.int64)
+    if placement_start is not None:
+        body_start, body_stop = section_body(buffer, placement_start, section_stops[placement_start])
+        inside = np.flatnonzero((starts >= body_start) & (starts < body_stop))
+        if len(inside):
+            placement_spans[inside, 0] = starts[inside]
+            placement_spans[inside, 1] = np.append(starts[inside[1:]], body_stop)
+            placement_spans[inside[0], 0] = body_start
+
+    # Outlines: a header line with name, type and height, then one line per vertex
+    outline_names, outline_types, heights = [], [], []
+    for line in outline_headers:
+        parts = line.decode('utf-8').split('"')
+        outline_names.append(parts[1].strip())
+        outline_types.append(parts[3].strip())
+        heights.append(parts[-1].strip().split()[-1])
+    vertices, vertex_starts = numeric_rows(buffer, [(start, stop) for start, stop, _ in mechanical], width=4, first=1, count=3)
+    blocks = np.array([block for _, _, block in mechanical], dtype=np.int64)
+    block_starts = np.array([start for start, _, _ in mechanical], dtype=np.int64)
+    vertex_blocks = blocks[np.searchsorted(block_starts, vertex_starts, side='right') - 1] if len(vertices) else np.empty(0, dtype=np.int64)
+    counts = np.bincount(vertex_blocks, minlength=len(outline_headers))
+    # The original text of an outline is its whole .MECHANICAL section
+    outline_spans = np.array([(start, section_stops[start]) for start in outline_starts], dtype=np.int64).reshape(-1, 2)
+    section_names = dict(zip(outline_starts, outline_names))
+    sections = [(keyword, start, stop, section_names.get(start) if keyword == '.MECHANICAL' else None) for keyword, start, stop in sections]
+
+    # A repeated id or outline name keeps its first position and its last record, like a dict would
+    _, first = np.unique(ids, return_index=True)
+    if len(first) < len(ids):
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = (len(ids) - 1 - last)[np.argsort(first)]
+        ids, names, types = ids[keep], [names[i] for i in keep], [types[i] for i in keep]
+        coordinates, placement_spans = coordinates[keep], placement_spans[keep]
+    outline_index = dict(zip(outline_names, range(len(outline_names))))
+    if len(outline_index) < len(outline_names):
+        keep = list(outline_index.values())
+        order = np.argsort(vertex_blocks, kind='stable')
+        block_offsets = np.concatenate([[0], np.cumsum(counts)])
+        vertices = vertices[order][np.concatenate([np.arange(block_offsets[i], block_offsets[i + 1]) for i in keep] + [np.empty(0, dtype=np.int64)])]
+        outline_names, outline_types, heights = list(outline_index), [outline_types[i] for i in keep], [heights[i] for i in keep]
+        counts, outline_spans = counts[keep], outline_spans[keep]
+
+    return IdfDocument.from_columns(header, board_outline, ids, names, types, coordinates, outline_names, outline_types,
+                                    heights, vertices, counts, source=buffer, sections=sections,
+                                    placement_spans=placement_spans, outline_spans=outline_spans)
+
+def split_sections(buffer, keywords):
+    """
+    Cut the buffer into sections: from a keyword line to the matching .END_ line, with any text between
+    sections as sections of their own (keyword None). Together they cover the whole buffer, in file order.
+
+    Like in the parser, a .BOARD_OUTLINE, .PLACEMENT or .MECHANICAL line also ends a section that has no
+    .END_ line, and other keyword lines inside a section are part of it.
+
+    :return: List of (keyword, start, stop)
+    """
+    sections = []
+    position = 0
+    open_section = None
+    for match in keywords:
+        keyword = match.group(1).decode('utf-8')
+        start = match.start()
+        if open_section is not None:
+            if keyword == '.END_' + open_section[0][1:]:
+                position = line_end(buffer, start)
+                sections.append((open_section[0], open_section[1], position))
+                open_section = None
+                continue
+            if keyword not in SECTION_STARTS:
+                continue
+            sections.append((open_section[0], open_section[1], start))
+            position = start
+            open_section = None
+        if start > position:
+            sections.append((None, position, start))
+        if keyword.startswith('.END_'):
+            # An .END_ line outside of any section
+            position = line_end(buffer, start)
+            sections.append((keyword, start, position))
+        else:
+            open_section = (keyword, start)
+            position = start
+    if open_section is not None:
+        sections.append((open_section[0], open_section[1], len(buffer)))
+    elif len(buffer) > position:
+        sections.append((None, position, len(buffer)))
+    return sections
+
+def section_body(buffer, start, stop):
+    """ Byte range between the keyword line of a section and its .END_ line (or its end, without one). """
+    body_start = min(line_end(buffer, start), stop)
+    last_line = max(buffer.rfind(b'\n', body_start, stop - 1) + 1, body_start)
+    if last_line < stop and bytes(buffer[last_line:stop]).lstrip().startswith(b'.END_'):
+        return body_start, last_line
+    return body_start, stop
+
+def placement_records(buffer, data, ranges):
+    """
+    Ids, names and types of the quoted placement lines in `ranges`, and the byte position of every such line.
+
+    Lines with the usual four quotes are cut into fields with array operations, and only the distinct names
+    and types are decoded. Other quoted lines are split one by one, like str.split('"') would.
+
+    :return: The ids as a NumPy str array, lists of names and types, and an array of line positions
+    """
+    ids, names, types, starts = [np.empty(0, dtype=str)], [], [], [np.empty(0, dtype=np.int64)]
+    for start, stop in (piece for block in line_blocks(buffer, ranges) for piece in block):
+        segment = data[start:stop]
+        newlines = np.flatnonzero(segment == ord('\n'))
+        line_starts = np.concatenate([[0], newlines + 1])
+        line_stops = np.append(newlines, len(segment))
+        line_stops = line_stops[line_starts < len(segment)]
+        line_starts = line_starts[line_starts < len(segment)]
+        quoted = segment[line_starts] == ord('"')
+        line_starts, line_stops = line_starts[quoted], line_stops[quoted]
+        starts.append(line_starts + start)
+
+        quotes = np.flatnonzero(segment == ord('"'))
+        first = np.searchsorted(quotes, line_starts)
+        fields = None
+        if np.all(np.searchsorted(quotes, line_stops) - first == 4):
+            quotes = quotes[first[:, None] + np.arange(4)].reshape(-1, 4)
+            spans = ((quotes[:, 0] + 1, quotes[:, 1]), (quotes[:, 2] + 1, quotes[:, 3]), (quotes[:, 3] + 1, line_stops))
+            blank = WHITESPACE[segment]
+            fields = [ascii_fields(segment, blank, field_starts, field_stops) for field_starts, field_stops in spans]
+        if fields is not None and all(field is not None for field in fields):
+            for field, values in zip(fields[:2], (names, types)):
+                distinct, inverse = np.unique(field, return_inverse=True)
+                text = [value.decode('ascii') for value in distinct.tolist()]
+                values.extend(text[i] for i in inverse.tolist())
+            ids.append(fields[2].astype(str))
+        else:
+            # Some line has more or less quotes than the usual four, or text that isn't plain ASCII
+            records = []
+            for match in QUOTED_LINE.finditer(buffer, start, stop):
+                parts = match.group().decode('utf-8').split('"')
+                records.append((parts[1].strip(), parts[3].strip(), parts[-1].strip()))
+            names.extend(name for name, _, _ in records)
+            types.extend(component_type for _, component_type, _ in records)
+            ids.append(np.array([id for _, _, id in records], dtype=str))
+    return np.concatenate(ids), names, types, np.concatenate(starts)
+
+def ascii_fields(segment, blank, starts, stops):
+    """
+    The byte ranges `starts` to `stops` of `segment`, without surrounding whitespace, as a NumPy bytes array.
+    None when a field holds something else than printable ASCII, which only str can strip and decode exactly.
+
+    :param blank: WHITESPACE[segment]
+    """
+    # Move the starts forward and the stops back, one step for all fields that still have whitespace there
+    starts, stops = starts.copy(), stops.copy()
+    moving = np.flatnonzero(starts < stops)
+    moving = moving[blank[starts[moving]]]
+    while len(moving):
+        starts[moving] += 1
+        moving = moving[starts[moving] < stops[moving]]
+        moving = moving[blank[starts[moving]]]
+    moving = np.flatnonzero(starts < stops)
+    moving = moving[blank[stops[moving] - 1]]
+    while len(moving):
+        stops[moving] -= 1
+        moving = moving[starts[moving] < stops[moving]]
+        moving = moving[blank[stops[moving] - 1]]
+
+    lengths = stops - starts
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    characters = np.zeros((len(starts), width), dtype=np.uint8)
+    for column in range(width):
+        inside = lengths > column
+        characters[inside, column] = segment[starts[inside] + column]
+    written = np.arange(width) < lengths[:, None]
+    if np.any(characters[written] < 0x20) or np.any(characters[written] >= 0x7f):
+        return None
+    return characters.view(f'S{width}').ravel()
+
+def line_end(buffer, position):
+    """ Position after the line that contains `position`, including its newline. """
+    end = buffer.find(b'\n', position)
+    return len(buffer) if end < 0 else end + 1
+
+def first_lines(buffer, count):
+    """ The first `count` lines as text, with the line ends a text mode file would give. """
+    position = 0
+    for _ in range(count):
+        if position >= len(buffer):
+            break
+        position = line_end(buffer, position)
+    return bytes(buffer[:position]).decode('utf-8').replace('\r\n', '\n')
+
+def line_blocks(buffer, ranges):
+    """ Split byte ranges of whole lines into blocks of at most about BLOCK_SIZE bytes, cut at line ends. """
+    block = []
+    size = 0
+    for start, stop in ranges:
+        while stop - start > BLOCK_SIZE:
+            cut = line_end(buffer, start + BLOCK_SIZE)
+            if cut >= stop:
+                break
+            yield block + [(start, cut)]
+            block, size = [], 0
+            start = cut
+        block.append((start, stop))
+        size += stop - start
+        if size >= BLOCK_SIZE:
+            yield block
+            block, size = [], 0
+    if block:
+        yield block
+
+def numeric_rows(buffer, ranges, width, first, count, skip_quoted=False):
+    """
+    Convert numeric columns of the lines in `ranges` in bulk.
+
+    :param ranges: Byte ranges (start, stop) of whole lines
+    :param width: Only lines with exactly this many tokens are converted
+    :param first: Index of the first token to convert, `count` tokens are converted per line
+    :param skip_quoted: Leave out lines that start with a double quote
+    :return: A (lines, count) float array, and the byte position in `buffer` where each converted line starts
+    """
+    rows, row_starts = [np.empty((0, count))], [np.empty(0, dtype=np.int64)]
+    data = np.frombuffer(buffer, dtype=np.uint8) if len(buffer) else np.empty(0, dtype=np.uint8)
+    for block in line_blocks(buffer, ranges):
+        # Concatenate the lines of the block, each one ending in a newline, and remember where they came from
+        pieces = []
+        positions = []
+        offset = 0
+        for start, stop in block:
+            pieces.append(data[start:stop])
+            positions.append((offset, start))
+            offset += stop - start
+            if stop > start and data[stop - 1] != 10:
+                pieces.append(np.array([10], dtype=np.uint8))
+                offset += 1
+        chunk = np.concatenate(pieces) if pieces else np.empty(0, dtype=np.uint8)
+        if len(chunk) == 0:
+            continue
+        line_ends = np.flatnonzero(chunk == 10)
+        line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+
+        # Token boundaries, and the line and position within the line of every token
+        blank = WHITESPACE[chunk]
+        token_starts = np.flatnonzero(~blank & np.concatenate([[True], blank[:-1]]))
+        token_stops = np.flatnonzero(~blank & np.concatenate([blank[1:], [True]])) + 1
+        token_lines = np.searchsorted(line_ends, token_starts)
+        tokens_per_line = np.bincount(token_lines, minlength=len(line_ends))
+        ranks = np.arange(len(token_starts)) - (np.cumsum(tokens_per_line) - tokens_per_line)[token_lines]
+
+        selected_lines = tokens_per_line == width
+        if skip_quoted:
+            selected_lines &= chunk[line_starts] != ord('"')
+        selected = selected_lines[token_lines] & (ranks >= first) & (ranks < first + count)
+
+        # Blank out everything but the selected tokens and the line ends, and let the text reader of NumPy
+        # convert the rows that are left, it makes no Python object per number
+        edges = np.zeros(len(chunk) + 1, dtype=np.int8)
+        edges[token_starts[selected]] = 1
+        edges[token_stops[selected]] = -1
+        text = np.where((np.cumsum(edges[:-1]) > 0) | (chunk == 10), chunk, ord(' ')).astype(np.uint8)
+        values = None
+        if selected_lines.any():
+            try:
+                values = np.loadtxt(io.BytesIO(text.tobytes()), dtype=np.float64, comments=None, ndmin=2, encoding='latin1')
+            except ValueError:
+                pass
+        if values is None or values.shape != (np.count_nonzero(selected_lines), count):
+            # Something NumPy doesn't read as a number, convert token by token like float() would
+            values = np.array([float(bytes(chunk[a:b]).decode('utf-8')) for a, b in zip(token_starts[selected], token_stops[selected])],
+                              dtype=np.float64)
+        rows.append(values.reshape(-1, count))
+
+        # Map the selected lines back to their position in the buffer
+        chunk_offsets = np.array([offset for offset, _ in positions], dtype=np.int64)
+        buffer_starts = np.array([start for _, start in positions], dtype=np.int64)
+        kept_starts = line_starts[selected_lines]
+        piece = np.searchsorted(chunk_offsets, kept_starts, side='right') - 1
+        row_starts.append(buffer_starts[piece] + kept_starts - chunk_offsets[piece])
+    return np.concatenate(rows), np.concatenate(row_starts)
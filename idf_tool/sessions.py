@@ -0,0 +1,48 @@
+import time
+from datetime import timedelta
+
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from flask_session.defaults import Defaults
+
+from idf_tool.store import Database
+
+class SqliteSessionInterface(ServerSideSessionInterface):
+    """
+    Flask-Session backend that keeps the sessions in an SQLite database in WAL mode. Unlike the filesystem
+    backend it is safe with several worker processes, which all read and write the same database.
+    """
+    session_class = ServerSideSession
+    ttl = False
+
+    def __init__(self, app, path, cleanup_n_requests=1000):
+        self.database = Database(path, """
+            CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, expiry REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry);
+        """)
+        config = app.config
+        super().__init__(app, config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+                         config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+                         config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+                         config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+                         config.get('SESSION_SERIALIZATION_FORMAT', Defaults.SESSION_SERIALIZATION_FORMAT),
+                         cleanup_n_requests)
+
+    def _retrieve_session_data(self, store_id):
+        with self.database.connection(write=False) as db:
+            row = db.execute('SELECT data FROM sessions WHERE id = ? AND expiry > ?', (store_id, time.time())).fetchone()
+        return self.serializer.decode(row[0]) if row is not None else None
+
+    def _delete_session(self, store_id):
+        with self.database.connection() as db:
+            db.execute('DELETE FROM sessions WHERE id = ?', (store_id,))
+
+    def _upsert_session(self, session_lifetime: timedelta, session, store_id):
+        expiry = time.time() + session_lifetime.total_seconds()
+        with self.database.connection() as db:
+            db.execute('INSERT INTO sessions (id, data, expiry) VALUES (?, ?, ?) '
+                       'ON CONFLICT (id) DO UPDATE SET data = excluded.data, expiry = excluded.expiry',
+                       (store_id, self.serializer.encode(session), expiry))
+
+    def _delete_expired_sessions(self):
+        with self.database.connection() as db:
+            db.execute('DELETE FROM sessions WHERE expiry <= ?', (time.time(),))
@@ -0,0 +1,565 @@
+import io
+import os
+import json
+import time
+import shutil
+import secrets
+import sqlite3
+import hashlib
+import weakref
+import threading
+import contextlib
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows (the desktop build) runs a single process, which the thread locks already cover
+    fcntl = None
+
+from idf_tool.document import IdfDocument, map_file
+from idf_tool.history import Change, EditHistory, pack_vertices, unpack_vertices
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def new_handle(digest):
+    """ Handle of a workspace: the content hash of its file plus a random part, so sessions never share edits. """
+    return f"{digest[:32]}-{secrets.token_hex(8)}"
+
+def value_size(value):
+    """ Rough number of bytes a workspace value keeps alive. """
+    if isinstance(value, (IdfDocument, EditHistory)):
+        return value.nbytes()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(key)) + value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(item) for item in value)
+    return 8
+
+def json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class Workspace(dict):
+    """
+    Workspace dict with the version in SharedDocumentStore it was loaded or stored at, None when it was never
+    stored. The stores don't track changes: a request that changed a workspace, in place or by assigning
+    values, stores it with a put, requests that only read it don't.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = None
+
+class HandleLocks:
+    """ A lock per workspace handle, for the threads of one process. A lock exists while a thread holds on to it. """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __call__(self, handle):
+        with self._lock:
+            lock = self._locks.get(handle)
+            if lock is None:
+                lock = self._locks[handle] = threading.Lock()
+            return lock
+
+    def held(self, handle):
+        """ Whether a thread holds the lock of `handle`. """
+        with self._lock:
+            lock = self._locks.get(handle)
+            return lock is not None and lock.locked()
+
+class DocumentStore:
+    """
+    Server-side state of the sessions. Every workspace is a dict (parsed documents, generated file content,
+    figures, form state) kept in memory in least recently used order. When the estimated size of all
+    workspaces exceeds `max_bytes`, the oldest ones are spilled to `folder` as a .npz file with the arrays
+    and a .json sidecar with everything else, and loaded back on their next use.
+
+    Threads share the workspace objects: hold `lock(handle)` while using one.
+    """
+
+    def __init__(self, folder, max_bytes=256 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._workspaces = OrderedDict()
+        self._sizes = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self.lock = HandleLocks()
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, handle):
+        """ Workspace of `handle`, or None when it is unknown. """
+        with self._lock:
+            if handle in self._workspaces:
+                self._workspaces.move_to_end(handle)
+                return self._workspaces[handle]
+            workspace = self._load(handle)
+            if workspace is not None:
+                self._insert(handle, workspace)
+            return workspace
+
+    def put(self, handle, workspace):
+        """ Keep the workspace. Always returns True, like a SharedDocumentStore put without conflict. """
+        with self._lock:
+            if handle in self._workspaces:
+                self._total -= self._sizes.pop(handle)
+                del self._workspaces[handle]
+            self._insert(handle, workspace)
+            return True
+
+    def discard(self, handle):
+        with self._lock:
+            if handle in self._workspaces:
+                self._total -= self._sizes.pop(handle)
+                del self._workspaces[handle]
+            for path in self._paths(handle):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _insert(self, handle, workspace):
+        size = sum(len(key) + value_size(value) for key, value in workspace.items())
+        self._workspaces[handle] = workspace
+        self._sizes[handle] = size
+        self._total += size
+        # Never evict a workspace in use: this one, even when it alone exceeds the budget, and the ones another
+        # thread holds the lock of, its changes would go to an object that is no longer in the store
+        for oldest in list(self._workspaces):
+            if self._total <= self.max_bytes:
+                break
+            if oldest == handle or self.lock.held(oldest):
+                continue
+            self._total -= self._sizes.pop(oldest)
+            self._spill(oldest, self._workspaces.pop(oldest))
+
+    # Disk spill
+
+    def _paths(self, handle):
+        # Handles come from the session cookie, never let them point outside the store folder
+        if not handle or not all(c.isalnum() or c == '-' for c in handle):
+            return []
+        base = os.path.join(self.folder, handle)
+        return [base + '.npz', base + '.json']
+
+    def _spill(self, handle, workspace):
+        paths = self._paths(handle)
+        if paths:
+            write_workspace(*paths, workspace)
+
+    def _load(self, handle):
+        paths = self._paths(handle)
+        if not paths or not os.path.exists(paths[1]):
+            return None
+        workspace = read_workspace(*paths)
+        # The workspace lives in memory again, it is written back when it gets evicted
+        for path in paths:
+            os.remove(path)
+        return workspace
+
+class ParseCache:
+    """
+    Persistent cache of parse results, keyed by the SHA-256 of the uploaded bytes (see save_stream). Entries are stored like
+    spilled workspaces and stamped with `version`; entries written by another version are ignored. When the
+    folder grows beyond `max_bytes`, the least recently used entries are deleted.
+    """
+
+    def __init__(self, folder, version, max_bytes=512 * 1024 * 1024):
+        self.folder = folder
+        self.version = version
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, key):
+        paths = self._paths(key)
+        with self._lock, file_lock(self._lock_path(), shared=True):
+            if not os.path.exists(paths[1]):
+                return None
+            try:
+                entry = read_workspace(*paths)
+            except (OSError, ValueError, KeyError):
+                return None
+            if entry.pop('version', None) != self.version:
+                return None
+            # Recently used entries are the last to be evicted
+            for path in paths:
+                os.utime(path)
+        return entry
+
+    def put(self, key, entry):
+        paths = self._paths(key)
+        # Other worker processes share the folder, an entry is two files that must not be read half written
+        with self._lock, file_lock(self._lock_path()):
+            write_workspace(*paths, dict(entry, version=self.version))
+            self._evict()
+
+    def _paths(self, key):
+        base = os.path.join(self.folder, key)
+        return [base + '.npz', base + '.json']
+
+    def _lock_path(self):
+        return os.path.join(self.folder, '.lock')
+
+    def _evict(self):
+        entries = []
+        for filename in os.listdir(self.folder):
+            if filename.endswith('.json'):
+                paths = self._paths(filename[:-len('.json')])
+                if os.path.exists(paths[0]):
+                    entries.append((os.path.getmtime(paths[1]), sum(os.path.getsize(path) for path in paths), paths))
+        total = sum(size for _, size, _ in entries)
+        for _, size, paths in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in paths:
+                os.remove(path)
+            total -= size
+
+# Disk format
+
+def split_workspace(workspace, parts=None):
+    """
+    Split a workspace into a dict of NumPy arrays and a dict of JSON serializable fields.
+
+    :param parts: When given, the values that are never changed in place (the source bytes of the documents
+                  and the steps of the edit histories) are put in this dict by name instead of in the arrays,
+                  so they can be stored once (see write_part)
+    """
+    arrays = {}
+    fields = {'documents': {}, 'histories': {}, 'arrays': [], 'values': {}}
+    sources = {}
+    for key, value in workspace.items():
+        if isinstance(value, IdfDocument):
+            document_arrays, fields['documents'][key] = value.state()
+            # A document and its copies share the source text, it is written once
+            if 'source' in document_arrays:
+                source = document_arrays.pop('source')
+                if id(value.source) not in sources:
+                    sources[id(value.source)] = f'{key}.source'
+                    if parts is None:
+                        arrays[f'{key}.source'] = source
+                    else:
+                        parts[f'{key}.source'] = value.source
+                fields['documents'][key]['source'] = sources[id(value.source)]
+            for name, array in document_arrays.items():
+                arrays[f'{key}.{name}'] = array
+        elif isinstance(value, EditHistory):
+            history_arrays, fields['histories'][key] = value.state(steps=parts is None)
+            if parts is not None:
+                fields['histories'][key]['steps'] = [f'{key}.{step}' for step in range(len(value.changes))]
+                parts.update(zip(fields['histories'][key]['steps'], value.changes))
+            for name, array in history_arrays.items():
+                arrays[f'{key}.{name}'] = array
+        elif isinstance(value, np.ndarray):
+            arrays[key] = value
+            fields['arrays'].append(key)
+        else:
+            fields['values'][key] = value
+    return arrays, fields
+
+def join_workspace(npz, fields, parts=None):
+    """ Inverse of split_workspace, with the arrays read from an open .npz file and the parts by name. """
+    workspace = Workspace(fields['values'])
+    for key in fields['arrays']:
+        workspace[key] = npz[key]
+    sources = {}
+    for key, document_fields in fields['documents'].items():
+        document_arrays = {name.split('.', 1)[1]: npz[name] for name in npz.files if name.startswith(key + '.')}
+        document_arrays.pop('source', None)
+        if 'source' in document_fields:
+            name = document_fields['source']
+            if name not in sources:
+                sources[name] = parts[name] if parts is not None else npz[name].tobytes()
+            document_arrays['source'] = sources[name]
+        elif 'source_path' in document_fields:
+            # Documents that refer to the same file share one map of it, like the source bytes above
+            path = document_fields['source_path']
+            if path not in sources:
+                sources[path] = map_file(path)
+            document_arrays['source'] = sources[path]
+        workspace[key] = IdfDocument.from_state(document_arrays, document_fields)
+    for key, history_fields in fields.get('histories', {}).items():
+        history_arrays = {name.split('.', 1)[1]: npz[name] for name in npz.files if name.startswith(key + '.')}
+        changes = [parts[name] for name in history_fields['steps']] if 'steps' in history_fields else None
+        workspace[key] = EditHistory.from_state(history_arrays, history_fields, changes)
+    return workspace
+
+def write_workspace(npz_path, json_path, workspace):
+    """ Write the arrays of a workspace to an .npz file and everything else to a JSON sidecar. """
+    arrays, fields = split_workspace(workspace)
+    np.savez(npz_path, **arrays)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(fields, f, default=json_default)
+
+def read_workspace(npz_path, json_path):
+    with open(json_path, 'r', encoding='utf-8') as f:
+        fields = json.load(f)
+    with np.load(npz_path) as npz:
+        return join_workspace(npz, fields)
+
+def write_part(value):
+    """ .npz bytes and JSON fields of a part of split_workspace: the source bytes of a document or a history step. """
+    if isinstance(value, Change):
+        vertices = []
+        fields = json.dumps(value.state(vertices, {}), default=json_default)
+        arrays = pack_vertices(vertices)
+    else:
+        fields = None
+        arrays = {'source': np.frombuffer(value, dtype=np.uint8)}
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue(), fields
+
+def read_part(arrays, fields):
+    with np.load(io.BytesIO(arrays)) as npz:
+        if fields is None:
+            return npz['source'].tobytes()
+        return Change.from_state(json.loads(fields), unpack_vertices(npz))
+
+# Multi-process deployments
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """ Advisory lock on `path` across processes, exclusive unless `shared`. Does nothing where fcntl is missing. """
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def atomic_write(path, data):
+    """ Write a file under a temporary name and rename it, so readers and concurrent writers never see a partial file. """
+    temporary_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def atomic_copy(source_path, path):
+    """ Copy a file in chunks, under a temporary name that is renamed like in atomic_write. """
+    temporary_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        shutil.copyfile(source_path, temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def save_stream(stream, folder, suffix='', chunk_size=1024 * 1024):
+    """
+    Save a file object to `folder` in chunks, named by the SHA-256 of its bytes, so the file never changes
+    once it is saved (the same bytes get the same name). Memory use doesn't grow with the size of the file.
+
+    :return: The hash and the absolute path of the file
+    """
+    digest = hashlib.sha256()
+    temporary_path = os.path.join(folder, f'.{os.getpid()}-{threading.get_ident()}.tmp')
+    try:
+        with open(temporary_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        path = os.path.abspath(os.path.join(folder, digest.hexdigest() + suffix))
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return digest.hexdigest(), path
+
+class Database:
+    """
+    SQLite database shared by all worker processes. It runs in WAL mode, so readers don't block the writer,
+    and every thread gets its own connection.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The journal mode is stored in the database file, and neither it nor executescript can run in a transaction
+        db = self._connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(schema)
+
+    def connection(self, write=True):
+        """ `with database.connection() as db:` runs the statements in one transaction. Pass write=False for reads. """
+        return Transaction(self._connect(), write)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+class Transaction:
+    def __init__(self, db, write):
+        self.db = db
+        self.write = write
+
+    def __enter__(self):
+        # Writers take the lock up front instead of upgrading a read transaction, which can deadlock
+        self.db.execute('BEGIN IMMEDIATE' if self.write else 'BEGIN')
+        return self.db
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+class SharedDocumentStore:
+    """
+    Workspaces in an SQLite database, for deployments with several worker processes: any worker can serve
+    the next request of a session. Every process keeps the workspaces it used last in memory (up to
+    `max_bytes`) with the version it loaded; a get only reads the workspace again when another process
+    stored a newer version. A put of a
+    workspace that another process stored in the meantime is refused instead of dropping those changes.
+    Threads of one process share the workspace objects, like in DocumentStore: hold `lock(handle)`.
+
+    The values that are never changed in place, the source bytes of the documents and the steps of the edit
+    history, are stored as separate parts and only written when they are new: an edit writes the document
+    arrays, the editor values and its own history step. A get reads only the parts it doesn't have yet.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.database = Database(path, """
+            CREATE TABLE IF NOT EXISTS workspaces (
+                handle TEXT PRIMARY KEY, version INTEGER NOT NULL,
+                arrays BLOB NOT NULL, fields TEXT NOT NULL, updated REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS workspace_parts (
+                handle TEXT NOT NULL, name TEXT NOT NULL, token TEXT NOT NULL, arrays BLOB NOT NULL, fields TEXT,
+                PRIMARY KEY (handle, name));
+        """)
+        self._workspaces = OrderedDict()
+        # Per handle, the token and the value of every part in the stored version
+        self._parts = {}
+        self._sizes = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self.lock = HandleLocks()
+
+    def get(self, handle):
+        with self.database.connection(write=False) as db:
+            row = db.execute('SELECT version FROM workspaces WHERE handle = ?', (handle,)).fetchone()
+            if row is None:
+                self._forget(handle)
+                return None
+            with self._lock:
+                if handle in self._workspaces and self._workspaces[handle].version == row[0]:
+                    self._workspaces.move_to_end(handle)
+                    return self._workspaces[handle]
+                known = self._parts.get(handle, {})
+            version, arrays, fields = db.execute(
+                'SELECT version, arrays, fields FROM workspaces WHERE handle = ?', (handle,)).fetchone()
+            fields = json.loads(fields)
+            parts = {}
+            for name, token in fields['parts'].items():
+                if name in known and known[name][0] == token:
+                    parts[name] = known[name]
+                else:
+                    part_arrays, part_fields = db.execute(
+                        'SELECT arrays, fields FROM workspace_parts WHERE handle = ? AND name = ?', (handle, name)).fetchone()
+                    parts[name] = (token, read_part(part_arrays, part_fields))
+        with np.load(io.BytesIO(arrays)) as npz:
+            workspace = join_workspace(npz, fields, {name: value for name, (_, value) in parts.items()})
+        workspace.version = version
+        self._remember(handle, workspace, parts)
+        return workspace
+
+    def put(self, handle, workspace):
+        """
+        Store the workspace.
+
+        :return: False when another process stored the workspace since it was loaded; nothing is written then
+                 and the next get loads the stored version
+        """
+        with self._lock:
+            known = self._parts.get(handle, {})
+        values = {}
+        arrays, fields = split_workspace(workspace, values)
+
+        # Parts are stored by name; a part is new when the stored one is another object
+        parts, new_parts = {}, {}
+        for name, value in values.items():
+            if name in known and known[name][1] is value:
+                parts[name] = known[name]
+            else:
+                parts[name] = new_parts[name] = (secrets.token_hex(8), value)
+        fields['parts'] = {name: token for name, (token, _) in parts.items()}
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        fields = json.dumps(fields, default=json_default)
+
+        with self.database.connection() as db:
+            # Only the version the workspace was loaded at is overwritten
+            if workspace.version is None:
+                cursor = db.execute("""
+                    INSERT INTO workspaces (handle, version, arrays, fields, updated) VALUES (?, 1, ?, ?, ?)
+                    ON CONFLICT (handle) DO NOTHING
+                """, (handle, buffer.getvalue(), fields, time.time()))
+            else:
+                cursor = db.execute("""
+                    UPDATE workspaces SET version = version + 1, arrays = ?, fields = ?, updated = ? WHERE handle = ? AND version = ?
+                """, (buffer.getvalue(), fields, time.time(), handle, workspace.version))
+            stored = cursor.rowcount == 1
+            if stored:
+                names = {name for name, in db.execute('SELECT name FROM workspace_parts WHERE handle = ?', (handle,))}
+                for name in names - parts.keys():
+                    db.execute('DELETE FROM workspace_parts WHERE handle = ? AND name = ?', (handle, name))
+                for name, (token, value) in new_parts.items():
+                    db.execute('INSERT OR REPLACE INTO workspace_parts (handle, name, token, arrays, fields) VALUES (?, ?, ?, ?, ?)',
+                               (handle, name, token, *write_part(value)))
+        if not stored:
+            self._forget(handle)
+            return False
+        workspace.version = 1 if workspace.version is None else workspace.version + 1
+        self._remember(handle, workspace, parts)
+        return True
+
+    def discard(self, handle):
+        with self.database.connection() as db:
+            db.execute('DELETE FROM workspaces WHERE handle = ?', (handle,))
+            db.execute('DELETE FROM workspace_parts WHERE handle = ?', (handle,))
+        self._forget(handle)
+
+    def _remember(self, handle, workspace, parts):
+        with self._lock:
+            if handle in self._workspaces:
+                self._total -= self._sizes.pop(handle)
+                del self._workspaces[handle]
+            size = sum(len(key) + value_size(value) for key, value in workspace.items())
+            self._workspaces[handle] = workspace
+            self._parts[handle] = parts
+            self._sizes[handle] = size
+            self._total += size
+            # The database has every workspace, the memory copies can simply be dropped
+            while self._total > self.max_bytes and len(self._workspaces) > 1:
+                oldest, _ = self._workspaces.popitem(last=False)
+                self._total -= self._sizes.pop(oldest)
+                del self._parts[oldest]
+
+    def _forget(self, handle):
+        with self._lock:
+            if handle in self._workspaces:
+                self._total -= self._sizes.pop(handle)
+                del self._workspaces[handle], self._parts[handle]
@@ -0,0 +1,180 @@
+import numpy as np
+
+from idf_tool.parse_idf import outline_polylines
+
+# Components that only touch (e.g. strings placed edge to edge) are not reported
+TOLERANCE = 0.01
+
+class GridIndex:
+    """
+    Uniform grid over the bounding boxes of the placements, keyed by component id. Every id is listed in the
+    cells its box covers, so the candidates for an overlap with a box are the ids in the cells it covers.
+    The state is plain JSON, so it can live in a workspace between requests.
+    """
+
+    def __init__(self, cell_size, cells=None, boxes=None):
+        self.cell_size = cell_size
+        self.cells = {} if cells is None else cells
+        self.boxes = {} if boxes is None else boxes
+
+    def state(self):
+        return {'cell_size': self.cell_size, 'cells': self.cells, 'boxes': self.boxes}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['cell_size'], state['cells'], state['boxes'])
+
+    def _cell_keys(self, box):
+        x0, y0, x1, y1 = (int(np.floor(value / self.cell_size)) for value in box)
+        return [f'{ix},{iy}' for ix in range(x0, x1 + 1) for iy in range(y0, y1 + 1)]
+
+    def insert(self, id, box):
+        self.boxes[id] = [float(value) for value in box]
+        for key in self._cell_keys(box):
+            self.cells.setdefault(key, []).append(id)
+
+    def remove(self, id):
+        box = self.boxes.pop(id, None)
+        if box is None:
+            return
+        for key in self._cell_keys(box):
+            ids = self.cells[key]
+            ids.remove(id)
+            if not ids:
+                del self.cells[key]
+
+    def query(self, box):
+        """ Ids whose box shares a grid cell with `box`. """
+        candidates = set()
+        for key in self._cell_keys(box):
+            candidates.update(self.cells.get(key, ()))
+        return candidates
+
+def component_geometry(document):
+    """
+    Transformed outline polygon, bounding box and change signature of every placement.
+
+    :return: List of (n, 2) polygons, an (n, 4) array of boxes (x0, y0, x1, y1; NaN without outline) and an
+             (n, 7) array of signatures that changes whenever the polygon does
+    """
+    x, y, lengths = outline_polylines(document, np.arange(len(document)))
+    starts = np.cumsum(lengths) - lengths
+    if len(lengths) == 0:
+        return [], np.empty((0, 4)), np.empty((0, 7))
+    # Every polyline ends with a NaN separator, which fmin and fmax skip
+    boxes = np.column_stack([np.fmin.reduceat(x, starts), np.fmin.reduceat(y, starts),
+                             np.fmax.reduceat(x, starts), np.fmax.reduceat(y, starts)])
+    signatures = np.column_stack([boxes, np.add.reduceat(np.nan_to_num(x), starts),
+                                  np.add.reduceat(np.nan_to_num(y), starts), lengths])
+    polygons = [np.column_stack([x[start:start + length - 1], y[start:start + length - 1]])
+                for start, length in zip(starts.tolist(), lengths.tolist())]
+    return polygons, boxes, signatures
+
+def points_in_polygon(points, polygon):
+    """ Ray casting for many points at once. `polygon` is a closed ring (last point equals the first). """
+    x = points[:, 0][:, None]
+    y = points[:, 1][:, None]
+    x0, y0 = polygon[:-1, 0][None], polygon[:-1, 1][None]
+    x1, y1 = polygon[1:, 0][None], polygon[1:, 1][None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = ((y0 > y) != (y1 > y)) & (x < (x1 - x0) * (y - y0) / (y1 - y0) + x0)
+    return crossings.sum(axis=1) % 2 == 1
+
+def distance_to_ring(points, polygon):
+    """ Distance of every point to the nearest segment of a closed ring. """
+    start = polygon[:-1][None]
+    segment = polygon[1:][None] - start
+    offset = points[:, None] - start
+    t = np.clip((offset * segment).sum(axis=-1) / np.maximum((segment * segment).sum(axis=-1), 1e-300), 0, 1)
+    return np.sqrt(((offset - t[..., None] * segment) ** 2).sum(axis=-1)).min(axis=1)
+
+def segments_cross(p, q, tolerance=1e-9):
+    """ Whether any segment of ring `p` properly crosses a segment of ring `q` (touching does not count). """
+    a, b = p[:-1][:, None], p[1:][:, None]
+    c, d = q[:-1][None], q[1:][None]
+
+    def orientation(o, u, v):
+        return (u[..., 0] - o[..., 0]) * (v[..., 1] - o[..., 1]) - (u[..., 1] - o[..., 1]) * (v[..., 0] - o[..., 0])
+
+    return bool(((orientation(c, d, a) * orientation(c, d, b) < -tolerance) &
+                 (orientation(a, b, c) * orientation(a, b, d) < -tolerance)).any())
+
+def polygons_overlap(p, q, tolerance=TOLERANCE):
+    if segments_cross(p, q):
+        return True
+    for points, polygon in ((p, q), (q, p)):
+        inside = points_in_polygon(points, polygon)
+        if inside.any() and (distance_to_ring(points[inside], polygon) > tolerance).any():
+            return True
+    return False
+
+def outside_board(polygon, board, tolerance=TOLERANCE):
+    outside = ~points_in_polygon(polygon, board)
+    return bool(outside.any() and (distance_to_ring(polygon[outside], board) > tolerance).any())
+
+def validate(document, state=None, tolerance=TOLERANCE):
+    """
+    Report components that overlap a component of the same type, and components that stick out of the board
+    outline. Busbars lie on the string ribbons by design, so busbar-string overlaps are not reported.
+
+    Candidate pairs come from a uniform grid of the bounding boxes; only pairs whose boxes overlap get the
+    exact polygon test. With the `state` of the previous call only placements whose geometry changed since
+    then are checked again.
+
+    :param state: The state returned by the previous call for the same document, or None
+    :return: The list of issues (dicts with 'kind', 'ids' and 'message') and the new state
+    """
+    polygons, boxes, signatures = component_geometry(document)
+    ids = document.ids()
+    rows = {id: row for row, id in enumerate(ids)}
+    types = document.placements['type'].tolist()
+    board = np.asarray(document.board_outline, dtype=np.float64).reshape(-1, 3)[:, :2]
+    board_signature = [len(board), float(board.sum())]
+    valid = ~np.isnan(boxes).any(axis=1)
+
+    if state is None or state['board'] != board_signature:
+        sizes = (boxes[valid, 2:] - boxes[valid, :2]).max(axis=1)
+        index = GridIndex(max(float(np.median(sizes)) if len(sizes) else 0.0, 1.0))
+        previous, overlaps, outside = {}, [], []
+    else:
+        index = GridIndex.from_state(state['index'])
+        previous, overlaps, outside = state['signatures'], state['overlaps'], state['outside']
+
+    # Placements that are new, gone or moved since the previous call
+    signature_lists = np.nan_to_num(signatures).tolist()
+    dirty = {id for id, signature in zip(ids, signature_lists) if previous.get(id) != signature}
+    dirty |= set(previous) - set(rows)
+    overlaps = [pair for pair in overlaps if pair[0] not in dirty and pair[1] not in dirty]
+    outside = [id for id in outside if id not in dirty]
+    for id in dirty:
+        index.remove(id)
+    for id in dirty:
+        row = rows.get(id)
+        if row is not None and valid[row]:
+            index.insert(id, boxes[row])
+
+    for id in sorted(dirty):
+        row = rows.get(id)
+        if row is None or not valid[row]:
+            continue
+        x0, y0, x1, y1 = boxes[row]
+        for other in sorted(index.query(boxes[row])):
+            other_row = rows[other]
+            # A pair of two changed placements is tested once, from its first id
+            if other == id or types[other_row] != types[row] or (other in dirty and other < id):
+                continue
+            ox0, oy0, ox1, oy1 = boxes[other_row]
+            if min(x1, ox1) - max(x0, ox0) <= tolerance or min(y1, oy1) - max(y0, oy0) <= tolerance:
+                continue
+            if polygons_overlap(polygons[row], polygons[other_row], tolerance):
+                overlaps.append(sorted([id, other]))
+        if len(board) > 2 and outside_board(polygons[row], board, tolerance):
+            outside.append(id)
+
+    overlaps.sort()
+    outside.sort()
+    issues = [{'kind': 'overlap', 'ids': pair, 'message': f'{pair[0]} overlaps {pair[1]}'} for pair in overlaps]
+    issues += [{'kind': 'outside_board', 'ids': [id], 'message': f'{id} is outside the board outline'} for id in outside]
+    state = {'board': board_signature, 'index': index.state(), 'overlaps': overlaps, 'outside': outside,
+             'signatures': dict(zip(ids, signature_lists))}
+    return issues, state
@@ -1,50 +1,302 @@
-function removeBusbar(sbar) {
-    console.log('Removing busbar:', sbar);
+// Send edit operations to the server, only the changed components come back
+function applyOperations(operations) {
+    return fetch('/api/operations', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({operations: operations})
+    }).then(response => response.json().then(data => {
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to apply operations');
+        }
+        return data;
+    }));
+}
 
-    // Create a form data object
-    const form = document.querySelector('form');
-    const formData = new FormData(form);
-    formData.append('sbar', sbar);
+// Figures are kept in the session storage, the server only sends what changed since the stored version
+function loadFigure(name) {
+    const key = 'figure-' + name;
+    let cached = null;
+    try {
+        cached = JSON.parse(sessionStorage.getItem(key));
+    } catch (error) {
+        cached = null;
+    }
+    const url = '/api/figure/' + name + (cached ? '?since=' + encodeURIComponent(cached.version) : '');
+    return fetch(url).then(response => response.json()).then(data => {
+        const figure = data.figure || applyFigurePatch(cached.figure, data.patch);
+        try {
+            sessionStorage.setItem(key, JSON.stringify({version: data.version, figure: figure}));
+        } catch (error) {
+            // Over the storage quota, the next visit fetches the whole figure again
+            sessionStorage.removeItem(key);
+        }
+        return figure;
+    });
+}
 
-    // Function to handle the removal of the busbar
-    fetch('/remove_busbar', {
-        method: 'POST',
-        body: formData
-    }).then(response => {
-            if (response.ok) {
-                // Handle successful removal, e.g., reload the page or update the UI
-                location.reload();
+function applyFigurePatch(figure, patch) {
+    patch.forEach(segment => {
+        const trace = figure.data[segment.trace];
+        if (segment.start === null) {
+            trace.x = segment.x;
+            trace.y = segment.y;
+            if (segment.text) {
+                trace.text = segment.text;
+            }
+            return;
+        }
+        trace.x.splice(segment.start, segment.x.length, ...segment.x);
+        trace.y.splice(segment.start, segment.y.length, ...segment.y);
+        if (segment.text) {
+            trace.text.splice(segment.start, segment.text.length, ...segment.text);
+        }
+    });
+    return figure;
+}
+
+// Slow work runs as a background job on the server, the browser polls its progress until it is done
+function startJob(url, body) {
+    return fetch(url, {method: 'POST', body: body}).then(response => response.json().then(data => {
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to start the job');
+        }
+        return data;
+    }));
+}
+
+function waitForJob(id, onProgress) {
+    return new Promise((resolve, reject) => {
+        let delay = 100;
+        function poll() {
+            fetch('/api/jobs/' + id).then(response => response.json()).then(job => {
+                if (onProgress) {
+                    onProgress(job);
+                }
+                if (job.state === 'done') {
+                    resolve(job);
+                } else if (job.state === 'failed' || job.error) {
+                    reject(new Error(job.error || 'The job failed'));
+                } else {
+                    // Poll quickly at first, small jobs are done within a few polls
+                    delay = Math.min(delay * 2, 1000);
+                    setTimeout(poll, delay);
+                }
+            }).catch(reject);
+        }
+        poll();
+    });
+}
+
+function showJobProgress(element, job) {
+    if (element) {
+        element.textContent = job.message + ' (' + Math.round(job.progress * 100) + '%)';
+    }
+}
+
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})[c]);
+}
+
+// Component editor for the string placements: only the rows in view exist in the DOM. They are fetched
+// page by page from /api/placements, and edits are kept here so they survive scrolling a row out of view.
+function placementTable(element) {
+    const rowsElement = element.querySelector('.placement-table-rows');
+    const spacer = element.querySelector('.placement-table-spacer');
+    const rowHeight = 46;
+    const pageSize = 100;
+    const overscan = 5;
+    const names = JSON.parse(element.dataset.stringNames || '[]');
+    // The string options are built once and shared by every row
+    const nameOptions = names.map(name => `<option value="${escapeHtml(name)}">${escapeHtml(name)}</option>`).join('');
+    const angleOptions = ['0', '90', '180', '270', '-90'].map(angle => `<option value="${angle}">${angle}</option>`).join('');
+    const edits = {};
+    let pages = {};
+    let total = parseInt(element.dataset.total || '0');
+    let query = {q: '', sort: 'file', order: 'asc'};
+    let generation = 0;
+
+    function loadPage(page) {
+        if (pages[page] !== undefined) {
+            return;
+        }
+        pages[page] = null;
+        const current = generation;
+        const params = new URLSearchParams(Object.assign({type: 'string', offset: page * pageSize, limit: pageSize}, query));
+        fetch('/api/placements?' + params)
+            .then(response => response.json())
+            .then(data => {
+                if (current !== generation) {
+                    return;
+                }
+                pages[page] = data.rows;
+                total = data.total;
+                render();
+            }).catch(error => {
+                console.error('Error:', error);
+                delete pages[page];
+            });
+    }
+
+    function rowHtml(row) {
+        const id = escapeHtml(row.id);
+        const field = (name, value) => escapeHtml(edits[name] !== undefined ? edits[name] : value);
+        return `
+<div class="row" data-id="${id}">
+    <div class="col">
+        <button type="button" class="btn btn-danger" onclick="removeString('${id}', this)">
+            <i class="bi bi-trash3"></i>
+        </button>
+    </div>
+    <div class="col">
+        <label for="name_${id}">${id}:</label>
+    </div>
+    <div class="col">
+        <select class="form-control" id="name_${id}" name="name_${id}" data-value="${field('name_' + row.id, row.name)}">${nameOptions}</select>
+    </div>
+    <div class="col">
+        <select class="form-control" id="string180deg_${id}" name="string180deg_${id}" data-value="${field('string180deg_' + row.id, String(row.rotation))}">${angleOptions}</select>
+    </div>
+    <div class="col">
+        <input type="number" class="form-control" name="placement_${id}_0" placeholder="Enter a number" value="${field('placement_' + row.id + '_0', row.x)}">
+    </div>
+    <div class="col">
+        <input type="number" class="form-control" name="placement_${id}_1" placeholder="Enter a number" value="${field('placement_' + row.id + '_1', row.y)}">
+    </div>
+    <div class="col">
+        <input type="number" class="form-control" name="placement_${id}_2" placeholder="Enter a number" value="${field('placement_' + row.id + '_2', row.z)}">
+    </div>
+</div>`;
+    }
+
+    function render() {
+        spacer.style.height = (total * rowHeight) + 'px';
+        const first = Math.max(Math.floor(element.scrollTop / rowHeight) - overscan, 0);
+        const last = Math.min(Math.ceil((element.scrollTop + element.clientHeight) / rowHeight) + overscan, total);
+        const html = [];
+        for (let index = first; index < last; index++) {
+            const page = Math.floor(index / pageSize);
+            loadPage(page);
+            const row = pages[page] ? pages[page][index % pageSize] : undefined;
+            html.push(row ? rowHtml(row) : '<div class="row"></div>');
+        }
+        rowsElement.style.transform = `translateY(${first * rowHeight}px)`;
+        rowsElement.innerHTML = html.join('');
+        rowsElement.querySelectorAll('select[data-value]').forEach(select => {
+            select.value = select.dataset.value;
+            if (select.selectedIndex === -1) {
+                select.selectedIndex = 0;
+            }
+        });
+    }
+
+    function reload(newQuery) {
+        if (newQuery) {
+            query = newQuery;
+            element.scrollTop = 0;
+        }
+        generation++;
+        pages = {};
+        render();
+    }
+
+    rowsElement.addEventListener('change', event => {
+        edits[event.target.name] = event.target.value;
+    });
+    rowsElement.addEventListener('input', event => {
+        edits[event.target.name] = event.target.value;
+    });
+    rowsElement.addEventListener('keydown', event => {
+        if (event.key === 'Enter') {
+            event.preventDefault();
+        }
+    });
+    rowsElement.addEventListener('focusout', event => {
+        const input = event.target;
+        if (input.type === 'number' && !isNaN(parseFloat(input.value))) {
+            input.value = parseFloat(input.value).toFixed(2);
+            edits[input.name] = input.value;
+        }
+    });
+    let scheduled = false;
+    element.addEventListener('scroll', () => {
+        if (!scheduled) {
+            scheduled = true;
+            requestAnimationFrame(() => {
+                scheduled = false;
+                render();
+            });
+        }
+    });
+    render();
+
+    return {
+        reload: reload,
+        contains: node => element.contains(node),
+        // Rows that are out of view are not in the form, their edits are added to the submitted data here
+        addEdits: formData => Object.entries(edits).forEach(([name, value]) => formData.set(name, value)),
+        invalidEdits: () => Object.entries(edits).filter(([name, value]) => name.startsWith('placement_') && (value === '' || isNaN(value))).map(([name]) => name),
+    };
+}
+
+let stringPlacements = null;
+
+// All string placement ids, for the autogenerate dialog
+function loadPlacementIds(offset = 0, ids = []) {
+    const params = new URLSearchParams({type: 'string', offset: offset, limit: 500});
+    return fetch('/api/placements?' + params)
+        .then(response => response.json())
+        .then(data => {
+            ids = ids.concat(data.rows.map(row => row.id));
+            return ids.length < data.total && data.rows.length ? loadPlacementIds(offset + data.rows.length, ids) : ids;
+        });
+}
+
+// Undo or redo one step of the edit history, the form shows the restored values after the reload
+function stepHistory(direction) {
+    fetch('/api/' + direction, {method: 'POST'})
+        .then(response => response.json().then(data => {
+            if (!response.ok) {
+                console.error(data.error);
+            }
+            location.reload();
+        })).catch(error => {
+            console.error('Error:', error);
+        });
+}
+
+function removeBusbar(sbar, button) {
+    console.log('Removing busbar:', sbar);
+
+    applyOperations([{op: 'remove', name: sbar}])
+        .then(() => {
+            // Only the row of the busbar changes, the rest of the page stays as it is
+            if (button) {
+                button.closest('.row').remove();
             } else {
-                // Handle errors
-                console.error('Failed to remove busbar');
+                location.reload();
             }
         }).catch(error => {
             console.error('Error:', error);
+            location.reload();
         });
 }
 
-function removeString(id) {
+function removeString(id, button) {
     console.log('Removing string:', id);
 
-    // Create a form data object
-    const form = document.querySelector('form');
-    const formData = new FormData(form);
-    formData.append('string', id);
-
-    // Function to handle the removal of the busbar
-    fetch('/remove_string', {
-        method: 'POST',
-        body: formData
-    }).then(response => {
-            if (response.ok) {
-                // Handle successful removal, e.g., reload the page or update the UI
-                location.reload();
+    applyOperations([{op: 'remove', id: id}])
+        .then(changes => {
+            // Removing the last placement of a string also removes its definition, which needs a full reload
+            if (button && changes.removed_outlines.length === 0 && stringPlacements && stringPlacements.contains(button)) {
+                stringPlacements.reload();
+            } else if (button && changes.removed_outlines.length === 0) {
+                button.closest('.row').remove();
             } else {
-                // Handle errors
-                console.error('Failed to remove string');
+                location.reload();
             }
         }).catch(error => {
             console.error('Error:', error);
+            location.reload();
         });
 }
 
@@ -89,6 +341,37 @@ document.addEventListener('DOMContentLoaded', function() {
     addEnterKeyPrevention();
     addFloatConversion();
 
+    const placementElement = document.getElementById('placement-table');
+    if (placementElement) {
+        stringPlacements = placementTable(placementElement);
+        const filter = document.getElementById('placement-filter');
+        const sort = document.getElementById('placement-sort');
+        const order = document.getElementById('placement-order');
+        let timer = null;
+        const update = () => stringPlacements.reload({q: filter.value.trim(), sort: sort.value, order: order.value});
+        filter.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(update, 200);
+        });
+        filter.addEventListener('keydown', preventEnterKeySubmission);
+        sort.addEventListener('change', update);
+        order.addEventListener('change', update);
+    }
+
+    const autogenerateModal = document.getElementById('autoGenerateModal');
+    const autogenerateSelect = document.getElementById('stringsToAutogenerate');
+    if (autogenerateModal && autogenerateSelect && !autogenerateSelect.disabled) {
+        autogenerateModal.addEventListener('show.bs.modal', function() {
+            if (autogenerateSelect.dataset.loaded) {
+                return;
+            }
+            loadPlacementIds().then(ids => {
+                autogenerateSelect.innerHTML = ids.map(id => `<option value="${escapeHtml(id)}">${escapeHtml(id)}</option>`).join('');
+                autogenerateSelect.dataset.loaded = '1';
+            }).catch(error => console.error('Error:', error));
+        });
+    }
+
     function addNewRow2(busbarName, id) {
         console.log("adding busbar", busbarName);
         const newRow = document.createElement('div');
@@ -230,6 +513,9 @@ document.addEventListener('DOMContentLoaded', function() {
 
         const form = document.getElementById('manipulate-form');
         const formData = new FormData(form);
+        if (stringPlacements) {
+            stringPlacements.addEdits(formData);
+        }
         formData.append('new_string_name', name)
         formData.append('cell_type', "M10 HC")
         formData.append('dist', 2);
@@ -253,51 +539,25 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
 
-    function executeSubmitParameters2(busbarName, id) {
-        console.log('Submitting parameters');
+    function addBusbar(busbarName) {
+        console.log('Adding busbar', busbarName);
 
-        const form = document.getElementById('manipulate-form');
-        const formData = new FormData(form);
-        formData.append('new_sbar_name_dyn', busbarName)
-        formData.append('new_sbar180deg_dyn', '0');
-        formData.append('new_sbarheight_dyn', 'False');
-        formData.append('new_id', id);
-        console.log(formData);
-        fetch('/submit_parameters', {
-            method: 'POST',
-            body: formData
-        }).then(response => {
-                if (response.ok) {
-                    console.log('Parameters submitted successfully');
-                    location.reload();
-                } else {
-                    // Handle errors
-                    console.error('Failed to submit parameters');
-                }
+        applyOperations([{op: 'add', type: 'busbar', name: busbarName, x: 0.0, y: 0.0, z: 0.92, length: 100.0, width: 5.0}])
+            .then(() => {
+                console.log('Busbar added');
+                location.reload();
             }).catch(error => {
                 console.error('Error:', error);
             });
     }
 
-    function executeSubmitParameters(id) {
-        console.log('Submitting parameters');
-
-        const form = document.getElementById('manipulate-form');
-        const formData = new FormData(form);
-        formData.append('new_string_name_dyn', id)
-        formData.append('new_string180deg_dyn', '0');
+    function addString() {
+        console.log('Placing string');
 
-        fetch('/submit_parameters', {
-            method: 'POST',
-            body: formData
-        }).then(response => {
-                if (response.ok) {
-                    console.log('Parameters submitted successfully');
-                    location.reload();
-                } else {
-                    // Handle errors
-                    console.error('Failed to submit parameters');
-                }
+        applyOperations([{op: 'add', type: 'string', x: 0.0, y: 0.0, z: 0.92}])
+            .then(() => {
+                console.log('String placed');
+                location.reload();
             }).catch(error => {
                 console.error('Error:', error);
             });
@@ -325,8 +585,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 console.log('Generating busbar name:', busbarName);
                 console.log('Adding new row');
                 addNewRow2(busbarName, id);
-                console.log('Executing submit parameters');
-                executeSubmitParameters2(busbarName, id);
+                addBusbar(busbarName);
             })
             .catch(error => console.error('Error:', error));
     });
@@ -371,8 +630,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 console.log('Generating string name:', id);
                 console.log('Adding new row');
                 addNewRow(id);
-                console.log('Executing submit parameters');
-                executeSubmitParameters(id);
+                addString();
             })
             .catch(error => console.error('Error:', error));
     });
@@ -426,6 +684,13 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
 
+        if (stringPlacements) {
+            if (stringPlacements.invalidEdits().length > 0) {
+                allValid = false;
+            }
+            stringPlacements.addEdits(formData);
+        }
+
         if (!allValid) {
             console.log('Please ensure all fields are filled.');
             warningMessage.textContent = 'Please ensure all number fields are filled.';
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import idf_tool.parse_idf as idf
+from idf_tool.document import IdfDocument
+
+STRING = 'String M10 HC 5 Cells 2mm +10mm -10mm'
+
+def make_document():
+    document = IdfDocument()
+    w_sbar, z_sbar = {}, {}
+    idf.add_busbar(document, w_sbar, z_sbar, ('sbar_001', 0.0, False, 0.0, 0.0, 0.0, 100.0, 5.0))
+    idf.generate_string_outline('M10 HC', 5, 2.0, 10.0, 10.0, document, STRING, idf.CELL_TYPES, None)
+    return document
+
+def apply(document, operations):
+    sbars = document.outline_names('busbar')
+    strings = document.outline_names('string')
+    return idf.apply_operations(document, operations, {name: 0.0 for name in sbars}, {name: False for name in sbars}, {},
+                                {name: [0.0, 0.0] for name in sbars}, {}, sbars, strings, {}, idf.CELL_TYPES)
+
+def test_resize_busbar():
+    document = make_document()
+    changes = apply(document, [{'op': 'resize', 'name': 'sbar_001', 'length': 150.0, 'width': 3.0}])
+    assert changes['outlines'] == {'sbar_001'}
+    assert document.outline('sbar_001')[:, :2].tolist() == [[0, 0], [150, 0], [150, 3], [0, 3], [0, 0]]
+
+def test_resize_busbar_starting_at_another_corner():
+    document = make_document()
+    ring = [[5.0, 0.0, 0.0], [5.0, 1107.2, 0.0], [0.0, 1107.2, 0.0], [0.0, 0.0, 0.0], [5.0, 0.0, 0.0]]
+    document.set_outline('sbar_001', 'busbar', False, ring)
+    apply(document, [{'op': 'resize', 'name': 'sbar_001', 'width': 1000.0}])
+    assert document.outline('sbar_001')[:, :2].tolist() == [[5, 0], [5, 1000], [0, 1000], [0, 0], [5, 0]]
+
+def test_resize_string_outline_is_rejected():
+    document = make_document()
+    before = document.outline(STRING).copy()
+    with pytest.raises(ValueError):
+        apply(document, [{'op': 'resize', 'name': STRING, 'length': 150.0}])
+    assert np.array_equal(document.outline(STRING), before)
+
+def test_resize_busbar_that_is_not_a_rectangle_is_rejected():
+    document = make_document()
+    document.set_outline('sbar_001', 'busbar', False, [[0.0, 0.0, 0.0], [10.0, 0.0, 0.0], [0.0, 5.0, 0.0], [0.0, 0.0, 0.0]])
+    with pytest.raises(ValueError):
+        apply(document, [{'op': 'resize', 'name': 'sbar_001', 'length': 150.0}])
+    assert document.outline('sbar_001')[:, :2].tolist() == [[0, 0], [10, 0], [0, 5], [0, 0]]